@@ -0,0 +1,2185 @@
+'''
+Benchmarks for the capstoneutils library. None of these talk to the real APIs;
+instead they run against a local stand-in server that answers the same endpoints
+with synthetic, deterministic data after a configurable delay, so the numbers
+only reflect the work done by the library itself and how it uses the network.
+
+Run this file directly to execute all the benchmarks, or only the bench_*
+functions named on the command line, or import it and call them from a notebook.
+bench_pipeline times the whole pipeline against recorded responses, so it can be
+run on every change to catch regressions.
+
+Author: Jason R. Foster
+'''
+import sys                          # For registering placeholder credentials
+import types                        # For building the placeholder credentials module
+import json                         # For encoding the stand-in responses
+import random                       # For generating deterministic synthetic data
+import threading                    # For running the stand-in server in the background
+import urllib.parse                 # For parsing query strings in the stand-in
+import os                           # For removing temporary cache files
+import tempfile                     # For keeping benchmark caches out of the working directory
+import subprocess                   # For measuring load time and memory in a fresh process
+import gzip                         # For storing recorded fixture responses
+import sqlite3                      # For reading recorded responses out of a response cache
+import zlib                         # For decompressing the recorded responses
+import gc                           # For collecting garbage between pipeline stages
+import shutil                       # For removing the pipeline's working directory
+import contextlib                   # For setting up and restoring the pipeline's settings
+from time import sleep, perf_counter, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from anytree import Node, search    # For building category trees and timing the original search
+import requests                     # For the errors raised when requests give up
+from fastnumbers import fast_real   # For the original soup based demographics parser
+
+# The benchmarks never send real credentials anywhere, so if the secrets module
+# isn't available we register placeholder values before loading the library
+if 'redacted' not in sys.modules:
+    try:
+        import redacted
+    except ImportError:
+        sys.modules['redacted'] = types.SimpleNamespace(
+            CLIENT_ID='bench', CLIENT_SECRET='bench', GOOGLE_API_KEY='bench', MY_VENUE='bench')
+
+import capstoneutils as csutil
+
+
+def synthetic_categories(top=10, mid=20, leaf=3):
+    '''
+    Builds a Foursquare-shaped category tree with the given fan out at each level
+
+    Keyword Arguments:
+    top -- The number of top-level categories. Default is 10
+    mid -- The number of children for each top-level category. Default is 20
+    leaf -- The number of children for each second-level category. Default is 3
+    '''
+    cats = []
+    for t in range(top):
+        children = []
+        for m in range(mid):
+            leaves = [{'id': 'cat-{}-{}-{}'.format(t, m, l), 'name': 'Category {}.{}.{}'.format(t, m, l),
+                       'categories': []} for l in range(leaf)]
+            children.append({'id': 'cat-{}-{}'.format(t, m), 'name': 'Category {}.{}'.format(t, m),
+                             'categories': leaves})
+        cats.append({'id': 'cat-{}'.format(t), 'name': 'Top {}'.format(t), 'categories': children})
+    return cats
+
+
+def synthetic_venues(lat, lng, count, categories):
+    '''
+    Returns a deterministic list of Foursquare explore items around the given point
+
+    Keyword Arguments:
+    lat -- The latitude of the centre point
+    lng -- The longitude of the centre point
+    count -- The number of venues to generate
+    categories -- A flat list of (id, name) tuples to draw categories from
+    '''
+    rnd = random.Random('{:.6f},{:.6f}'.format(lat, lng))
+    items = []
+    for i in range(count):
+        cid, cname = categories[rnd.randrange(len(categories))]
+        vlat = lat + rnd.uniform(-0.01, 0.01)
+        vlng = lng + rnd.uniform(-0.01, 0.01)
+        items.append({'venue': {
+            'id': 'v{:.5f}{:.5f}'.format(vlat, vlng),
+            'name': 'Venue {} near {:.4f},{:.4f}'.format(i, lat, lng),
+            'location': {'lat': vlat, 'lng': vlng},
+            'categories': [{'id': cid, 'name': cname}]}})
+    return items
+
+
+def flatten_categories(cats):
+    '''
+    Returns every (id, name) pair in a nested Foursquare category list
+
+    Keyword Arguments:
+    cats -- Json array of categories in the Foursquare format
+    '''
+    flat = []
+    for cat in cats:
+        flat.append((cat['id'], cat['name']))
+        flat.extend(flatten_categories(cat['categories']))
+    return flat
+
+
+DEMOGRAPHIC_FIELDS = [
+    ('Total Population', '{:,}'), ('Population in Households', '{:,}'), ('Population in Familes', '{:,}'),
+    ('Population in Group Qrtrs', '{:,}'), ('Population Density2', '{:,}'), ('Diversity Index3', '{}'),
+    ('Median Household Income', '${:,}'), ('Average Household Income', '${:,}'), ('Per Capita Income', '${:,}'),
+    ('Total Housing Units', '{:,} (100%)'), ('Owner Occupied HU', '{:,} (45.2%)'), ('Renter Occupied HU', '{:,} (40.1%)'),
+    ('Vacant Housing Units', '{:,} (14.7%)'), ('Median Home Value', '${:,}'), ('Average Home Value', '${:,}'),
+    ('Total Households', '{:,}'), ('Average Household Size', '{:.2f}'), ('Family Households', '{:,}'),
+    ('Average Family Size', '{}'),
+]
+
+def synthetic_demographics_page(zipcode, missing=False):
+    '''
+    Returns an HTML page laid out like a hometownlocator zip code page, with
+    navigation, scripts and filler around the three 'halfcontentpadded' divs, or
+    a page without them if missing is True
+
+    Keyword Arguments:
+    zipcode -- The zip code the page is for
+    missing -- Whether to leave out the demographic data. Default is False
+    '''
+    rnd = random.Random(zipcode)
+    filler = ''.join('<p class="note">Paragraph {} about {} with <a href="/x{}">a link</a> and more text.</p>'.format(
+        i, zipcode, i) for i in range(150))
+    nav = '<ul class="nav">' + ''.join('<li><a href="/s{0}">State {0}</a></li>'.format(i) for i in range(60)) + '</ul>'
+    head = '<html><head><title>{} Demographics</title><script>var x = {{"a": 1}};</script></head><body>'.format(zipcode)
+    if missing:
+        return head + nav + '<div class="halfcontentpadded"><p>No data for this zip code.</p></div>' + filler + '</body></html>'
+    tables = []
+    half = len(DEMOGRAPHIC_FIELDS) // 2
+    for fields in [DEMOGRAPHIC_FIELDS[:half], DEMOGRAPHIC_FIELDS[half:]]:
+        rows = ['<tr><td colspan="2"><b>2019 Summary</b></td></tr>']
+        for label, fmt in fields:
+            value = rnd.randint(2, 900000) if '{:,' in fmt or '{}' == fmt else rnd.uniform(1, 4)
+            rows.append('<tr><td><span class="label">{}</span>:</td><td class="val">{}</td></tr>'.format(label, fmt.format(value)))
+        tables.append('<div class="halfcontentpadded left"><table class="demog">{}</table></div>'.format(''.join(rows)))
+    intro = '<div class="halfcontentpadded"><table><tr><td>Zip code {}</td></tr></table></div>'.format(zipcode)
+    return head + nav + intro + filler + ''.join(tables) + filler + '</body></html>'
+
+
+def synthetic_county_zips(per_county=20, metros=None):
+    '''
+    Returns the rows of each zip-codes.com county page in ZIPCODE_PAGES and in the
+    other metros in METROS and metros, as a dictionary of county to a list of (zip code,
+    classification, city). Most are general zip codes in one of the county's
+    cities, but some are PO boxes or in other cities, which load_demographics
+    leaves out. The Denver zip codes start at 80000 and the other metros' at 10000
+
+    Keyword Arguments:
+    per_county -- The number of zip codes on each county page. Default is 20
+    metros -- More metro configs, laid out like METROS, whose counties to add.
+              Default is None
+    '''
+    counties = [(80000, sorted(csutil.ZIPCODE_PAGES.items()))]
+    counties += [(10000, [item for metro, config in sorted(dict(csutil.METROS, **(metros or {})).items())
+                          for item in sorted(config['counties'].items()) if item[0] not in csutil.ZIPCODE_PAGES])]
+    pages = {}
+    for base, items in counties:
+        for c, (county, cities) in enumerate(items):
+            rnd = random.Random(county)
+            pages[county] = [('{:05d}'.format(base + c * 100 + j),
+                              'PO Box' if j % 7 == 6 else 'General',
+                              'Elsewhere' if j % 11 == 10 else cities[rnd.randrange(len(cities))]) for j in range(per_county)]
+    return pages
+
+
+def synthetic_county_page(rows):
+    '''
+    Returns an HTML page laid out like a zip-codes.com county page, with the zip
+    codes in a table with class 'statTable'
+
+    Keyword Arguments:
+    rows -- A list of (zip code, classification, city) for the page
+    '''
+    cells = ['<tr><td><b>ZIP Code</b></td><td><b>Type</b></td><td><b>City</b></td><td><b>Population</b></td></tr>']
+    cells += ['<tr><td><a href="/zip-code/{0}/zip-code-{0}.asp">ZIP Code {0}</a></td><td>{1}</td><td>{2}</td>'
+              '<td>{3:,}</td></tr>'.format(z, kind, city, int(z) * 3 % 50000) for z, kind, city in rows]
+    return '<html><body><h1>County</h1><table class="statTable">{}</table></body></html>'.format(''.join(cells))
+
+
+def synthetic_franchise_page(franchises):
+    '''
+    Returns an HTML page laid out like the Wikipedia list of coffeehouse chains,
+    with the franchise names in the first column of a sortable wikitable
+
+    Keyword Arguments:
+    franchises -- The franchise names to list
+    '''
+    rows = ['<tr><th>Name</th><th>Country</th><th>Locations</th></tr>']
+    rows += ['<tr><td><a href="/wiki/F{}" title="{}">{}</a></td><td>USA</td><td>{}</td></tr>'.format(i, name, name, i * 13)
+             for i, name in enumerate(franchises)]
+    return '<html><body><table class="wikitable sortable">{}</table></body></html>'.format(''.join(rows))
+
+
+# Coffee franchises for the stand-in's Wikipedia page and coffee venues
+FRANCHISE_NAMES = ['Starbucks', "Dunkin' Donuts", "Peet's Coffee", 'Caribou Coffee', 'Tim Hortons',
+                   'Dazbog Coffee', 'Ink! Coffee', 'Scooter\'s Coffee', 'Dutch Bros. Coffee', 'The Human Bean']
+
+def synthetic_coffee_venues(lat, lng, count, franchises):
+    '''
+    Returns a deterministic list of Foursquare explore items for the coffee section
+    around the given point, a mix of franchise and independent coffee shops and a
+    few other venues that the section also returns
+
+    Keyword Arguments:
+    lat -- The latitude of the centre point
+    lng -- The longitude of the centre point
+    count -- The number of venues to generate
+    franchises -- The franchise names to draw from
+    '''
+    rnd = random.Random('coffee {:.6f},{:.6f}'.format(lat, lng))
+    items = []
+    for i in range(count):
+        vlat = lat + rnd.uniform(-0.01, 0.01)
+        vlng = lng + rnd.uniform(-0.01, 0.01)
+        kind = rnd.random()
+        if kind < 0.4:
+            name, category = franchises[rnd.randrange(len(franchises))], 'Coffee Shop'
+        elif kind < 0.85:
+            name, category = 'Cafe {} near {:.4f},{:.4f}'.format(i, lat, lng), 'Coffee Shop'
+        else:
+            name, category = 'Bakery {} near {:.4f},{:.4f}'.format(i, lat, lng), 'Bakery'
+        items.append({'venue': {
+            'id': 'c{:.5f}{:.5f}'.format(vlat, vlng),
+            'name': name,
+            'location': {'lat': vlat, 'lng': vlng},
+            'categories': [{'id': 'cat-' + category.lower(), 'name': category}]}})
+    return items
+
+
+def synthetic_latlon(place):
+    '''
+    Returns a deterministic latitude and longitude for a place, within the Denver area
+
+    Keyword Arguments:
+    place -- The place to geocode
+    '''
+    rnd = random.Random(' '.join(place.split()).upper())
+    return round(39.5 + rnd.random() * 0.5, 6), round(-105.3 + rnd.random() * 0.6, 6)
+
+
+def synthetic_world(clusters, background=0, bounds=(39.55, -105.25, 39.95, -104.75), seed=0):
+    '''
+    Returns a fixed set of venues for the stand-in to explore, as a dictionary of
+    arrays of ids, latitudes, longitudes and category positions. Venues are spread
+    uniformly over the bounds and in normally distributed clusters, which gives a
+    mix of dense and sparse areas like a real metro
+
+    Keyword Arguments:
+    clusters -- A sequence of (lat, lng, count, spread in meters) clusters
+    background -- The number of venues spread uniformly over the bounds. Default is 0
+    bounds -- The (south, west, north, east) bounds of the background venues
+    seed -- The random seed. Default is 0
+    '''
+    np = csutil.np
+    rnd = np.random.default_rng(seed)
+    lats = [rnd.uniform(bounds[0], bounds[2], background)]
+    lngs = [rnd.uniform(bounds[1], bounds[3], background)]
+    for lat, lng, count, spread in clusters:
+        lats.append(lat + rnd.normal(0, spread / csutil.METERS_PER_DEGREE, count))
+        lngs.append(lng + rnd.normal(0, spread / (csutil.METERS_PER_DEGREE * np.cos(np.radians(lat))), count))
+    lats, lngs = np.concatenate(lats), np.concatenate(lngs)
+    return {'id': np.array(['w{}'.format(i) for i in range(len(lats))]), 'lat': lats, 'lng': lngs,
+            'category': rnd.integers(0, 1 << 30, len(lats))}
+
+
+def world_venues_within(world, lat, lng, radius):
+    '''
+    Returns the positions of the world's venues within radius meters of the point,
+    nearest first, and their distances
+
+    Keyword Arguments:
+    world -- The synthetic_world
+    lat -- The latitude of the point
+    lng -- The longitude of the point
+    radius -- The radius in meters
+    '''
+    np = csutil.np
+    dy = (world['lat'] - lat) * csutil.METERS_PER_DEGREE
+    dx = (world['lng'] - lng) * csutil.METERS_PER_DEGREE * np.cos(np.radians(lat))
+    dist = np.hypot(dx, dy)
+    within = np.flatnonzero(dist <= radius)
+    return within[np.argsort(dist[within], kind='stable')], dist
+
+
+def world_explore(world, lat, lng, radius, limit, categories, section=None):
+    '''
+    Answers an explore request from the synthetic world, returning the nearest
+    venues within the radius up to the limit along with the total number there.
+    One venue in eight is a coffee shop, a third of them franchises, and the
+    coffee section returns only those
+
+    Keyword Arguments:
+    world -- The synthetic_world
+    lat -- The latitude of the point
+    lng -- The longitude of the point
+    radius -- The radius in meters
+    limit -- The most venues to return
+    categories -- A flat list of (id, name) tuples to draw categories from
+    section -- The explore section, of which only 'coffee' is answered. Default is None
+    '''
+    within, _ = world_venues_within(world, lat, lng, radius)
+    if section == 'coffee':
+        within = within[world['category'][within] % 8 == 0]
+    items = []
+    for i in within[:limit]:
+        category = world['category'][i]
+        cid, cname = categories[category % len(categories)]
+        name = 'World venue {}'.format(i)
+        if category % 8 == 0:
+            cname = 'Coffee Shop'
+            if category // 8 % 3 == 0:
+                name = FRANCHISE_NAMES[category // 24 % len(FRANCHISE_NAMES)]
+        items.append({'venue': {'id': world['id'][i], 'name': name,
+                                'location': {'lat': float(world['lat'][i]), 'lng': float(world['lng'][i])},
+                                'categories': [{'id': cid, 'name': cname}]}})
+    return {'totalResults': int(len(within)), 'groups': [{'items': items}]}
+
+
+# Content types of the responses from each endpoint, for replaying fixtures
+FIXTURE_CONTENT_TYPES = {'zipcodes': 'text/html; charset=utf-8', 'demographics': 'text/html; charset=utf-8',
+                         'franchises': 'text/html; charset=utf-8'}
+
+def fixture_key(url):
+    '''
+    Returns the key a response is stored under in a fixture file: the normalized
+    path and query of the url without the host or credentials, so responses
+    recorded from the real sites are found again when the library is pointed at
+    the stand-in. The hometownlocator state subdomain becomes the first part of
+    the path, as it is in the stand-in's DEMOGRAPHICS_URL
+
+    Keyword Arguments:
+    url -- The url, or just the path and query of a request to the stand-in
+    '''
+    parts = urllib.parse.urlsplit(csutil.normalize_url(url))
+    path = parts.path
+    if parts.netloc.endswith('.hometownlocator.com'):
+        path = '/' + parts.netloc.split('.')[0] + path
+    return path + ('?' + parts.query if parts.query else '')
+
+
+def export_fixtures(cache_path, fixture_path):
+    '''
+    Writes every response in a response cache file to a gzipped JSON fixture file
+    for the stand-in to replay, and returns the number of responses. Running the
+    notebooks once with the real API keys and the cache enabled records the real
+    responses, which can then be timed offline as often as needed
+
+    Keyword Arguments:
+    cache_path -- The response cache sqlite file, e.g. HTTP_CACHE_FILE
+    fixture_path -- The fixture file to write
+    '''
+    conn = sqlite3.connect(cache_path)
+    try:
+        fixtures = {fixture_key(key): {'endpoint': endpoint, 'body': zlib.decompress(body).decode('utf-8')}
+                    for key, endpoint, body in conn.execute('SELECT key, endpoint, body FROM responses')}
+    finally:
+        conn.close()
+    with gzip.open(fixture_path, 'wt', encoding='utf-8') as f:
+        json.dump(fixtures, f)
+    return len(fixtures)
+
+
+def load_fixtures(fixture_path):
+    '''
+    Reads a fixture file written by export_fixtures and returns a dictionary of
+    fixture key to (content type, body bytes)
+
+    Keyword Arguments:
+    fixture_path -- The fixture file to read
+    '''
+    with gzip.open(fixture_path, 'rt', encoding='utf-8') as f:
+        fixtures = json.load(f)
+    return {key: (FIXTURE_CONTENT_TYPES.get(f['endpoint'], 'application/json'), f['body'].encode('utf-8'))
+            for key, f in fixtures.items()}
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''
+    Threaded server with a listen backlog deep enough for the concurrent benchmarks
+    '''
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''
+    Request handler for the stand-in server. Each known path is answered with
+    synthetic data, or from the server's fixtures when it has them, after the
+    delay given by the server's latency setting
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connection_count += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_quota_headers()
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_html(self, text, status=200):
+        self.send_body(text.encode('utf-8'), 'text/html; charset=utf-8', status)
+
+    def send_body(self, data, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_quota_headers()
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_quota_headers(self):
+        # Reports the quota left in the current window the way Foursquare does,
+        # when the server has one
+        server = self.server
+        if server.quota_headers is not None:
+            self.send_header('X-RateLimit-Remaining', server.quota_headers[0])
+            self.send_header('X-RateLimit-Reset', server.quota_headers[1])
+            return
+        if server.quota_window is None:
+            return
+        limit, seconds = server.quota_window
+        with server.lock:
+            now = time()
+            if now >= server.quota_reset:
+                server.quota_reset, server.quota_used = now + seconds, 0
+            server.quota_used += 1
+            remaining = max(limit - server.quota_used, 0)
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', '{:.3f}'.format(server.quota_reset))
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            failure = server.rnd.random() < server.error_rate
+            stalled = server.rnd.random() < server.stall_rate
+            garbled = server.rnd.random() < server.garbled_rate
+            now = perf_counter()
+            if server.quota_rate:
+                server.quota_tokens = min(server.quota_rate, server.quota_tokens + (now - server.quota_updated) * server.quota_rate)
+                server.quota_updated = now
+                throttled = server.quota_tokens < 1
+                server.quota_tokens -= 0 if throttled else 1
+            else:
+                throttled = False
+        sleep(server.latency)
+
+        # Stalled requests are never answered, so the client has to time out
+        if stalled:
+            with server.lock:
+                server.error_count += 1
+            sleep(server.stall_seconds)
+            self.close_connection = True
+            return
+
+        # Injected failures alternate between throttling and server errors, and
+        # requests over the stand-in's quota are always throttled
+        if throttled or (failure and server.rnd.random() < 0.5):
+            with server.lock:
+                server.error_count += 1
+            self.send_response(429)
+            self.send_header('Retry-After', '0' if not throttled else '{:.3f}'.format(1 / server.quota_rate))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if failure:
+            with server.lock:
+                server.error_count += 1
+            self.send_json({'meta': {'code': 500}}, status=503)
+            return
+
+        if garbled:
+            # Like a proxy's error page in place of the API's answer
+            with server.lock:
+                server.error_count += 1
+            self.send_html('<html><body>Service temporarily unavailable</body></html>')
+        elif server.fixtures is not None:
+            fixture = server.fixtures.get(fixture_key(self.path))
+            if fixture is None:
+                self.send_json({'meta': {'code': 404}}, status=404)
+            else:
+                self.send_body(fixture[1], fixture[0])
+        elif parsed.path.endswith('/venues/categories'):
+            self.send_json({'meta': {'code': 200}, 'response': {'categories': server.categories}})
+        elif parsed.path.endswith('/venues/explore') and 'radius' in query and server.world is not None:
+            lat, lng = (float(v) for v in query['ll'].split(','))
+            self.send_json({'meta': {'code': 200}, 'response': world_explore(
+                server.world, lat, lng, float(query['radius']), int(query.get('limit', 100)), server.flat_categories,
+                query.get('section'))})
+        elif parsed.path.endswith('/venues/explore') and query.get('section') == 'coffee':
+            lat, lng = (float(v) for v in query['ll'].split(','))
+            items = synthetic_coffee_venues(lat, lng, min(int(query.get('limit', 100)), 30), FRANCHISE_NAMES)
+            self.send_json({'meta': {'code': 200}, 'response': {'groups': [{'items': items}]}})
+        elif parsed.path.endswith('/venues/explore'):
+            lat, lng = (float(v) for v in query['ll'].split(','))
+            count = min(int(query.get('limit', 100)), server.venues_per_location)
+            items = synthetic_venues(lat, lng, count, server.flat_categories)
+            self.send_json({'meta': {'code': 200}, 'response': {'groups': [{'items': items}]}})
+        elif parsed.path.endswith('/geocode/json') and query['address'] in server.unknown_places:
+            self.send_json({'status': 'ZERO_RESULTS', 'results': []})
+        elif parsed.path.endswith('/geocode/json'):
+            lat, lng = synthetic_latlon(query['address'])
+            self.send_json({'status': 'OK', 'results': [{'geometry': {'location': {'lat': lat, 'lng': lng}}}]})
+        elif parsed.path.startswith('/tiles/'):
+            self.send_body(server.tile_png, 'image/png')
+        elif '/zip-codes/data,zipcode,' in parsed.path:
+            zipcode = parsed.path.rsplit(',', 1)[1].split('.')[0]
+            self.send_html(synthetic_demographics_page(zipcode, missing=zipcode in server.missing_zips))
+        elif parsed.path.startswith('/county/'):
+            county = parsed.path.rsplit('/', 1)[1].split('.')[0]
+            self.send_html(synthetic_county_page(server.county_zips.get(county, [])))
+        elif parsed.path.startswith('/wiki/'):
+            self.send_html(synthetic_franchise_page(FRANCHISE_NAMES))
+        else:
+            self.send_json({'meta': {'code': 404}}, status=404)
+
+
+def start_standin(latency=0.05, venues_per_location=100, cache_path=None, error_rate=0.0, quota_rate=None, world=None,
+                  fixtures=None, zips_per_county=20, stall_rate=0.0, stall_seconds=5.0, quota_window=None,
+                  garbled_rate=0.0, metros=None):
+    '''
+    Starts the stand-in server on a free local port in a background thread and
+    returns the server. Use stop_standin to shut it down again
+
+    Keyword Arguments:
+    latency -- The number of seconds to wait before answering each request. Default is 0.05
+    venues_per_location -- The number of venues returned by each explore call. Default is 100
+    cache_path -- The response cache file to use. Default is None, which disables
+                  the cache so every call reaches the stand-in
+    error_rate -- The fraction of requests that fail with a 429 or 503. Default is 0
+    quota_rate -- The requests per second above which the stand-in answers with 429,
+                  or None for no quota. Default is None
+    world -- A synthetic_world to answer explore requests with a radius from, or
+             None to generate venues around each point. Default is None
+    fixtures -- Recorded responses from load_fixtures to answer every request
+                with, or None for synthetic responses. Requests without a
+                fixture are answered with a 404. Default is None
+    zips_per_county -- The number of zip codes on each synthetic county page.
+                       Default is 20
+    stall_rate -- The fraction of requests that are never answered. Default is 0
+    stall_seconds -- How long a stalled request holds its connection before it is
+                     dropped. Default is 5
+    quota_window -- A (limit, seconds) quota to report in X-RateLimit headers, or
+                    None to send none. Default is None
+    garbled_rate -- The fraction of requests answered with an HTML page and a 200
+                    status rather than the API's response. Default is 0
+    metros -- More metro configs, laid out like METROS, whose county pages to serve.
+              Default is None
+    '''
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    server.latency = latency
+    server.venues_per_location = venues_per_location
+    server.categories = synthetic_categories()
+    server.flat_categories = flatten_categories(server.categories)
+    server.request_count = 0
+    server.connection_count = 0
+    server.error_count = 0
+    server.error_rate = error_rate
+    server.stall_rate = stall_rate
+    server.stall_seconds = stall_seconds
+    server.garbled_rate = garbled_rate
+    server.unknown_places = set()
+    server.rnd = random.Random(0)
+    server.quota_rate = quota_rate
+    server.quota_tokens = float(quota_rate or 0)
+    server.quota_updated = perf_counter()
+    server.quota_window = quota_window
+    # Raw (remaining, reset) header values to send instead of the quota window's
+    server.quota_headers = None
+    server.quota_reset = 0.0
+    server.quota_used = 0
+    server.missing_zips = set()
+    server.world = world
+    server.fixtures = fixtures
+    server.county_zips = synthetic_county_zips(zips_per_county, metros)
+    server.tile_png = b''
+    server.lock = threading.Lock()
+    server.base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Point the library at the stand-in for the duration of the benchmark
+    server.saved_urls = {name: getattr(csutil, name) for name in
+                         ['FOURSQUARE_URL', 'DEMOGRAPHICS_URL', 'GEOCODE_URL', 'ZIPCODES_URL', 'FRANCHISES_URL']}
+    server.saved_cache = (csutil.HTTP_CACHE_FILE, csutil.http_cache_enabled)
+    csutil.FOURSQUARE_URL = server.base_url + '/v2'
+    csutil.GEOCODE_URL = server.base_url + '/maps/api/geocode/json'
+    csutil.DEMOGRAPHICS_URL = server.base_url + '/{}/zip-codes/data,zipcode,{}.cfm'
+    csutil.ZIPCODES_URL = server.base_url + '/county/{}.asp'
+    csutil.FRANCHISES_URL = server.base_url + '/wiki/List_of_coffeehouse_chains'
+    csutil.configure_cache(path=cache_path, enabled=cache_path is not None)
+    return server
+
+
+def stop_standin(server):
+    '''
+    Stops the given stand-in server and points the library back at the real APIs
+
+    Keyword Arguments:
+    server -- The server returned from start_standin
+    '''
+    for name, value in server.saved_urls.items():
+        setattr(csutil, name, value)
+    csutil.configure_cache(path=server.saved_cache[0], enabled=server.saved_cache[1])
+    server.shutdown()
+    server.server_close()
+
+
+def synthetic_centroids(n, lat=39.74, lng=-104.99):
+    '''
+    Returns n fake zip codes with centroids scattered around the given point
+
+    Keyword Arguments:
+    n -- The number of zip codes to generate
+    lat -- The latitude to scatter the centroids around. Default is Denver
+    lng -- The longitude to scatter the centroids around. Default is Denver
+    '''
+    rnd = random.Random(n)
+    names = ['{:05d}'.format(80000 + i) for i in range(n)]
+    lats = [lat + rnd.uniform(-0.3, 0.3) for _ in range(n)]
+    lngs = [lng + rnd.uniform(-0.3, 0.3) for _ in range(n)]
+    return names, lats, lngs
+
+
+def bench_explore(n_zips=100, latency=0.05, workers=(1, 4, 16, 32)):
+    '''
+    Times the explore stage for a run of zip codes at each level of concurrency,
+    then checks that get_nearby_venues returns exactly the same frame from the
+    concurrent path as from the serial one
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes to explore. Default is 100
+    latency -- The simulated network latency per request in seconds. Default is 0.05
+    workers -- The max_workers values to time. Default is (1, 4, 16, 32)
+    '''
+    names, lats, lngs = synthetic_centroids(n_zips)
+    server = start_standin(latency=latency)
+    try:
+        serial_time = None
+        for w in workers:
+            start = perf_counter()
+            csutil.explore_locations(lats, lngs, max_workers=w)
+            elapsed = perf_counter() - start
+            serial_time = serial_time or elapsed
+            print('explore: {} zips, max_workers={:>3}: {:7.2f}s  ({:5.1f}x)'.format(
+                n_zips, w, elapsed, serial_time / elapsed))
+
+        serial = csutil.get_nearby_venues(names, lats, lngs, max_workers=1)
+        concurrent = csutil.get_nearby_venues(names, lats, lngs, max_workers=max(workers))
+        if not concurrent.equals(serial):
+            raise AssertionError('Concurrent get_nearby_venues returned a different frame')
+        print('explore: concurrent and serial frames are identical ({} rows)'.format(serial.shape[0]))
+    finally:
+        stop_standin(server)
+
+
+def synthetic_explored(n_venues, categories, per_location=100):
+    '''
+    Returns rownames, coordinates and raw EXPLORE results totalling n_venues venues,
+    built without going through the stand-in server
+
+    Keyword Arguments:
+    n_venues -- The total number of venues to generate
+    categories -- A flat list of (id, name) tuples to draw categories from
+    per_location -- The number of venues for each location. Default is 100
+    '''
+    n_zips = max(1, n_venues // per_location)
+    names, lats, lngs = synthetic_centroids(n_zips)
+    explored = [{'response': {'groups': [{'items': synthetic_venues(lat, lng, per_location, categories)}]}}
+                for lat, lng in zip(lats, lngs)]
+    return names, lats, lngs, explored
+
+
+def bench_venue_frame(sizes=(1000, 10000, 100000, 1000000)):
+    '''
+    Times building the venue frame from raw EXPLORE results at increasing sizes to
+    show that the cost per venue stays flat as the number of venues grows
+
+    Keyword Arguments:
+    sizes -- The total numbers of venues to time. Default is 1k to 1M
+    '''
+    # Use a shallow tree so the timing is dominated by building the frame
+    cats = synthetic_categories(top=10, mid=0)
+    tree = Node('root')
+    csutil.add_categories(cats, tree)
+    flat = flatten_categories(cats)
+
+    for size in sizes:
+        names, lats, lngs, explored = synthetic_explored(size, flat)
+        start = perf_counter()
+        frame = csutil.venues_frame(names, lats, lngs, explored, tree)
+        elapsed = perf_counter() - start
+        print('venue frame: {:>8} venues: {:8.3f}s  ({:6.2f} us/venue)'.format(
+            frame.shape[0], elapsed, elapsed / frame.shape[0] * 1e6))
+
+
+def bench_categories(n_venues=100000, n_search=2000):
+    '''
+    Compares classifying venues by searching the whole category tree for each one,
+    as get_top_parent used to, against the flat index built by index_categories
+
+    Keyword Arguments:
+    n_venues -- The number of venue category ids to classify with the index. Default is 100k
+    n_search -- The number of ids to classify with the tree search. Default is 2000
+    '''
+    cats = synthetic_categories()
+    tree = Node('root')
+    csutil.add_categories(cats, tree)
+    rnd = random.Random(0)
+    flat = flatten_categories(cats)
+    ids = [flat[rnd.randrange(len(flat))][0] for _ in range(n_venues)]
+
+    def tree_search(name):
+        node = search.findall(tree, filter_=lambda node: node.name == name)[0]
+        return node if len(node.ancestors) == 1 else node.ancestors[1]
+
+    start = perf_counter()
+    searched = [tree_search(i).descr for i in ids[:n_search]]
+    search_time = (perf_counter() - start) / n_search
+
+    start = perf_counter()
+    csutil.index_categories(tree)
+    index_time = perf_counter() - start
+
+    start = perf_counter()
+    looked_up = [csutil.get_top_parent(tree, i).descr for i in ids]
+    lookup_time = (perf_counter() - start) / n_venues
+
+    start = perf_counter()
+    mapped = csutil.get_top_descrs(tree, ids)
+    map_time = (perf_counter() - start) / n_venues
+
+    if searched != looked_up[:n_search] or looked_up != mapped.tolist():
+        raise AssertionError('Category index disagrees with the tree search')
+    print('categories: {} nodes, index built in {:.2f}ms'.format(len(flat), index_time * 1e3))
+    print('categories: tree search {:9.2f} us/venue'.format(search_time * 1e6))
+    print('categories: index       {:9.3f} us/venue  ({:,.0f}x)'.format(lookup_time * 1e6, search_time / lookup_time))
+    print('categories: vector map  {:9.3f} us/venue  ({:,.0f}x)'.format(map_time * 1e6, search_time / map_time))
+
+
+def bench_cache(n_zips=100, latency=0.05):
+    '''
+    Runs get_nearby_venues twice against the stand-in with the response cache turned
+    on, and reports the time and number of requests that reached the server for the
+    cold and the warm run. The warm run should not make any requests at all
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes to explore. Default is 100
+    latency -- The simulated network latency per request in seconds. Default is 0.05
+    '''
+    names, lats, lngs = synthetic_centroids(n_zips)
+    fd, cache_path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    server = start_standin(latency=latency, cache_path=cache_path)
+    try:
+        frames = []
+        for run in ['cold', 'warm']:
+            before = server.request_count
+            start = perf_counter()
+            frames.append(csutil.get_nearby_venues(names, lats, lngs))
+            elapsed = perf_counter() - start
+            print('cache: {} run: {:7.2f}s, {:>4} requests, {}'.format(
+                run, elapsed, server.request_count - before, csutil.cache_stats()))
+        if not frames[0].equals(frames[1]):
+            raise AssertionError('Cached get_nearby_venues returned a different frame')
+    finally:
+        stop_standin(server)
+        os.remove(cache_path)
+
+
+def bench_cache_store(n=20000, body_bytes=4000, max_entries=5000):
+    '''
+    Times ResponseCache directly: n stores into a cache that holds about
+    max_entries responses, so most stores evict, then n hits spread over the
+    entries that are left. Checks that the cache stays under its size limit, that
+    its running total matches the stored sizes and that a response hit just
+    before the cache fills up again survives as the most recently used
+
+    Keyword Arguments:
+    n -- The number of stores and of hits. Default is 20000
+    body_bytes -- The size of each response body. Default is 4000
+    max_entries -- About how many compressed responses fit in the cache. Default is 5000
+    '''
+    rnd = random.Random(0)
+    # Random hex compresses to about half its size, like the JSON responses do
+    bodies = [''.join(rnd.choice('0123456789abcdef') for _ in range(body_bytes)) for _ in range(50)]
+    urls = ['http://example.com/v2/venues/explore?ll={},{}'.format(i, i) for i in range(n)]
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        cache = csutil.ResponseCache(path, {'explore': 86400}, max_entries * len(zlib.compress(bodies[0].encode())))
+        start = perf_counter()
+        for i, url in enumerate(urls):
+            cache.put(url, 'explore', bodies[i % len(bodies)])
+        stores = perf_counter() - start
+        kept = urls[-max_entries // 2:]
+        start = perf_counter()
+        for i in range(n):
+            if cache.get(kept[(i * 7919) % len(kept)], 'explore') is None:
+                raise AssertionError('A response that should be cached was missing')
+        hits = perf_counter() - start
+
+        # The oldest stored response is hit, so it is the most recently used when
+        # the next stores evict
+        survivor = kept[0]
+        cache.get(survivor, 'explore')
+        for url in urls[:max_entries // 4]:
+            cache.put(url, 'explore', bodies[0])
+        stats = cache.stats()
+        stored = cache.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if stats['bytes'] != stored or stored > cache.max_bytes:
+            raise AssertionError('The cache holds {} bytes, counted {}, limit {}'.format(stored, stats['bytes'], cache.max_bytes))
+        if cache.get(survivor, 'explore') is None:
+            raise AssertionError('The most recently used response was evicted')
+        print('cache store: {} stores: {:6.2f}s ({:7.0f}/s), {} hits: {:6.2f}s ({:7.0f}/s), {} entries, {} evictions'.format(
+            n, stores, n / stores, n, hits, n / hits, stats['entries'], stats['evictions']))
+        cache.close()
+    finally:
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def bench_session(n_zips=500, latency=0.0, max_workers=8):
+    '''
+    Runs the explore stage for a run of zip codes with a new connection for every
+    request and again with the pooled keep-alive session, and reports the time and
+    the number of connections the stand-in accepted for each. The stand-in is plain
+    HTTP, so the savings against the real APIs are larger by the cost of the TLS
+    handshake that is skipped on every reused connection
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes to explore. Default is 500
+    latency -- The simulated server latency per request in seconds. Default is 0
+    max_workers -- The number of concurrent requests. Default is 8
+    '''
+    names, lats, lngs = synthetic_centroids(n_zips)
+    server = start_standin(latency=latency)
+    try:
+        for pooled in [False, True]:
+            csutil.configure_session(pooled=pooled)
+            before = server.connection_count
+            start = perf_counter()
+            csutil.explore_locations(lats, lngs, max_workers=max_workers)
+            elapsed = perf_counter() - start
+            print('session: {} zips, pooled={!s:<5}: {:6.2f}s, {:>4} connections'.format(
+                n_zips, pooled, elapsed, server.connection_count - before))
+    finally:
+        csutil.configure_session(pooled=True)
+        stop_standin(server)
+
+
+def bench_retry(n_zips=100, error_rate=0.3, latency=0.01, max_workers=8, stall_rate=0.05, read_timeout=0.25):
+    '''
+    Explores a run of zip codes against a stand-in that fails a share of requests
+    with 429 and 503 responses, then against one that never answers a share of
+    them, and checks that the retries still produce exactly the frame of a clean
+    run. Stalled requests are retried once they pass the read timeout
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes to explore. Default is 100
+    error_rate -- The fraction of requests that fail. Default is 0.3
+    latency -- The simulated network latency per request in seconds. Default is 0.01
+    max_workers -- The number of concurrent requests. Default is 8
+    stall_rate -- The fraction of requests that are never answered. Default is 0.05
+    read_timeout -- The read timeout in seconds for the stalled run. Default is 0.25
+    '''
+    names, lats, lngs = synthetic_centroids(n_zips)
+    saved_base, saved_timeout = csutil.HTTP_BACKOFF_BASE, csutil.HTTP_TIMEOUT
+    csutil.HTTP_BACKOFF_BASE = 0.05
+    try:
+        server = start_standin(latency=latency)
+        try:
+            clean = csutil.get_nearby_venues(names, lats, lngs, max_workers=max_workers)
+        finally:
+            stop_standin(server)
+
+        runs = [('{:.0%} injected errors'.format(error_rate), {'error_rate': error_rate}),
+                ('{:.0%} stalled requests'.format(stall_rate), {'stall_rate': stall_rate, 'stall_seconds': 5.0})]
+        for label, settings in runs:
+            csutil.HTTP_TIMEOUT = (csutil.HTTP_TIMEOUT[0], read_timeout) if 'stall_rate' in settings else saved_timeout
+            server = start_standin(latency=latency, **settings)
+            try:
+                before = dict(csutil.http_counters)
+                start = perf_counter()
+                flaky = csutil.get_nearby_venues(names, lats, lngs, max_workers=max_workers)
+                elapsed = perf_counter() - start
+            finally:
+                stop_standin(server)
+            if not flaky.equals(clean):
+                raise AssertionError('Retried get_nearby_venues returned a different frame')
+            print('retry: {} zips, {}: {:6.2f}s, {} errors served, {} retries, {} failures'.format(
+                n_zips, label, elapsed, server.error_count,
+                csutil.http_counters['retries'] - before['retries'],
+                csutil.http_counters['failures'] - before['failures']))
+    finally:
+        csutil.HTTP_BACKOFF_BASE, csutil.HTTP_TIMEOUT = saved_base, saved_timeout
+
+
+def bench_rate_limit(n_zips=200, quota_rate=40, max_workers=16):
+    '''
+    Explores a run of zip codes against a stand-in that enforces a requests per
+    second quota, first without a client-side limit and then with the explore
+    limiter set to the quota, and reports the throughput and throttled responses.
+    Then explores them against a stand-in that reports an hourly quota in
+    X-RateLimit headers, which shouldn't slow the requests down until the quota
+    runs low, and one that is nearly used up, which should
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes to explore. Default is 200
+    quota_rate -- The stand-in's quota in requests per second. Default is 40
+    max_workers -- The number of concurrent requests. Default is 16
+    '''
+    names, lats, lngs = synthetic_centroids(n_zips)
+    saved_limits, saved_base = dict(csutil.HTTP_RATE_LIMITS), csutil.HTTP_BACKOFF_BASE
+    csutil.HTTP_BACKOFF_BASE = 0.05
+    try:
+        for limit in [None, quota_rate]:
+            csutil.HTTP_RATE_LIMITS['explore'] = (limit, 1)
+            csutil.http_limiters.pop('explore', None)
+            server = start_standin(latency=0.005, quota_rate=quota_rate)
+            outcome = 'completed'
+            try:
+                start = perf_counter()
+                csutil.explore_locations(lats, lngs, max_workers=max_workers)
+            except requests.exceptions.RetryError:
+                outcome = 'gave up'
+            finally:
+                elapsed = perf_counter() - start
+                stop_standin(server)
+            print('rate limit: quota {}/s, client limit {!s:>4}: {} in {:5.2f}s, {:>4} requests, {:>4} throttled'.format(
+                quota_rate, limit, outcome, elapsed, server.request_count, server.error_count))
+
+        # Endpoints without a client-side limit are only held back by the quota the
+        # server reports
+        csutil.HTTP_RATE_LIMITS.pop('explore', None)
+        for window in [(5000, 3600), (n_zips // 2, 4)]:
+            csutil.http_limiters.pop('explore', None)
+            server = start_standin(latency=0.005, quota_window=window)
+            try:
+                start = perf_counter()
+                csutil.explore_locations(lats, lngs, max_workers=max_workers)
+                elapsed = perf_counter() - start
+            finally:
+                stop_standin(server)
+            print('rate limit: reported quota {} per {}s: {:>4} requests in {:5.2f}s, {:7.1f} requests/s'.format(
+                window[0], window[1], server.request_count, elapsed, server.request_count / elapsed))
+    finally:
+        csutil.HTTP_RATE_LIMITS.clear()
+        csutil.HTTP_RATE_LIMITS.update(saved_limits)
+        csutil.http_limiters.pop('explore', None)
+        csutil.HTTP_BACKOFF_BASE = saved_base
+
+
+# Run in a fresh interpreter so that peak memory only reflects the one load
+LOAD_SCRIPT = '''
+import time
+import pandas as pd, pyarrow.parquet
+import capstonebench, capstoneutils as csutil
+csutil.DATA_DIR = {!r}
+def peak_mb():
+    return [int(l.split()[1]) for l in open('/proc/self/status') if l.startswith('VmHWM')][0] / 1024
+base = peak_mb()
+start = time.perf_counter()
+{}
+elapsed = time.perf_counter() - start
+print(elapsed, peak_mb() - base, df.shape[0], df.shape[1])
+'''
+
+
+def bench_storage(scale=100):
+    '''
+    Scales the stored datasets up by the given factor, giving each copy its own
+    zip codes, and compares the time and peak memory to load them from a pickle
+    against the Parquet store: in full, a single column and two zip codes. Peak
+    memory is read from /proc, so this benchmark only runs on Linux
+
+    Keyword Arguments:
+    scale -- The number of copies of each dataset to store. Default is 100
+    '''
+    import pandas as pd
+    tmpdir = tempfile.mkdtemp()
+    saved_dir = csutil.DATA_DIR
+    csutil.DATA_DIR = tmpdir
+    try:
+        for name in ['all_demog', 'fsq_venues']:
+            df = pd.read_pickle('{}.pkl'.format(name))
+            big = pd.concat([df.assign(ZipCode=df['ZipCode'].astype(str) + '-{}'.format(k)) for k in range(scale)],
+                            ignore_index=True)
+            big['ZipCode'] = big['ZipCode'].astype(object)
+            pkl = os.path.join(tmpdir, '{}.pkl'.format(name))
+            big.to_pickle(pkl)
+            csutil.write_dataset(big, name)
+            parquet = csutil.dataset_file(name)
+            zips = list(big['ZipCode'].unique()[:2])
+            loads = [
+                ('pickle, full', 'df = pd.read_pickle({!r})'.format(pkl)),
+                ('parquet, full', 'df = csutil.read_dataset({!r})'.format(name)),
+                ('parquet, 1 column', 'df = csutil.read_dataset({!r}, columns=["ZipCode"])'.format(name)),
+                ('parquet, 2 zips', 'df = csutil.read_dataset({!r}, zipcodes={!r})'.format(name, zips)),
+            ]
+            print('storage: {} x{} = {} rows, pickle {:.1f}MB, parquet {:.1f}MB'.format(
+                name, scale, big.shape[0], os.path.getsize(pkl) / 2**20, os.path.getsize(parquet) / 2**20))
+            for label, code in loads:
+                out = subprocess.run([sys.executable, '-c', LOAD_SCRIPT.format(tmpdir, code)],
+                                     capture_output=True, text=True, check=True,
+                                     cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+                print('storage:   {:<18} {:7.3f}s, peak +{:7.1f}MB, {:>7} x {} frame'.format(
+                    label, float(out[0]), float(out[1]), out[2], out[3]))
+    finally:
+        csutil.DATA_DIR = saved_dir
+        for f in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, f))
+        os.rmdir(tmpdir)
+
+
+def synthetic_venue_frame(n_zips, per_zip=100, n_categories=400, seed=0):
+    '''
+    Returns a venue frame shaped like the output of get_nearby_venues, with
+    category popularity skewed so that some categories are far more common
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes
+    per_zip -- The number of venues in each zip code. Default is 100
+    n_categories -- The number of distinct main categories. Default is 400
+    seed -- The random seed. Default is 0
+    '''
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    n = n_zips * per_zip
+    names, lats, lngs = synthetic_centroids(n_zips)
+    weights = 1.0 / np.arange(1, n_categories + 1)
+    cats = np.array(['Category {:03d}'.format(i) for i in range(n_categories)], dtype=object)
+    tops = np.array(['Top {}'.format(i % 10) for i in range(n_categories)], dtype=object)
+    cat_idx = rng.choice(n_categories, size=n, p=weights / weights.sum())
+    return pd.DataFrame({
+        'ZipCode': np.repeat(np.array(names, dtype=object), per_zip),
+        'Centroid Latitude': np.repeat(lats, per_zip),
+        'Centroid Longitude': np.repeat(lngs, per_zip),
+        'Venue': np.array(['Venue {}'.format(i) for i in range(n)], dtype=object),
+        'Venue Latitude': np.repeat(lats, per_zip) + rng.uniform(-0.01, 0.01, n),
+        'Venue Longitude': np.repeat(lngs, per_zip) + rng.uniform(-0.01, 0.01, n),
+        'Venue Main Category': cats[cat_idx],
+        'Venue Top-Level Category': tops[cat_idx]})
+
+
+def top_venues_onehot(result_venues, num_top_venues=10):
+    '''
+    The original one hot encoding version of get_top_venues, with a stable sort so
+    its ties come out in the same order, kept here as the baseline to compare with
+
+    Keyword Arguments:
+    result_venues -- Dataframe containg the venue data
+    num_top_venues -- The number of venues to return. Default is 10
+    '''
+    import pandas as pd
+    onehot = pd.get_dummies(result_venues[['Venue Main Category']], prefix="", prefix_sep="")
+    onehot['ZipCode'] = result_venues['ZipCode']
+    onehot_grouped = onehot.groupby('ZipCode').mean().reset_index()
+    top = [onehot_grouped.iloc[ind, 1:].sort_values(ascending=False, kind='stable').index.values[0:num_top_venues]
+           for ind in range(onehot_grouped.shape[0])]
+    return onehot_grouped[['ZipCode']].join(pd.DataFrame(top, index=onehot_grouped.index))
+
+
+def bench_top_venues(n_zips=10000, baseline_zips=1000):
+    '''
+    Times get_top_venues at n_zips zip codes of 100 venues each, and both it and
+    the original one hot encoding version at baseline_zips, checking they agree
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes to time get_top_venues with. Default is 10k
+    baseline_zips -- The number of zip codes for the comparison. Default is 1000
+    '''
+    small = synthetic_venue_frame(baseline_zips)
+    start = perf_counter()
+    expected = top_venues_onehot(small)
+    onehot_time = perf_counter() - start
+    start = perf_counter()
+    actual = csutil.get_top_venues(small)
+    batched_time = perf_counter() - start
+    if not (actual.values == expected.values).all():
+        raise AssertionError('Batched get_top_venues disagrees with the one hot version')
+    print('top venues: {:>6} zips, one hot {:7.2f}s, batched {:7.3f}s ({:,.0f}x)'.format(
+        baseline_zips, onehot_time, batched_time, onehot_time / batched_time))
+
+    big = synthetic_venue_frame(n_zips)
+    start = perf_counter()
+    csutil.get_top_venues(big)
+    print('top venues: {:>6} zips ({} venues), batched {:7.3f}s'.format(n_zips, big.shape[0], perf_counter() - start))
+
+
+def diversity_notebook(result_venues):
+    '''
+    The reciprocal Simpson's Diversity Index as calculated in the Week 5 notebook,
+    kept here as the baseline to compare with
+
+    Keyword Arguments:
+    result_venues -- Dataframe containing the venue data
+    '''
+    import pandas as pd
+    t1 = result_venues.loc[:, ['ZipCode', 'Venue Top-Level Category', 'Venue Main Category', 'Venue']]
+    t2 = t1.groupby(by=['ZipCode', 'Venue Top-Level Category', 'Venue Main Category'])['Venue'].count().reset_index()
+    t2.rename(columns={'Venue': 'Little-n'}, inplace=True)
+    t3 = t2.groupby(by=['ZipCode', 'Venue Top-Level Category'])['Little-n'].sum().reset_index()
+    t3.rename(columns={'Little-n': 'Big-N'}, inplace=True)
+    t4 = pd.merge(t2,t3,left_on=['ZipCode','Venue Top-Level Category'], right_on=['ZipCode','Venue Top-Level Category'], how='inner', validate='m:1')
+    t4['Squared n-N Ratio'] = t4.apply(lambda row: pd.Series((row['Little-n'] / row['Big-N'])**2), axis=1)
+    t5 = t4.groupby(by=['ZipCode', 'Venue Top-Level Category'])['Squared n-N Ratio'].sum().reset_index()
+    t5['Simpsons RI'] = t5.apply(lambda row: pd.Series(1 / row['Squared n-N Ratio']), axis=1)
+    t5.drop('Squared n-N Ratio', axis=1, inplace=True)
+    return pd.pivot_table(t5, index='ZipCode', columns='Venue Top-Level Category', values='Simpsons RI', fill_value=0.0)
+
+
+def bench_diversity(n_zips=10000, chunk_rows=100000):
+    '''
+    Times get_diversity_index against the notebook calculation on synthetic data,
+    then times get_diversity_index on a larger frame, whole and in chunks. The
+    correctness checks are in test_capstoneutils
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes of 100 venues for the large run. Default is 10k
+    chunk_rows -- The number of rows in each chunk for the chunked run. Default is 100k
+    '''
+    small = synthetic_venue_frame(200)
+    start = perf_counter()
+    diversity_notebook(small)
+    notebook_time = perf_counter() - start
+    start = perf_counter()
+    csutil.get_diversity_index(small)
+    vector_time = perf_counter() - start
+    print('diversity: {} venues, notebook {:6.2f}s, vectorized {:6.3f}s ({:,.0f}x)'.format(
+        small.shape[0], notebook_time, vector_time, notebook_time / vector_time))
+
+    big = synthetic_venue_frame(n_zips)
+    start = perf_counter()
+    whole = csutil.get_diversity_index(big)
+    whole_time = perf_counter() - start
+    start = perf_counter()
+    chunked = csutil.get_diversity_index(big.iloc[i:i + chunk_rows] for i in range(0, big.shape[0], chunk_rows))
+    chunked_time = perf_counter() - start
+    print('diversity: {} venues, whole {:6.3f}s, in chunks of {} {:6.3f}s'.format(
+        big.shape[0], whole_time, chunk_rows, chunked_time))
+
+
+def bench_kmeans_sweep(n_samples=2000, n_features=20, k_range=range(2, 20), n_init=10, workers=(1, 2, 4)):
+    '''
+    Times sweep_kmeans on synthetic blobs with different numbers of worker processes
+    and checks that every run returns the same frame. The speedup is bounded by the
+    number of cores on the machine
+
+    Keyword Arguments:
+    n_samples -- The number of rows in the feature matrix. Default is 2000
+    n_features -- The number of features. Default is 20
+    k_range -- The values of k to sweep. Default is 2 through 19
+    n_init -- The number of k-means initializations for each k. Default is 10
+    workers -- The numbers of processes to time. Default is (1, 2, 4)
+    '''
+    import numpy as np
+    from sklearn.datasets import make_blobs
+    X, _ = make_blobs(n_samples=n_samples, n_features=n_features, centers=8, random_state=0)
+    baseline, serial_time = None, None
+    for w in workers:
+        start = perf_counter()
+        result = csutil.sweep_kmeans(X, k_range=k_range, n_init=n_init, max_workers=w)
+        elapsed = perf_counter() - start
+        if baseline is None:
+            baseline, serial_time = result, elapsed
+        elif not np.allclose(result.values, baseline.values):
+            raise AssertionError('sweep_kmeans with {} workers returned a different frame'.format(w))
+        print('kmeans sweep: {} x {}, {} values of k, {} workers: {:6.2f}s ({:4.1f}x, {} cores)'.format(
+            n_samples, n_features, len(k_range), w, elapsed, serial_time / elapsed, os.cpu_count()))
+
+
+def parse_demographics_soup(html, zipcode):
+    '''
+    The original BeautifulSoup extraction from scrape_demographics, kept here as
+    the baseline to compare with
+
+    Keyword Arguments:
+    html -- The text of the page
+    zipcode -- The zip code the page is for
+    '''
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'lxml')
+    data = {"ZipCode": zipcode}
+    divs = soup.findAll('div', {"class": "halfcontentpadded"})
+    if (len(divs) < 3):
+        return None
+    for i in [1,2]:
+        rows = divs[i].find('table').findAll('tr')
+        for row in rows:
+            cells = row.findAll('td')
+            if not cells or cells[0].has_attr('colspan'):
+                continue
+            key = cells[0].find('span').get_text().strip()
+            data[key] = fast_real(csutil.clean_value(cells[1].get_text().strip()))
+    return data
+
+
+def bench_demographics(n_pages=2000, n_zips=200, latency=0.05, workers=(1, 16)):
+    '''
+    Times parsing fixture demographics pages with the original soup extraction and
+    with parse_demographics, checking they agree, then times scraping a run of zip
+    codes from the stand-in serially and concurrently, with some zip codes missing
+    so that the fallback page is needed
+
+    Keyword Arguments:
+    n_pages -- The number of fixture pages to parse. Default is 2000
+    n_zips -- The number of zip codes to scrape from the stand-in. Default is 200
+    latency -- The simulated network latency per request in seconds. Default is 0.05
+    workers -- The max_workers values to time scraping with. Default is (1, 16)
+    '''
+    pages = [('{:05d}'.format(80000 + i), synthetic_demographics_page('{:05d}'.format(80000 + i)))
+             for i in range(n_pages)]
+    for label, parse in [('soup', parse_demographics_soup), ('lxml xpath', csutil.parse_demographics)]:
+        start = perf_counter()
+        parsed = [parse(html, zipcode) for zipcode, html in pages]
+        elapsed = perf_counter() - start
+        print('demographics: {:<10} parsed {} pages of {:.0f}KB at {:7.0f} pages/s'.format(
+            label, n_pages, len(pages[0][1]) / 1024, n_pages / elapsed))
+        if label == 'soup':
+            expected = parsed
+        elif parsed != expected:
+            raise AssertionError('parse_demographics disagrees with the soup extraction')
+
+    zips = ['{:05d}'.format(80000 + i) for i in range(n_zips)]
+    saved_limits = dict(csutil.HTTP_RATE_LIMITS)
+    csutil.HTTP_RATE_LIMITS.pop('demographics', None)
+    csutil.http_limiters.pop('demographics', None)
+    try:
+        baseline = None
+        for w in workers:
+            server = start_standin(latency=latency)
+            server.missing_zips = set(zips[::10])
+            csutil.clear_fallback_demographics()
+            try:
+                start = perf_counter()
+                scraped = list(csutil.scrape_demographics_many(zips, ['colorado'] * n_zips, max_workers=w))
+                elapsed = perf_counter() - start
+            finally:
+                stop_standin(server)
+            if baseline is None:
+                baseline, serial_time, serial_requests = scraped, elapsed, server.request_count
+            elif scraped != baseline:
+                raise AssertionError('Concurrent scraping returned different demographics')
+            elif server.request_count != serial_requests:
+                raise AssertionError('Concurrent scraping made {} requests rather than {}'.format(
+                    server.request_count, serial_requests))
+            print('demographics: scraped {} zips ({} missing), max_workers={:>3}: {:6.2f}s ({:4.1f}x), {} requests'.format(
+                n_zips, len(server.missing_zips), w, elapsed, serial_time / elapsed, server.request_count))
+    finally:
+        csutil.HTTP_RATE_LIMITS.update(saved_limits)
+        csutil.http_limiters.pop('demographics', None)
+
+
+def bench_geocode(n_rows=300, n_offline=20000, latency=0.02, max_workers=16):
+    '''
+    Times geocoding a column of zip codes one request per row, as load_demographics
+    used to, against geocode_places cold, warm from the geocode cache and offline
+    from a zip code centroid table in the Census Gazetteer format
+
+    Keyword Arguments:
+    n_rows -- The number of rows to geocode over the network. Default is 300
+    n_offline -- The number of rows to geocode offline. Default is 20000
+    latency -- The simulated network latency per request in seconds. Default is 0.02
+    max_workers -- The max_workers to geocode with. Default is 16
+    '''
+    rnd = random.Random(5)
+    # Rows repeat zip codes, as they do when geocoding venues or multiple metros
+    zips = ['{:05d}'.format(80000 + rnd.randrange(n_rows * 3 // 4)) for _ in range(n_rows)]
+    frame = csutil.pd.DataFrame({'ZipCode': zips})
+    workdir = tempfile.mkdtemp(prefix='capstonebench-')
+    saved = (csutil.CHECKPOINT_FILE, csutil.ZIP_CENTROIDS_FILE, dict(csutil.HTTP_RATE_LIMITS))
+    csutil.CHECKPOINT_FILE = os.path.join(workdir, 'checkpoints.sqlite')
+    csutil.ZIP_CENTROIDS_FILE = os.path.join(workdir, '2020_Gaz_zcta_national.txt')
+    csutil.HTTP_RATE_LIMITS.pop('geocode', None)
+    csutil.http_limiters.pop('geocode', None)
+    server = start_standin(latency=latency)
+    try:
+        start = perf_counter()
+        per_row = frame.apply(lambda row: csutil.pd.Series(csutil.fetch_place_latlon(row['ZipCode'])), axis=1).to_numpy()
+        per_row_time = perf_counter() - start
+        per_row_requests = server.request_count
+        print('geocode: {} rows, one request per row:      {:7.3f}s, {} requests'.format(
+            n_rows, per_row_time, per_row_requests))
+
+        for label in ['cold', 'warm']:
+            start = perf_counter()
+            batch = csutil.geocode_places(zips, max_workers=max_workers)
+            elapsed = perf_counter() - start
+            print('geocode: {} rows, geocode_places {}:       {:7.4f}s, {} requests ({:.0f}x)'.format(
+                n_rows, label, elapsed, server.request_count - per_row_requests, per_row_time / elapsed))
+            if not csutil.np.array_equal(batch, per_row):
+                raise AssertionError('geocode_places disagrees with per row geocoding')
+            per_row_requests = server.request_count
+        
+        # A fresh process only has the persistent cache, not the in-memory copy
+        csutil.place_latlons = None
+        start = perf_counter()
+        csutil.get_place_latlon('Denver, CO, USA')
+        first = perf_counter() - start
+        csutil.place_latlons = None
+        start = perf_counter()
+        csutil.get_place_latlon('  denver, co,  USA')
+        print('geocode: get_place_latlon first call {:.3f}s, next run {:.4f}s from the cache'.format(
+            first, perf_counter() - start))
+
+        # Write a Gazetteer style table with more zip codes than are looked up
+        table_zips = ['{:05d}'.format(10000 + i) for i in range(33000)]
+        with open(csutil.ZIP_CENTROIDS_FILE, 'w') as f:
+            f.write('GEOID\tALAND\tAWATER\tALAND_SQMI\tAWATER_SQMI\tINTPTLAT\tINTPTLONG                                                                                                               \n')
+            for z in table_zips:
+                lat, lng = synthetic_latlon(z)
+                f.write('{}\t1000\t0\t0.1\t0.0\t{}\t{}\n'.format(z, lat, lng))
+        offline_zips = [table_zips[rnd.randrange(len(table_zips))] for _ in range(n_offline)]
+        requests_before = server.request_count
+        start = perf_counter()
+        csutil.load_zip_centroids()
+        loaded = perf_counter() - start
+        start = perf_counter()
+        offline = csutil.geocode_places(offline_zips, offline=True)
+        elapsed = perf_counter() - start
+        expected = csutil.np.array([synthetic_latlon(z) for z in offline_zips])
+        if not csutil.np.allclose(offline, expected) or server.request_count != requests_before:
+            raise AssertionError('Offline geocoding returned wrong values or used the network')
+        print('geocode: {} rows offline from a {} zip table: {:7.3f}s (+{:.3f}s to load the table), 0 requests'.format(
+            n_offline, len(table_zips), elapsed, loaded))
+    finally:
+        stop_standin(server)
+        csutil.CHECKPOINT_FILE, csutil.ZIP_CENTROIDS_FILE = saved[0], saved[1]
+        csutil.HTTP_RATE_LIMITS.update(saved[2])
+        csutil.http_limiters.pop('geocode', None)
+        csutil.place_latlons = None
+        csutil.zip_centroids = None
+
+
+def bench_static_map(n_markers=85, n_maps=10, size=(1024, 768)):
+    '''
+    Times drawing marker maps like den_map.png and cluster_map.png with
+    render_static_map, with and without tiles from the stand-in, and checks that
+    each marker is drawn where Leaflet would put it. The browser based renderer
+    can't be timed without Firefox, which it used to take at least the 3 second
+    sleep per map to capture
+
+    Keyword Arguments:
+    n_markers -- The number of circle markers on each map. Default is 85
+    n_maps -- The number of maps to draw. Default is 10
+    size -- The (width, height) of the images. Default is (1024, 768)
+    '''
+    try:
+        import folium
+    except ImportError:
+        print('static map: folium is not installed, skipping')
+        return
+    from PIL import Image
+    rnd = random.Random(3)
+    tab10 = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+    maps = []
+    for m in range(n_maps):
+        fmap = folium.Map(location=[39.7392, -104.9903], zoom_start=10)
+        for i in range(n_markers):
+            lat, lng = 39.55 + rnd.random() * 0.4, -105.25 + rnd.random() * 0.5
+            color = tab10[i % len(tab10)] if m % 2 else 'royalblue'
+            folium.CircleMarker([lat, lng], radius=5, popup=folium.Popup(str(i)), color=color, weight=2,
+                                fill=True, fill_color=color, fill_opacity=0.67).add_to(fmap)
+        maps.append(fmap)
+
+    workdir = tempfile.mkdtemp(prefix='capstonebench-')
+    start = perf_counter()
+    for m, fmap in enumerate(maps):
+        csutil.render_static_map(fmap, os.path.join(workdir, 'map{}.png'.format(m)), size=size)
+    elapsed = perf_counter() - start
+    print('static map: {} maps of {} markers: {:.3f}s ({:.0f} ms/map)'.format(
+        n_maps, n_markers, elapsed, 1000 * elapsed / n_maps))
+
+    # The center of each marker is inside its fill, so it should take the fill color
+    # blended over the background
+    img = Image.open(os.path.join(workdir, 'map1.png')).convert('RGB')
+    x, y = csutil.mercator_pixels([maps[1].location[0]], [maps[1].location[1]], 10)
+    left, top = x[0] - size[0] / 2, y[0] - size[1] / 2
+    for layer in list(maps[1]._children.values())[-5:]:
+        mx, my = csutil.mercator_pixels([layer.location[0]], [layer.location[1]], 10)
+        pixel = img.getpixel((int(mx[0] - left), int(my[0] - top)))
+        if pixel == (0xe8, 0xe8, 0xe8):
+            raise AssertionError('Marker at {} was not drawn'.format(layer.location))
+
+    # Tiles come from the stand-in, with the same latency for each
+    buf = csutil.io.BytesIO()
+    Image.new('RGB', (256, 256), '#d0e0c8').save(buf, 'PNG')
+    server = start_standin(latency=0.02)
+    server.tile_png = buf.getvalue()
+    try:
+        tiled = folium.Map(location=[39.7392, -104.9903], zoom_start=10,
+                           tiles=server.base_url + '/tiles/{z}/{x}/{y}.png', attr='stand-in')
+        for layer in list(maps[0]._children.values()):
+            if type(layer).__name__ == 'CircleMarker':
+                tiled.add_child(layer)
+        start = perf_counter()
+        csutil.render_static_map(tiled, os.path.join(workdir, 'tiled.png'), size=size, tiles=True)
+        print('static map: with {} tiles from the stand-in: {:.3f}s'.format(server.request_count, perf_counter() - start))
+    finally:
+        stop_standin(server)
+
+
+def synthetic_venue_names(n, n_franchises=300, n_independent=200000, seed=0):
+    '''
+    Returns a list of franchise names and a Series of n venue names drawn from them,
+    including the variants Foursquare returns like 'Starbucks Reserve', store
+    numbers and locations in parentheses, and a larger pool of independent shops
+
+    Keyword Arguments:
+    n -- The number of venue names
+    n_franchises -- The number of franchise names. Default is 300
+    n_independent -- The number of distinct independent shop names. Default is 200000
+    seed -- The random seed. Default is 0
+    '''
+    rnd = csutil.np.random.default_rng(seed)
+    words = ['Bean', 'Brew', 'Roast', 'Cup', 'Grind', 'Daily', 'Mile', 'High', 'Java', 'Drip', 'Press', 'Mocha',
+             'Alpine', 'Summit', 'Corner', 'Union', 'Cherry', 'Creek', 'Larimer', 'Pearl']
+    franchises = ['Starbucks', "Dunkin' Donuts", "Peet's Coffee", 'Caribou Coffee', 'Tim Hortons'] + [
+        '{} {} Coffee'.format(words[i % 20], words[(i // 20) % 20]) + (' Co' if i >= 400 else '') for i in range(n_franchises - 5)]
+    variants = ['{}', '{} Reserve', '{} ({})', '{} #{}', '{}']
+    pool = []
+    for i, name in enumerate(franchises):
+        for j, v in enumerate(variants):
+            pool.append(v.format(name, 'Store {}'.format(i * 7 + j)))
+    pool.append("Dunkin'Donuts")
+    independents = ['{} {} Cafe {}'.format(words[i % 20], words[(i * 7) % 20], i) for i in range(n_independent)]
+    names = csutil.np.where(rnd.random(n) < 0.4, csutil.np.array(pool, dtype=object)[rnd.integers(0, len(pool), n)],
+                            csutil.np.array(independents, dtype=object)[rnd.integers(0, n_independent, n)])
+    return franchises, csutil.pd.Series(names, dtype=object, name='Venue')
+
+
+def bench_franchise(n=1000000, n_rowwise=50000):
+    '''
+    Times flagging franchises in n venue names with FranchiseMatcher against the
+    row-wise is_franchise apply, which is timed on the first n_rowwise names and
+    scaled up because it takes minutes at n. Checks that the default matcher
+    flags the same venues as is_franchise, and counts the matches that prefix,
+    loose and fuzzy matching add
+
+    Keyword Arguments:
+    n -- The number of venue names. Default is 1000000
+    n_rowwise -- The number of names to time the row-wise apply on. Default is 50000
+    '''
+    franchises, names = synthetic_venue_names(n)
+    frame = csutil.pd.DataFrame({'Venue': names[:n_rowwise]})
+    fr_vals = csutil.pd.Series(franchises).values
+    start = perf_counter()
+    old = frame.apply(lambda row: csutil.pd.Series(csutil.is_franchise(row, fr_vals)), axis=1)[0]
+    rowwise = (perf_counter() - start) * n / n_rowwise
+    print('franchise: {} names, row-wise is_franchise:   {:8.2f}s (scaled from {})'.format(n, rowwise, n_rowwise))
+
+    start = perf_counter()
+    matcher = csutil.FranchiseMatcher(franchises)
+    matched = matcher.match(names)
+    elapsed = perf_counter() - start
+    print('franchise: {} names, FranchiseMatcher:        {:8.2f}s ({:.0f}x), {} distinct names, dtype {}'.format(
+        n, elapsed, rowwise / elapsed, names.nunique(), matched.dtype))
+    old = (old == 'True').to_numpy()
+    new = matched[:n_rowwise].to_numpy()
+    if (old != new).any():
+        raise AssertionError('FranchiseMatcher flagged {} venues differently from is_franchise'.format((old != new).sum()))
+    prefix = csutil.FranchiseMatcher(franchises, prefix=True).match(names[:n_rowwise])
+    loose = csutil.FranchiseMatcher(franchises, loose=True).match(names[:n_rowwise])
+    print('franchise: is_franchise flagged {} of {}, the matcher {}, with prefix=True {}, with loose=True {}'.format(
+        old.sum(), n_rowwise, new.sum(), prefix.sum(), loose.sum()))
+
+    start = perf_counter()
+    fuzzy = csutil.FranchiseMatcher(franchises, fuzzy=0.9).match(names[:n_rowwise])
+    print('franchise: {} names with fuzzy=0.9:            {:8.2f}s, {} flagged'.format(
+        n_rowwise, perf_counter() - start, fuzzy.sum()))
+
+
+def coffee_pivot_original(candidate_shops):
+    '''
+    The margins pivot table and row-wise PctInd that load_coffee_shops used to
+    build, kept here as the baseline to compare with
+
+    Keyword Arguments:
+    candidate_shops -- Dataframe of coffee shops with ZipCode, Venue and IsFranchise
+    '''
+    candidate_shops = candidate_shops.assign(IsFranchise=candidate_shops['IsFranchise'].astype(str))
+    grouped_shops = candidate_shops.groupby(['ZipCode','IsFranchise'], as_index=False)['Venue'].count()
+    results = csutil.pd.pivot_table(grouped_shops, index='ZipCode', columns='IsFranchise', values='Venue', aggfunc='sum', margins=True, fill_value=0)
+    results.reset_index(inplace=True)
+    results = results[:-1]
+    results[['PctInd']] = results.apply(lambda row: csutil.pd.Series(row['False'] / row['All']), axis=1)
+    return results
+
+
+def bench_coffee_pivot(sizes=((10, 1000), (1000, 100000), (40000, 1000000))):
+    '''
+    Times the original pivot table and PctInd against count_coffee_shops for
+    candidate sets from a few zip codes up to nationwide, checking the legacy
+    schema matches the original
+
+    Keyword Arguments:
+    sizes -- A sequence of (zip codes, coffee shops) to time. Default goes from
+             (10, 1000) to a nationwide (40000, 1000000)
+    '''
+    rnd = csutil.np.random.default_rng(7)
+    for n_zips, n_shops in sizes:
+        shops = csutil.pd.DataFrame({
+            'ZipCode': csutil.np.array(['{:05d}'.format(z) for z in range(10000, 10000 + n_zips)],
+                                       dtype=object)[rnd.integers(0, n_zips, n_shops)],
+            'Venue': 'Shop',
+            'IsFranchise': rnd.random(n_shops) < 0.45})
+        start = perf_counter()
+        original = coffee_pivot_original(shops)
+        original_time = perf_counter() - start
+        start = perf_counter()
+        counted = csutil.count_coffee_shops(shops, legacy=True)
+        elapsed = perf_counter() - start
+        csutil.pd.testing.assert_frame_equal(original, counted, check_dtype=False)
+        print('coffee pivot: {:>5} zips, {:>7} shops: original {:7.3f}s, count_coffee_shops {:6.3f}s ({:.0f}x)'.format(
+            n_zips, n_shops, original_time, elapsed, original_time / elapsed))
+
+
+def bench_spatial_index(n_venues=2000000, n_queries=10000, radius=500, k=10, n_added=1000):
+    '''
+    Times building a VenueIndex over millions of venues spread across the Denver
+    metro area, then single and batched radius, nearest neighbor and density
+    queries against a full scan, and adding a batch of venues against rebuilding
+
+    Keyword Arguments:
+    n_venues -- The number of venues in the index. Default is 2000000
+    n_queries -- The number of points in the batched queries. Default is 10000
+    radius -- The query radius in meters. Default is 500
+    k -- The number of nearest neighbors to find. Default is 10
+    n_added -- The number of venues to add incrementally. Default is 1000
+    '''
+    np = csutil.np
+    rnd = np.random.default_rng(11)
+    def venues(n):
+        return csutil.pd.DataFrame({'Venue ID': rnd.integers(0, 1 << 40, n),
+                                    'Venue Latitude': 39.5 + rnd.random(n) * 0.5,
+                                    'Venue Longitude': -105.3 + rnd.random(n) * 0.6})
+    frame = venues(n_venues)
+    start = perf_counter()
+    index = csutil.VenueIndex(frame)
+    print('spatial index: built over {} venues in {:.2f}s'.format(n_venues, perf_counter() - start))
+
+    lat, lon = 39.7392, -104.9903
+    coords = np.radians(frame[['Venue Latitude', 'Venue Longitude']].to_numpy())
+    start = perf_counter()
+    a = np.sin((coords[:, 0] - np.radians(lat)) / 2) ** 2 + np.cos(np.radians(lat)) * np.cos(coords[:, 0]) * \
+        np.sin((coords[:, 1] - np.radians(lon)) / 2) ** 2
+    dist = 2 * csutil.EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+    within = np.flatnonzero(dist <= radius)
+    scan = perf_counter() - start
+
+    def per_query(func, repeat=200):
+        start = perf_counter()
+        for _ in range(repeat):
+            result = func()
+        return result, (perf_counter() - start) / repeat * 1000
+
+    found, radius_ms = per_query(lambda: index.query_radius(lat, lon, radius)[0])
+    (_, nearest), knn_ms = per_query(lambda: index.query_knn(lat, lon, k))
+    count, count_ms = per_query(lambda: index.count_within(lat, lon, radius)[0])
+    if set(found) != set(within) or count != len(within) or set(nearest[0]) != set(np.argsort(dist)[:k]):
+        raise AssertionError('VenueIndex disagrees with a full scan')
+    print('spatial index: one point, full scan {:.1f} ms; radius {:.3f} ms ({} venues), kNN k={} {:.3f} ms, count {:.3f} ms'.format(
+        scan * 1000, radius_ms, len(found), k, knn_ms, count_ms))
+
+    lats, lons = 39.55 + rnd.random(n_queries) * 0.4, -105.25 + rnd.random(n_queries) * 0.5
+    for label, func in [('radius', lambda: index.query_radius(lats, lons, radius)),
+                        ('kNN', lambda: index.query_knn(lats, lons, k)),
+                        ('density', lambda: index.density(lats, lons, radius))]:
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        print('spatial index: batched {:<7} {} points: {:.3f}s ({:.3f} ms per point)'.format(
+            label, n_queries, elapsed, elapsed / n_queries * 1000))
+
+    added = venues(n_added)
+    start = perf_counter()
+    index.add(added)
+    add_time = perf_counter() - start
+    start = perf_counter()
+    csutil.VenueIndex(csutil.pd.concat([frame, added], ignore_index=True))
+    print('spatial index: adding {} venues {:.3f}s, rebuilding from scratch {:.2f}s'.format(
+        n_added, add_time, perf_counter() - start))
+    if set(index.query_radius(lat, lon, radius)[0]) != set(csutil.VenueIndex(index.venues).query_radius(lat, lon, radius)[0]):
+        raise AssertionError('Incrementally added venues are missing from queries')
+
+
+def bench_tiled_explore(half_size=1500, latency=0.02, max_workers=8):
+    '''
+    Explores zip code centroids of different venue densities in a synthetic world
+    with a single explore request each, with explore_tiled, and with a uniform grid
+    of tiles as fine as the deepest one explore_tiled needed. Checks explore_tiled
+    finds every venue in each area
+
+    Keyword Arguments:
+    half_size -- Half the width in meters of the square explored around each
+                 centroid. Default is 1500
+    latency -- The simulated network latency per request in seconds. Default is 0.02
+    max_workers -- The max_workers for explore_tiled. Default is 8
+    '''
+    np = csutil.np
+    centroids = [('downtown', 39.7508, -104.9966), ('midtown', 39.7200, -104.9500),
+                 ('suburb', 39.6100, -105.0200), ('rural', 39.9000, -105.2000)]
+    world = synthetic_world([(39.7508, -104.9966, 6000, 700), (39.7200, -104.9500, 900, 1200),
+                             (39.6100, -105.0200, 150, 1500)], background=400, seed=4)
+    server = start_standin(latency=latency, world=world)
+    try:
+        for name, lat, lng in centroids:
+            within, dist = world_venues_within(world, lat, lng, half_size * np.sqrt(2))
+            m_lon = csutil.METERS_PER_DEGREE * np.cos(np.radians(lat))
+            in_square = set(world['id'][(np.abs(world['lat'] - lat) * csutil.METERS_PER_DEGREE <= half_size) &
+                                        (np.abs(world['lng'] - lng) * m_lon <= half_size)])
+
+            single = csutil.explore_location(lat, lng, radius=half_size * np.sqrt(2))
+            single_found = {i['venue']['id'] for i in single['response']['groups'][0]['items']} & in_square
+
+            before = server.request_count
+            start = perf_counter()
+            tiled = csutil.explore_tiled(lat, lng, half_size, max_workers=max_workers)
+            elapsed = perf_counter() - start
+            tiled_requests = server.request_count - before
+            tiled_found = {i['venue']['id'] for i in tiled['response']['groups'][0]['items']}
+            if tiled_found != in_square:
+                raise AssertionError('explore_tiled missed {} venues around {}'.format(len(in_square - tiled_found), name))
+
+            # A uniform grid would need tiles as small as the deepest explore_tiled used
+            depth = tiled['meta']['depth']
+            print('tiled explore: {:<8} {:>5} venues: single request found {:>4}; tiled found {:>5} with {:>3} requests '
+                  'in {:.2f}s (uniform grid at depth {}: {} requests)'.format(
+                      name, len(in_square), len(single_found), len(tiled_found), tiled_requests, elapsed,
+                      depth, 4 ** depth))
+    finally:
+        stop_standin(server)
+
+
+COMPACT_WRITE_SCRIPT = '''
+import numpy as np, pandas as pd
+import capstonebench, capstoneutils as csutil
+n = {}
+rnd = np.random.default_rng(0)
+zips = ['{{:05d}}'.format(80000 + i) for i in range(2000)]
+cats = ['Category {{}}'.format(i) for i in range(400)]
+tops = ['Top {{}}'.format(i) for i in range(10)]
+names = ['Venue name {{}}'.format(i) for i in range(n // 3)]
+def strings(values):
+    # Each row gets its own string object, as it does when parsed from json
+    return np.array([values[i][:1] + values[i][1:] for i in rnd.integers(0, len(values), n)], dtype=object)
+lats, lngs = 39.5 + rnd.random(n), -105.3 + rnd.random(n)
+df = pd.DataFrame({{'ZipCode': strings(zips), 'Centroid Latitude': lats, 'Centroid Longitude': lngs,
+                   'Venue': strings(names), 'Venue Latitude': lats, 'Venue Longitude': lngs,
+                   'Venue Main Category': strings(cats), 'Venue Top-Level Category': strings(tops)}})
+df = df.astype({{c: object for c in ['ZipCode', 'Venue', 'Venue Main Category', 'Venue Top-Level Category']}})
+df.to_pickle({!r})
+csutil.DATA_DIR = {!r}
+csutil.write_dataset(csutil.compact_venues(df), 'fsq_venues')
+'''
+
+COMPACT_LOAD_SCRIPT = '''
+import gc
+import pandas as pd
+import capstonebench, capstoneutils as csutil
+def rss_mb():
+    return [int(l.split()[1]) for l in open('/proc/self/status') if l.startswith('VmRSS')][0] / 1024
+csutil.DATA_DIR = {!r}
+gc.collect()
+base = rss_mb()
+{}
+gc.collect()
+print(rss_mb() - base, df.memory_usage(deep=True).sum() / 2 ** 20)
+'''
+
+
+def bench_compact_memory(n_venues=3000000):
+    '''
+    Measures the memory held by a venue frame of n_venues once it is loaded: with
+    one Python string per row, as get_nearby_venues used to build and store it,
+    converted to the compact VENUE_DTYPES from that old pickle, and loaded from a
+    compact Parquet store. Each is loaded in a fresh process and the growth in
+    resident memory is read from /proc, so this benchmark only runs on Linux
+
+    Keyword Arguments:
+    n_venues -- The number of venues in the frame. Default is 3000000
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='capstonebench-')
+    here = os.path.dirname(os.path.abspath(__file__))
+    pkl = os.path.join(tmpdir, 'object', 'fsq_venues.pkl')
+    os.makedirs(os.path.dirname(pkl))
+    subprocess.run([sys.executable, '-c', COMPACT_WRITE_SCRIPT.format(n_venues, pkl, tmpdir)], check=True, cwd=here)
+    baseline = None
+    for label, data_dir, code in [
+            ('object strings', os.path.dirname(pkl), 'df = pd.read_pickle({!r})'.format(pkl)),
+            ('compacted from pickle', os.path.dirname(pkl), 'df = csutil.load_foursquare_venues([], [], [])'),
+            ('compact parquet', tmpdir, 'df = csutil.load_foursquare_venues([], [], [])')]:
+        out = subprocess.run([sys.executable, '-c', COMPACT_LOAD_SCRIPT.format(data_dir, code)], capture_output=True,
+                             text=True, check=True, cwd=here).stdout.split()
+        rss, frame = float(out[0]), float(out[1])
+        baseline = baseline or rss
+        print('compact memory: {} venues, {:<22} RSS +{:7.1f}MB, frame {:7.1f}MB ({:.1f}x lower RSS)'.format(
+            n_venues, label, rss, frame, baseline / rss))
+    for root, _, files in os.walk(tmpdir, topdown=False):
+        for f in files:
+            os.remove(os.path.join(root, f))
+        os.rmdir(root)
+
+    demog = csutil.pd.read_pickle(os.path.join(here, 'all_demog.pkl'))
+    before = demog.memory_usage(deep=True).sum()
+    after = csutil.compact_demographics(demog.copy()).memory_usage(deep=True).sum()
+    print('compact memory: stored demographics {:.1f}KB -> {:.1f}KB'.format(before / 1024, after / 1024))
+
+
+# The libraries capstoneutils used to import when it was loaded
+EAGER_IMPORTS = ['requests', 'bs4', 'lxml.html', 'fastnumbers', 'anytree', 'selenium.webdriver',
+                 'selenium.webdriver.support.ui', 'PIL.Image', 'pyarrow.parquet']
+
+def import_time(code):
+    '''
+    Runs the code in a fresh interpreter with -X importtime and returns the total
+    import time in milliseconds, the sum of the cumulative times of the top-level
+    imports
+
+    Keyword Arguments:
+    code -- The Python code to run
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                         check=True, cwd=here).stderr
+    total = 0
+    for line in err.splitlines():
+        fields = line.split('|')
+        # Nested imports are indented under the import that triggered them
+        if len(fields) == 3 and fields[1].strip().isdigit() and not fields[2].startswith('  '):
+            total += int(fields[1])
+    return total / 1000
+
+def bench_import_time(runs=7):
+    '''
+    Measures how long a fresh process takes to import capstoneutils, the cost paid
+    by every worker process, with -X importtime. The module on its own is compared
+    with also importing the libraries it used to load eagerly, which is what
+    loading it used to cost. The median of runs is reported
+
+    Keyword Arguments:
+    runs -- The number of fresh processes to time each way. Default is 7
+    '''
+    lazy = 'import capstoneutils'
+    eager = 'import {}; import capstoneutils'.format(', '.join(EAGER_IMPORTS))
+    for label, code in [('eager dependencies', eager), ('lazy dependencies', lazy)]:
+        times = sorted(import_time(code) for _ in range(runs))
+        print('import time: {:<18} {:6.1f}ms'.format(label, times[runs // 2]))
+    
+    # Loading it shouldn't need any optional dependency or credentials, and
+    # shouldn't write anything, so it is loaded once more in an empty directory
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmpdir = tempfile.mkdtemp(prefix='capstonebench-')
+    check = 'import sys, capstoneutils; print([m for m in {!r} if m in sys.modules])'.format(EAGER_IMPORTS + ['redacted'])
+    env = dict(os.environ, PYTHONPATH=here)
+    loaded = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, check=True, cwd=tmpdir,
+                            env=env).stdout.strip()
+    print('import time: modules loaded on import {}, files written {}'.format(loaded, os.listdir(tmpdir)))
+    os.rmdir(tmpdir)
+
+def reset_peak_rss():
+    '''
+    Resets the peak resident memory of this process, which Linux allows through
+    /proc/self/clear_refs, and returns the current resident memory in MB. If it
+    can't be reset the peaks reported afterwards are for the whole process
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    return [int(l.split()[1]) for l in open('/proc/self/status') if l.startswith('VmRSS')][0] / 1024
+
+def peak_rss():
+    '''
+    Returns the peak resident memory of this process in MB since reset_peak_rss
+    '''
+    return [int(l.split()[1]) for l in open('/proc/self/status') if l.startswith('VmHWM')][0] / 1024
+
+
+@contextlib.contextmanager
+def pipeline_environment():
+    '''
+    Context manager for running the pipeline in a temporary directory with the
+    client side rate limits lifted and a short retry backoff, restoring the
+    settings afterwards. Yields the temporary directory
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='capstonebench-')
+    saved = (csutil.DATA_DIR, csutil.CHECKPOINT_FILE, dict(csutil.HTTP_RATE_LIMITS), csutil.HTTP_BACKOFF_BASE)
+    csutil.HTTP_RATE_LIMITS.clear()
+    csutil.http_limiters.clear()
+    csutil.HTTP_BACKOFF_BASE = 0.05
+    try:
+        yield tmpdir
+    finally:
+        csutil.DATA_DIR, csutil.CHECKPOINT_FILE = saved[0], saved[1]
+        csutil.HTTP_RATE_LIMITS.update(saved[2])
+        csutil.http_limiters.clear()
+        csutil.HTTP_BACKOFF_BASE = saved[3]
+        csutil.place_latlons = None
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run_pipeline(server, workdir, max_workers=8):
+    '''
+    Runs the notebook pipeline, load_demographics, load_foursquare_venues,
+    get_top_venues and load_coffee_shops, with its datasets and checkpoints in
+    workdir. Returns the result of each stage and a list with a tuple for each
+    stage of (stage, seconds, requests reaching the server, retries, peak memory
+    growth in MB, rows)
+
+    Keyword Arguments:
+    server -- The stand-in server the library is pointed at
+    workdir -- The directory for the stored datasets and checkpoints
+    max_workers -- The max_workers for each loader. Default is 8
+    '''
+    os.makedirs(workdir, exist_ok=True)
+    csutil.DATA_DIR = workdir
+    csutil.CHECKPOINT_FILE = os.path.join(workdir, 'checkpoints.sqlite')
+    csutil.place_latlons = None
+    csutil.clear_fallback_demographics()
+    results = {}
+    def places():
+        demog = results['load_demographics']
+        return demog['ZipCode'], demog['Latitude'], demog['Longitude']
+    stages = [
+        ('load_demographics', lambda: csutil.load_demographics(max_workers=max_workers)),
+        ('load_foursquare_venues', lambda: csutil.load_foursquare_venues(*places(), max_workers=max_workers)),
+        ('get_top_venues', lambda: csutil.get_top_venues(results['load_foursquare_venues'])),
+        ('load_coffee_shops', lambda: csutil.load_coffee_shops(*places(), max_workers=max_workers)),
+    ]
+    timings = []
+    for stage, func in stages:
+        gc.collect()
+        base = reset_peak_rss()
+        requests_before, retries_before = server.request_count, csutil.http_counters['retries']
+        start = perf_counter()
+        results[stage] = func()
+        elapsed = perf_counter() - start
+        timings.append((stage, elapsed, server.request_count - requests_before,
+                        csutil.http_counters['retries'] - retries_before, peak_rss() - base, len(results[stage])))
+    return results, timings
+
+
+def bench_pipeline(fixture_path=None, latency=0.02, error_rate=0.05, max_workers=8, zips_per_county=20):
+    '''
+    Times the whole pipeline from load_demographics to load_coffee_shops against
+    the stand-in replaying recorded responses, reporting the wall time, requests,
+    retries and peak memory of each stage. It is run twice: built from the network
+    with an empty response cache, then again from the datasets that run stored.
+    The client side rate limits are lifted, so the times are for the library and
+    the simulated network only.
+
+    Without a fixture file the responses are first recorded from the synthetic
+    stand-in, and the replayed run is checked against the recorded one. Use
+    export_fixtures to record real responses instead
+
+    Keyword Arguments:
+    fixture_path -- A fixture file written by export_fixtures, or None to record
+                    synthetic responses. Default is None
+    latency -- The simulated network latency per request in seconds. Default is 0.02
+    error_rate -- The fraction of replayed requests that fail with a 429 or 503
+                  and are retried. Default is 0.05
+    max_workers -- The max_workers for each loader. Default is 8
+    zips_per_county -- The zip codes on each synthetic county page. Default is 20
+    '''
+    recorded = None
+    with pipeline_environment() as tmpdir:
+        if fixture_path is None:
+            fixture_path = os.path.join(tmpdir, 'fixtures.json.gz')
+            server = start_standin(latency=0, cache_path=os.path.join(tmpdir, 'record.sqlite'),
+                                   zips_per_county=zips_per_county)
+            try:
+                recorded, _ = run_pipeline(server, os.path.join(tmpdir, 'record'), max_workers)
+            finally:
+                stop_standin(server)
+            count = export_fixtures(os.path.join(tmpdir, 'record.sqlite'), fixture_path)
+            print('pipeline: recorded {} responses ({:.1f}MB gzipped)'.format(count, os.path.getsize(fixture_path) / 2**20))
+        
+        server = start_standin(latency=latency, error_rate=error_rate, fixtures=load_fixtures(fixture_path),
+                               cache_path=os.path.join(tmpdir, 'replay.sqlite'))
+        try:
+            for label in ['network', 'stored']:
+                results, timings = run_pipeline(server, os.path.join(tmpdir, 'replay'), max_workers)
+                for stage, elapsed, count, retries, peak, rows in timings:
+                    print('pipeline: {:<7} {:<22} {:7.3f}s, {:4} requests, {:3} retries, peak +{:6.1f}MB, {:6} rows'.format(
+                        label, stage, elapsed, count, retries, peak, rows))
+                print('pipeline: {:<7} {:<22} {:7.3f}s'.format(label, 'total', sum(t[1] for t in timings)))
+        finally:
+            stop_standin(server)
+        
+        if recorded is not None:
+            for stage in ['get_top_venues', 'load_coffee_shops']:
+                if not recorded[stage].equals(results[stage]):
+                    raise AssertionError('The replayed {} differs from the recorded one'.format(stage))
+            print('pipeline: replayed results match the recorded run')
+
+
+def bench_metrics(calls=1000000, latency=0.005, error_rate=0.05, max_workers=8):
+    '''
+    Measures the cost of the instrumented decorator per call with metrics off and
+    on, against calling the function directly, then runs the pipeline against
+    the synthetic stand-in with metrics on and summarizes what was collected
+
+    Keyword Arguments:
+    calls -- The number of calls to time the decorator with. Default is 1000000
+    latency -- The simulated network latency per request in seconds. Default is 0.005
+    error_rate -- The fraction of requests that fail and are retried. Default is 0.05
+    max_workers -- The max_workers for each loader. Default is 8
+    '''
+    def noop(x):
+        return x
+    wrapped = csutil.instrumented()(noop)
+    saved = csutil.get_metrics()
+    try:
+        timings = {}
+        for label, func, enabled in [('direct', noop, False), ('metrics off', wrapped, False),
+                                     ('metrics on', wrapped, True)]:
+            csutil.configure_metrics(enabled)
+            start = perf_counter()
+            for i in range(calls):
+                func(i)
+            timings[label] = (perf_counter() - start) / calls * 1e9
+        print('metrics: {:.0f}ns per direct call, +{:.0f}ns with metrics off, +{:.0f}ns with metrics on'.format(
+            timings['direct'], timings['metrics off'] - timings['direct'], timings['metrics on'] - timings['direct']))
+        
+        m = csutil.configure_metrics()
+        with pipeline_environment() as tmpdir:
+            server = start_standin(latency=latency, error_rate=error_rate, cache_path=os.path.join(tmpdir, 'cache.sqlite'))
+            try:
+                run_pipeline(server, os.path.join(tmpdir, 'run'), max_workers)
+            finally:
+                stop_standin(server)
+        snapshot = m.snapshot()
+        if csutil.json.loads(m.to_json()) != csutil.json.loads(csutil.json.dumps(snapshot)):
+            raise AssertionError('The JSON export differs from the snapshot')
+        
+        rows = {s['labels']['function']: s['value'] for s in snapshot['counters']['rows_total']}
+        for s in snapshot['histograms']['call_seconds']:
+            name = s['labels']['function']
+            print('metrics: {:<24} {:5} calls, {:8.3f}s total, {:7} rows'.format(name, s['count'], s['sum'], rows.get(name, 0)))
+        counters = {(name, s['labels'].get('endpoint')): s['value'] for name, samples in snapshot['counters'].items()
+                    for s in samples}
+        for s in snapshot['histograms']['http_request_seconds']:
+            endpoint = s['labels']['endpoint']
+            print('metrics: {:<12} {:4} requests, {:6.1f}ms mean, {:7.1f}KB, {:3} retries, {:4} cache misses'.format(
+                endpoint, s['count'], s['sum'] / s['count'] * 1000,
+                counters.get(('http_response_bytes_total', endpoint), 0) / 1024,
+                counters.get(('http_retries_total', endpoint), 0), counters.get(('cache_misses_total', endpoint), 0)))
+        text = m.to_prometheus()
+        print('metrics: Prometheus export has {} samples, e.g. {}'.format(
+            sum(1 for line in text.splitlines() if not line.startswith('#')),
+            next(line for line in text.splitlines() if line.startswith('capstone_http_retries_total'))))
+    finally:
+        csutil.metrics = saved
+
+
+STREAM_SCRIPT = '''
+import time
+import capstonebench as bench, capstoneutils as csutil
+csutil.DATA_DIR = {!r}
+names, lats, lngs = bench.synthetic_centroids({})
+server = bench.start_standin(latency=0)
+base = bench.reset_peak_rss()
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start, bench.peak_rss() - base, rows)
+bench.stop_standin(server)
+'''
+
+def bench_streaming(n_zips=4000, max_workers=8):
+    '''
+    Compares the peak memory of exploring n_zips zip codes of 100 venues each
+    with get_nearby_venues and storing the frame, against streaming them into the
+    store with store_nearby_venues, each in a fresh process against the stand-in,
+    and checks that both store the same dataset. Peak memory is read from /proc,
+    so this benchmark only runs on Linux
+
+    Keyword Arguments:
+    n_zips -- The number of zip codes to explore. Default is 4000
+    max_workers -- The max_workers for the explore requests. Default is 8
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmpdir = tempfile.mkdtemp(prefix='capstonebench-')
+    runs = [('get_nearby_venues', 'df = csutil.get_nearby_venues(names, lats, lngs, max_workers={0}); '
+                                  'csutil.write_dataset(df, "fsq_venues"); rows = len(df)'),
+            ('store_nearby_venues', 'rows = csutil.store_nearby_venues(names, lats, lngs, max_workers={0})')]
+    try:
+        stored = []
+        for label, code in runs:
+            data_dir = os.path.join(tmpdir, label)
+            os.makedirs(data_dir)
+            out = subprocess.run([sys.executable, '-c', STREAM_SCRIPT.format(data_dir, n_zips, code.format(max_workers))],
+                                 capture_output=True, text=True, check=True, cwd=here).stdout.split()
+            print('streaming: {} zips, {:<20} {:6.2f}s, peak +{:7.1f}MB, {} venues stored'.format(
+                n_zips, label, float(out[0]), float(out[1]), out[2]))
+            csutil.DATA_DIR = data_dir
+            stored.append(csutil.read_dataset('fsq_venues', dtypes=csutil.VENUE_DTYPES))
+        csutil.pd.testing.assert_frame_equal(stored[0], stored[1], check_column_type=False)
+        print('streaming: both store the same dataset')
+    finally:
+        csutil.DATA_DIR = '.'
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_metros(counts=(1, 2, 4, 8), quota=200, latency=0.05, max_workers=4, counties=3, zips_per_county=20):
+    '''
+    Times run_metros building 1, 2, 4 and 8 synthetic metros at once against the
+    stand-in, with a shared client side quota of quota requests per second for
+    every endpoint, and reports the requests per second each reached. One metro
+    is held back by its own max_workers and the latency, so throughput should
+    grow with the number of metros until it reaches the quota. The largest count
+    is also built one metro at a time for comparison, from a JSON file of the
+    configs, and its partitions are read back as one Hive partitioned Parquet
+    dataset
+
+    Keyword Arguments:
+    counts -- The numbers of metros to build at once. Default is (1, 2, 4, 8)
+    quota -- The requests per second allowed for each endpoint. Default is 200
+    latency -- The simulated network latency per request in seconds. Default is 0.05
+    max_workers -- The max_workers for each metro. Default is 4
+    counties -- The number of county pages of each metro. Default is 3
+    zips_per_county -- The zip codes on each synthetic county page. Default is 20
+    '''
+    metros = {'metro{}'.format(m): {'counties': {'xx-metro{}-county{}'.format(m, c): ['City {}'.format(c)]
+                                                 for c in range(counties)},
+                                    'state': 'somestate', 'fallback_zip': None}
+              for m in range(max(counts))}
+    with pipeline_environment() as tmpdir:
+        server = start_standin(latency=latency, zips_per_county=zips_per_county, metros=metros)
+        for metro, config in metros.items():
+            config['fallback_zip'] = server.county_zips[next(iter(config['counties']))][0][0]
+        config_path = os.path.join(tmpdir, 'metros.json')
+        with open(config_path, 'w') as f:
+            json.dump(metros, f)
+        try:
+            runs = [(n, None) for n in counts] + [(max(counts), 1)]
+            for n, metro_workers in runs:
+                workdir = os.path.join(tmpdir, 'metros{}-{}'.format(n, metro_workers))
+                os.makedirs(workdir)
+                csutil.DATA_DIR = workdir
+                csutil.CHECKPOINT_FILE = os.path.join(workdir, 'checkpoints.sqlite')
+                csutil.place_latlons = None
+                csutil.clear_fallback_demographics()
+                csutil.HTTP_RATE_LIMITS.update({endpoint: (quota, max_workers) for endpoint in
+                                                ['categories', 'zipcodes', 'demographics', 'geocode', 'explore', 'franchises']})
+                csutil.http_limiters.clear()
+                requests_before = server.request_count
+                start = perf_counter()
+                if metro_workers == 1:
+                    configs = config_path
+                else:
+                    configs = {metro: metros[metro] for metro in sorted(metros)[:n]}
+                summary = csutil.run_metros(configs, max_workers=max_workers, metro_workers=metro_workers)
+                elapsed = perf_counter() - start
+                count = server.request_count - requests_before
+                if summary['Error'].notna().any():
+                    raise AssertionError('run_metros failed: {}'.format(summary['Error'].dropna().tolist()))
+                print('metros: {} metros, {:<8} {:6.2f}s, {:5} requests, {:6.1f} requests/s, {:5} zip codes, {:6} venues'.format(
+                    n, 'serial' if metro_workers == 1 else 'parallel', elapsed, count, count / elapsed,
+                    summary['ZipCodes'].sum(), summary['Venues'].sum()))
+
+            # The partitions of the last run read back as one dataset with a metro column
+            venues = csutil.get_parquet().read_table(os.path.join(csutil.DATA_DIR, 'fsq_venues'))
+            per_metro = venues.group_by('metro').aggregate([('ZipCode', 'count')]).to_pandas()
+            if sorted(per_metro['metro']) != sorted(summary['Metro']) or per_metro['ZipCode_count'].sum() != summary['Venues'].sum():
+                raise AssertionError('The stored partitions differ from the metros that were built')
+            print('metros: {} partitions of fsq_venues read back with {} venues'.format(len(per_metro), len(venues)))
+        finally:
+            stop_standin(server)
+
+
+def bench_venue_store(grid=6, spacing=1000, half_size=1000, max_workers=8):
+    '''
+    Explores a grid of zip code centroids in a synthetic world with squares that
+    overlap their neighbors, then explores the coffee section of the same squares,
+    first building frames per zip code with get_nearby_venues and get_coffee_shops,
+    then adding them to a VenueStore. Reports the venues classified and matched
+    against the franchise list, the time spent building from the response cache
+    and the bytes stored each way, and checks both give the same frames
+
+    Keyword Arguments:
+    grid -- The number of centroids along each side of the grid. Default is 6
+    spacing -- The distance between neighboring centroids in meters. Default is 1000
+    half_size -- Half the width in meters of the square explored around each
+                 centroid. Default is 1000
+    max_workers -- The max_workers for the explore requests. Default is 8
+    '''
+    np = csutil.np
+    lat0, lng0 = 39.74, -104.99
+    m_lon = csutil.METERS_PER_DEGREE * np.cos(np.radians(lat0))
+    names = ['{:05d}'.format(80000 + i) for i in range(grid * grid)]
+    lats = [lat0 + (i // grid) * spacing / csutil.METERS_PER_DEGREE for i in range(grid * grid)]
+    lngs = [lng0 + (i % grid) * spacing / m_lon for i in range(grid * grid)]
+    world = synthetic_world([(lat0 + 0.02, lng0 + 0.03, 8000, 2000)], background=2000, seed=7)
+    tmpdir = tempfile.mkdtemp(prefix='capstonebench-')
+    saved_dir = csutil.DATA_DIR
+    server = start_standin(latency=0.002, world=world, cache_path=os.path.join(tmpdir, 'cache.sqlite'))
+    try:
+        csutil.DATA_DIR = tmpdir
+        def build(store=None):
+            venues = csutil.get_nearby_venues(names, lats, lngs, max_workers=max_workers, half_size=half_size,
+                                              store=store)
+            coffee = csutil.get_coffee_shops(names, lats, lngs, max_workers=max_workers, half_size=half_size,
+                                             store=store)
+            return venues, coffee
+        # Fill the response cache so the timed runs only measure the library
+        build()
+
+        start = perf_counter()
+        venues, coffee = build()
+        plain_time = perf_counter() - start
+        csutil.write_dataset(venues, 'fsq_venues')
+        csutil.write_dataset(coffee, 'coffee_shops')
+        plain_bytes = sum(os.path.getsize(csutil.dataset_file(n)) for n in ['fsq_venues', 'coffee_shops'])
+        # The loaders checkpoint a frame per zip code, which is the other way they are stored
+        checkpoints = csutil.CheckpointStore(os.path.join(tmpdir, 'checkpoints.sqlite'))
+        for dataset, df in [('venues', venues), ('coffee', coffee)]:
+            for name, group in df.groupby('ZipCode', sort=False, observed=True):
+                checkpoints.put(dataset, name, group.reset_index(drop=True))
+        checkpoints.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        checkpoint_bytes = os.path.getsize(checkpoints.path)
+
+        store = csutil.VenueStore(os.path.join(tmpdir, 'venues.sqlite'))
+        times = []
+        for _ in range(2):
+            before = dict(store.counters)
+            start = perf_counter()
+            stored_venues, stored_coffee = build(store)
+            times.append((perf_counter() - start, {k: v - before[k] for k, v in store.counters.items()}))
+        if not (stored_venues.equals(venues) and stored_coffee.reset_index(drop=True).equals(coffee.reset_index(drop=True))):
+            raise AssertionError('The venue store frames differ from the ones built per zip code')
+        store.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        store.conn.execute('VACUUM')
+        store_bytes = os.path.getsize(store.path)
+        stats = store.stats()
+
+        print('venue store: {} zip codes, {} venue rows and {} coffee rows for {} distinct venues'.format(
+            len(names), len(venues), len(coffee), stats['venues']))
+        print('venue store: per zip code   {:6.2f}s, {:6} venues classified, {:5} franchise matches, '
+              '{:6.2f}MB checkpoints, {:6.2f}MB Parquet'.format(plain_time, len(venues) + len(coffee), len(coffee),
+                                                                checkpoint_bytes / 2**20, plain_bytes / 2**20))
+        for label, (elapsed, counts) in zip(['store, new', 'store, again'], times):
+            print('venue store: {:<13} {:6.2f}s, {:6} venues classified, {:5} franchise matches, {:6.2f}MB sqlite'.format(
+                label, elapsed, counts['classified'], counts['matched'], store_bytes / 2**20))
+        print('venue store: the stored frames match the per zip code ones')
+    finally:
+        stop_standin(server)
+        csutil.DATA_DIR = saved_dir
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    benches = [bench_explore, bench_venue_frame, bench_categories, bench_cache, bench_cache_store,
+               bench_session, bench_retry, bench_rate_limit, bench_storage,
+               bench_top_venues, bench_diversity, bench_kmeans_sweep, bench_demographics,
+               bench_geocode, bench_static_map, bench_franchise, bench_coffee_pivot,
+               bench_spatial_index, bench_tiled_explore, bench_compact_memory, bench_import_time,
+               bench_pipeline, bench_metrics, bench_streaming, bench_metros, bench_venue_store]
+    # Any benchmarks named on the command line are run on their own, e.g.
+    # python capstonebench.py bench_pipeline
+    selected = sys.argv[1:]
+    for bench in benches:
+        if not selected or bench.__name__ in selected:
+            bench()
@@ -16,22 +16,1300 @@ sources:
 * Simpsons Diversity Index http://www.countrysideinfo.co.uk/simpsons.htm
 * Google Maps API https://developers.google.com/maps/documentation/geocoding/start
 ''' 
-import redacted as rg               # Contains the API keys and secrets, not in source control
-from bs4 import BeautifulSoup       # For parsing HTML responses during scraping
-from fastnumbers import fast_real   # For smart creation of integers or floaats from strings
-import requests                     # For making http requests during scraping
+# Only the libraries used throughout are imported here. The API keys and the
+# heavier libraries that only a few functions need (requests, BeautifulSoup,
+# lxml, fastnumbers, anytree, Selenium, Pillow and pyarrow) are imported by
+# those functions on first use, so loading this module, e.g. in a worker
+# process, stays cheap
 import pandas as pd                 # Dataframes and other list operations
 import numpy as np                  # Various numerical and mathematical utilities
 import os                           # For determining current working directory
-from time import sleep              # To allow for a sleep during retries of http requests
+from time import sleep, time, monotonic, perf_counter  # To allow for a sleep during retries of http requests
+import random                       # Jitter for the backoff between retries
 import pickle                       # Serialization for dataframes to avoid request caps
 import urllib.parse                 # For url-encoding query strings, mostly for Google
-from anytree import Node, search    # Fast tree implementation for Foursquare categories
-from selenium import webdriver      # Used only for saving png versions of Folium maps
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future  # Pools for requests and model fitting
+from multiprocessing import shared_memory  # Sharing feature matrices with worker processes
 import logging                      # For saving output from what I would normally print
+import json                         # For decoding cached API responses
+import sqlite3                      # Storage for the on-disk http response cache
+import zlib                         # Compression of cached response bodies
+import threading                    # Locking shared state used by concurrent requests
+import functools                    # Memoizing scrapes that are repeated
+import io                           # Reading downloaded map tiles
+import bisect                       # Finding the histogram bucket for a latency
+import collections                  # Bounded queue of requests in flight
+import sys                          # Checking the platform before releasing heap memory
+
+# Nothing is logged anywhere until the application asks for it, e.g. with
+# configure_logging, rather than as a side effect of importing this module
+logging.getLogger('capstoneutils').addHandler(logging.NullHandler())
+
+def configure_logging(filename='capstone_util.log', filemode='w', level=logging.DEBUG):
+    '''
+    Sends the log output of this module to a file, which is what importing it used
+    to do. Note that the default file mode truncates the log file
+
+    Keyword Arguments:
+    filename -- The file to log to. Default is 'capstone_util.log'
+    filemode -- The mode to open the file with. Default is 'w'
+    level -- The lowest level to log. Default is logging.DEBUG
+    '''
+    logging.basicConfig(filename=filename, filemode=filemode, level=level)
+
+# The module holding the API keys and secrets, which is not in source control. It
+# is imported when a request first needs a key
+secrets = None
+
+def get_secrets():
+    '''
+    Returns the module holding the API keys and secrets, importing it on first use.
+    Raises ImportError if it isn't available
+    '''
+    global secrets
+    if secrets is None:
+        import redacted
+        secrets = redacted
+    return secrets
+
+@functools.lru_cache(maxsize=None)
+def get_parquet():
+    '''
+    Returns the pyarrow.parquet module, importing it on first use, or None if
+    pyarrow isn't installed, in which case datasets are stored as pickles
+    '''
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+    return pq
+
+@functools.lru_cache(maxsize=None)
+def get_malloc_trim():
+    '''
+    Returns glibc's malloc_trim, loading it on first use, or None on platforms
+    without glibc. It gives freed heap memory back to the operating system, which
+    glibc otherwise keeps for later allocations
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    import ctypes
+    try:
+        return ctypes.CDLL('libc.so.6').malloc_trim
+    except (OSError, AttributeError):
+        return None
+
+# Base urls for the APIs and scraped sites. Kept at module level so they can be
+# pointed at a local stand-in server for benchmarking
+FOURSQUARE_URL = 'https://api.foursquare.com/v2'
+DEMOGRAPHICS_URL = 'https://{}.hometownlocator.com/zip-codes/data,zipcode,{}.cfm'
+GEOCODE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+ZIPCODES_URL = 'https://www.zip-codes.com/county/{}.asp'
+FRANCHISES_URL = 'https://en.wikipedia.org/wiki/List_of_coffeehouse_chains'
+
+# The zip-codes.com county pages for the Denver metro area, and the cities on
+# each page whose zip codes are kept
+ZIPCODE_PAGES = {
+    'co-denver': ['Denver'],
+    'co-adams': ['Denver', 'Westminster', 'Aurora', 'Thornton'],
+    'co-jefferson': ['Arvada', 'Broomfield', 'Wheat Ridge', 'Littleton', 'Denver', 'Golden'],
+    'co-arapahoe': ['Aurora', 'Englewood', 'Littleton'],
+    'co-douglas': ['Castle Rock', 'Lone Tree', 'Littleton', 'Parker'],
+    'co-boulder': ['Boulder'],
+}
+
+# The metro areas the pipeline can be built for. Each has its zip-codes.com county
+# pages with the cities to keep on each, the state for the hometownlocator pages,
+# any other (zip code, state) pairs to add, zip codes to leave out, and the zip
+# code whose demographics are used for zip codes that don't have any. Add a metro
+# here to run it with run_metros, or pass run_metros its own configs or a JSON or
+# YAML file of them
+METROS = {
+    'denver': {
+        'counties': ZIPCODE_PAGES,
+        'state': 'colorado',
+        'extra_zips': [('85281', 'arizona')],
+        # Two have demographics that are all zeroes and one is a tiny part of a
+        # medical school campus
+        'drop_zips': ['80294', '80225', '80045'],
+        'fallback_zip': '80202',
+    },
+}
+DEFAULT_METRO = 'denver'
+METRO_REQUIRED_KEYS = ('counties', 'state', 'fallback_zip')
+
+# Upper bounds in seconds of the latency histogram buckets for requests and calls
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_PREFIX = 'capstone_'
+
+class Metrics:
+    '''
+    Counters and latency histograms for the fetchers and loaders, kept in memory
+    and shared by every thread. Each metric has a name and a few labels, such as
+    the endpoint or function, and can be exported as a dictionary, as JSON or in
+    the Prometheus text format
+
+    Keyword Arguments:
+    buckets -- The upper bounds in seconds of the histogram buckets. Default is METRICS_BUCKETS
+    '''
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Clears every counter and histogram
+        '''
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        '''
+        Adds the value to a counter
+
+        Keyword Arguments:
+        name -- The name of the counter, e.g. 'http_retries_total'
+        value -- The amount to add. Default is 1
+        labels -- The labels of the counter, e.g. endpoint='explore'
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        '''
+        Records a duration in a histogram
+
+        Keyword Arguments:
+        name -- The name of the histogram, e.g. 'http_request_seconds'
+        seconds -- The duration to record
+        labels -- The labels of the histogram, e.g. endpoint='explore'
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # A count for each bucket and one for the values above them all,
+                # then the sum of the values
+                hist = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[i] += 1
+            hist[-1] += seconds
+
+    def snapshot(self):
+        '''
+        Returns the metrics as a dictionary with 'counters' and 'histograms', each a
+        dictionary of metric name to a list of samples. A counter sample has its
+        labels and value, and a histogram sample its labels, count, sum and the
+        cumulative count for each bucket's upper bound, ending with '+Inf'
+        '''
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(hist) for key, hist in self.histograms.items()}
+        result = {'counters': {}, 'histograms': {}}
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        for (name, labels), hist in sorted(histograms.items()):
+            cumulative = np.cumsum(hist[:-1]).tolist()
+            bounds = [repr(b) for b in self.buckets] + ['+Inf']
+            result['histograms'].setdefault(name, []).append({
+                'labels': dict(labels), 'count': cumulative[-1], 'sum': hist[-1],
+                'buckets': dict(zip(bounds, cumulative))})
+        return result
+
+    def to_json(self, **kwargs):
+        '''
+        Returns the snapshot as a JSON string
+
+        Keyword Arguments:
+        kwargs -- Passed on to json.dumps, e.g. indent=2
+        '''
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format, with every
+        name prefixed by METRICS_PREFIX
+        '''
+        def fmt(labels, **extra):
+            labels = dict(labels, **extra)
+            if not labels:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+            return '{' + ','.join('{}="{}"'.format(k, v) for k, v in zip(labels, escaped)) + '}'
+        
+        snapshot = self.snapshot()
+        lines = []
+        for name, samples in snapshot['counters'].items():
+            lines.append('# TYPE {}{} counter'.format(METRICS_PREFIX, name))
+            lines.extend('{}{}{} {}'.format(METRICS_PREFIX, name, fmt(s['labels']), s['value']) for s in samples)
+        for name, samples in snapshot['histograms'].items():
+            lines.append('# TYPE {}{} histogram'.format(METRICS_PREFIX, name))
+            for s in samples:
+                lines.extend('{}{}_bucket{} {}'.format(METRICS_PREFIX, name, fmt(s['labels'], le=le), count)
+                             for le, count in s['buckets'].items())
+                lines.append('{}{}_sum{} {}'.format(METRICS_PREFIX, name, fmt(s['labels']), s['sum']))
+                lines.append('{}{}_count{} {}'.format(METRICS_PREFIX, name, fmt(s['labels']), s['count']))
+        return '\n'.join(lines) + '\n'
+
+# Metrics are only collected once they are turned on with configure_metrics. Until
+# then this is None, and instrumented code does nothing more than check that
+metrics = None
+
+def configure_metrics(enabled=True, buckets=None):
+    '''
+    Turns collecting metrics on or off, and returns the Metrics object now in use,
+    or None when turned off. Turning them on again starts from empty metrics
+
+    Keyword Arguments:
+    enabled -- Whether to collect metrics. Default is True
+    buckets -- The upper bounds in seconds of the histogram buckets. Default is METRICS_BUCKETS
+    '''
+    global metrics
+    metrics = Metrics(buckets or METRICS_BUCKETS) if enabled else None
+    return metrics
+
+def get_metrics():
+    '''
+    Returns the Metrics object being collected, or None if metrics are turned off
+    '''
+    return metrics
+
+def count_rows(result):
+    '''
+    Returns the number of rows in a frame or array, or 1 for any other result
+
+    Keyword Arguments:
+    result -- The result of an instrumented function
+    '''
+    return len(result) if hasattr(result, 'shape') else 1
+
+def instrumented(rows=count_rows):
+    '''
+    Decorator that records the calls to a fetcher or loader when metrics are on:
+    a histogram of its latency in call_seconds, the rows it produced in
+    rows_total and any exceptions in call_errors_total, all labelled with the
+    function name. When metrics are off the function is called directly
+
+    Keyword Arguments:
+    rows -- A function of the result that returns the number of rows it holds.
+            Default is count_rows
+    '''
+    def decorate(func):
+        name = func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            m = metrics
+            if m is None:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                m.inc('call_errors_total', function=name)
+                raise
+            finally:
+                m.observe('call_seconds', perf_counter() - start, function=name)
+            m.inc('rows_total', rows(result), function=name)
+            return result
+        return wrapper
+    return decorate
+
+# Settings for the on-disk cache of individual HTTP responses. Each endpoint has its
+# own time-to-live in seconds, and once the cache grows past its size limit the least
+# recently used responses are evicted first
+HTTP_CACHE_FILE = './capstone_http_cache.sqlite'
+HTTP_CACHE_MAX_BYTES = 256 * 1024 * 1024
+HTTP_CACHE_TTLS = {
+    'categories': 30 * 86400,
+    'explore': 7 * 86400,
+    'nextvenues': 86400,
+    'geocode': 365 * 86400,
+    'zipcodes': 90 * 86400,
+    'demographics': 90 * 86400,
+    'franchises': 30 * 86400,
+}
+# Cache hits only note when each response was used; the notes are written to the
+# database in one batch once there are this many, or before the next store
+HTTP_CACHE_ACCESS_BATCH = 256
+
+# Query string parameters that hold credentials, which are never part of a cache key
+SECRET_PARAMS = {'client_id', 'client_secret', 'key', 'oauth_token'}
+
+def normalize_url(url):
+    '''
+    Returns the url in a canonical form for use as a cache key: the scheme and host
+    are lowercased, the query parameters are sorted and any credentials are removed
+
+    Keyword Arguments:
+    url -- The url to normalize
+    '''
+    parts = urllib.parse.urlsplit(url)
+    query = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+                   if k.lower() not in SECRET_PARAMS)
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path,
+                                    urllib.parse.urlencode(query), ''))
+
+
+class ResponseCache:
+    '''
+    A persistent cache of HTTP response bodies stored in a sqlite database. Entries
+    are keyed by normalized url, expire according to the time-to-live for their
+    endpoint and are evicted least recently used first when the cache is over its
+    size limit. The cache can be shared by the threads used for concurrent requests.
+    The total size is kept as a running count rather than summed on every store,
+    and hits are written back in batches of HTTP_CACHE_ACCESS_BATCH, so a hit
+    doesn't commit a write of its own
+    
+    Keyword Arguments:
+    path -- The sqlite file to store responses in
+    ttls -- A dictionary of endpoint name to time-to-live in seconds
+    max_bytes -- The maximum total size of the stored (compressed) responses
+    '''
+    def __init__(self, path, ttls, max_bytes):
+        self.path = path
+        self.ttls = dict(ttls)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # Write-ahead logging without a sync on every commit keeps lookups cheap; at
+        # worst a crash loses the most recent entries, which are simply refetched
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                endpoint TEXT NOT NULL,
+                                body BLOB NOT NULL,
+                                size INTEGER NOT NULL,
+                                created REAL NOT NULL,
+                                accessed REAL NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.conn.commit()
+        self.total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        # Key to the time of its latest hit that isn't written yet
+        self.accessed = {}
+
+    def flush_accessed(self):
+        '''
+        Writes the access times of the hits since the last flush. Call it with the
+        lock held
+        '''
+        if self.accessed:
+            self.conn.executemany('UPDATE responses SET accessed = ? WHERE key = ?',
+                                  [(when, key) for key, when in self.accessed.items()])
+            self.conn.commit()
+            self.accessed = {}
+
+    def get(self, url, endpoint):
+        '''
+        Returns the cached body for the url, or None if it is missing or expired
+
+        Keyword Arguments:
+        url -- The url of the request
+        endpoint -- The endpoint name, used to find the time-to-live
+        '''
+        key = normalize_url(url)
+        now = time()
+        with self.lock:
+            row = self.conn.execute('SELECT body, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.ttls.get(endpoint, 0):
+                self.counters['misses'] += 1
+                return None
+            self.accessed[key] = now
+            if len(self.accessed) >= HTTP_CACHE_ACCESS_BATCH:
+                self.flush_accessed()
+            self.counters['hits'] += 1
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, url, endpoint, text):
+        '''
+        Stores the body for the url and evicts the least recently used responses
+        if the cache has grown past its size limit
+
+        Keyword Arguments:
+        url -- The url of the request
+        endpoint -- The endpoint name the response came from
+        text -- The response body to store
+        '''
+        key = normalize_url(url)
+        body = zlib.compress(text.encode('utf-8'))
+        now = time()
+        with self.lock:
+            # Pending hits go first so they can't overwrite the new entry's time and
+            # so eviction sees the true order
+            self.flush_accessed()
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, endpoint, body, len(body), now, now))
+            self.counters['stores'] += 1
+            self.total += len(body) - (row[0] if row else 0)
+            if self.total > self.max_bytes:
+                # Walk the oldest entries only as far as needed to get back under the
+                # limit, then delete them in one statement
+                count, freed = 0, 0
+                for (size,) in self.conn.execute('SELECT size FROM responses ORDER BY accessed'):
+                    if self.total - freed <= self.max_bytes:
+                        break
+                    count += 1
+                    freed += size
+                self.conn.execute('''DELETE FROM responses WHERE key IN
+                                     (SELECT key FROM responses ORDER BY accessed LIMIT ?)''', (count,))
+                self.counters['evictions'] += count
+                self.total -= freed
+            self.conn.commit()
+
+    def clear(self):
+        '''
+        Removes every stored response and resets the counters
+        '''
+        with self.lock:
+            self.conn.execute('DELETE FROM responses')
+            self.conn.commit()
+            self.total = 0
+            self.accessed = {}
+            self.counters = dict.fromkeys(self.counters, 0)
+
+    def stats(self):
+        '''
+        Returns a dictionary of the hit, miss, store and eviction counters along with
+        the number of stored responses and their total size in bytes
+        '''
+        with self.lock:
+            count = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            return dict(self.counters, entries=count, bytes=self.total)
+
+    def close(self):
+        '''
+        Writes any pending hits and closes the database
+        '''
+        with self.lock:
+            self.flush_accessed()
+            self.conn.close()
+
+
+# Settings for the shared HTTP session. Connections are kept alive and pooled per
+# host, with enough connections in each pool for the number of concurrent requests
+HTTP_POOL_HOSTS = 10
+HTTP_POOL_SIZE = 10
+
+# The (connect, read) timeouts in seconds for every request. A request that times
+# out is retried like a connection error, so a stalled server can't hold a worker,
+# and the pool waiting on it, forever
+HTTP_TIMEOUT = (10, 60)
+
+# The shared session is created on first use
+http_session = None
+http_session_pooled = True
+http_session_lock = threading.Lock()
+
+def configure_session(pool_size=None, pool_hosts=None, pooled=None):
+    '''
+    Changes the settings for the shared HTTP session used by every fetcher in this
+    module. The session is closed and recreated with the new settings on the next
+    request, so only call it while no requests are being made; use
+    ensure_pool_size to grow the pool of a session that is in use
+
+    Keyword Arguments:
+    pool_size -- The number of connections to keep for each host. Default is HTTP_POOL_SIZE
+    pool_hosts -- The number of hosts to keep pools for. Default is HTTP_POOL_HOSTS
+    pooled -- Whether to reuse connections at all. When False every request opens
+              a new connection, which is only useful for comparison. Default is None,
+              which keeps the current setting
+    '''
+    global http_session, http_session_pooled, HTTP_POOL_SIZE, HTTP_POOL_HOSTS
+    with http_session_lock:
+        if http_session is not None:
+            http_session.close()
+        http_session = None
+        if pooled is not None:
+            http_session_pooled = pooled
+        HTTP_POOL_SIZE = pool_size or HTTP_POOL_SIZE
+        HTTP_POOL_HOSTS = pool_hosts or HTTP_POOL_HOSTS
+
+def mount_pool(session):
+    '''
+    Mounts a connection pool adapter with the current HTTP_POOL_HOSTS and
+    HTTP_POOL_SIZE on the session. Call it with http_session_lock held
+
+    Keyword Arguments:
+    session -- The requests session
+    '''
+    import requests
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+def ensure_pool_size(pool_size):
+    '''
+    Makes sure the shared session keeps at least pool_size connections for each
+    host. A larger pool is mounted on the live session, so requests other threads
+    are making carry on over the connections they already have, and the old pool's
+    connections are let go once those requests finish. The session is never closed
+
+    Keyword Arguments:
+    pool_size -- The number of connections needed for each host
+    '''
+    global HTTP_POOL_SIZE
+    with http_session_lock:
+        if pool_size <= HTTP_POOL_SIZE:
+            return
+        HTTP_POOL_SIZE = pool_size
+        if http_session is not None:
+            mount_pool(http_session)
+
+def get_session():
+    '''
+    Returns the shared requests session, creating it if needed. The session keeps
+    connections alive in a pool for each host and asks servers for compressed
+    responses. Returns None if pooling has been turned off with configure_session
+    '''
+    global http_session
+    with http_session_lock:
+        if not http_session_pooled:
+            return None
+        if http_session is None:
+            import requests
+            http_session = requests.Session()
+            mount_pool(http_session)
+            http_session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        return http_session
+
+def http_get(url):
+    '''
+    Makes a GET request through the shared session, or with a one-off connection
+    if pooling has been turned off
+
+    Keyword Arguments:
+    url -- The url to request
+    '''
+    session = get_session()
+    if session is None:
+        import requests
+        return requests.get(url, timeout=HTTP_TIMEOUT)
+    return session.get(url, timeout=HTTP_TIMEOUT)
+
+# Settings for retrying failed requests. Retries back off exponentially with full
+# jitter, unless the server says how long to wait with a Retry-After header
+HTTP_MAX_TRIES = 6
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 30.0
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Client-side rate limits for each endpoint as (requests per second, burst size).
+# Endpoints that aren't listed are only limited once the server reports a quota
+# through its X-RateLimit-Remaining and X-RateLimit-Reset headers
+HTTP_RATE_LIMITS = {
+    'geocode': (50, 50),
+    'zipcodes': (10, 10),
+    'demographics': (10, 10),
+}
+
+class RateLimiter:
+    '''
+    A token bucket shared by every thread making requests to one endpoint. Tokens
+    are added at the given rate up to the burst size and each request takes one,
+    waiting for the next token if the bucket is empty. The bucket can be updated
+    later with the quota the server reports
+    
+    Keyword Arguments:
+    rate -- The sustained number of requests per second, or None for no limit
+    burst -- The number of requests that can be made at once
+    '''
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.max_burst = burst
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+        # Waiting threads are woken when a new quota arrives rather than sleeping
+        # out a wait worked out from the old one
+        self.quota_changed = threading.Condition(self.lock)
+
+    def acquire(self):
+        '''
+        Takes a token from the bucket, waiting until one is available, and returns
+        the number of seconds spent waiting
+        '''
+        start = monotonic()
+        with self.lock:
+            while True:
+                if self.rate is None:
+                    return monotonic() - start
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return now - start
+                self.quota_changed.wait((1 - self.tokens) / self.rate)
+
+    def update_quota(self, remaining, reset_in):
+        '''
+        Matches the bucket to the quota the server reports. The requests that are
+        remaining can be made right away, so the bucket holds that many tokens, and
+        once they run out the rest of the window is spread evenly at the rate that
+        uses up the quota by the time it resets. The configured rate and burst are
+        never exceeded, so endpoints with a limit in HTTP_RATE_LIMITS are only
+        slowed down when their quota gets low
+
+        Keyword Arguments:
+        remaining -- The number of requests left in the current quota window
+        reset_in -- The number of seconds until the quota window resets
+        '''
+        with self.lock:
+            now = monotonic()
+            if self.rate is not None:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            remaining = max(remaining, 0)
+            rate = max(remaining, 1) / max(reset_in, 1.0)
+            if self.max_rate is None:
+                self.rate = rate
+                self.burst = max(remaining, 1)
+                self.tokens = float(remaining)
+            else:
+                self.rate = min(rate, self.max_rate) if remaining < self.max_burst else self.max_rate
+                self.tokens = min(self.tokens, remaining)
+            self.quota_changed.notify_all()
+
+
+http_limiters = {}
+http_limiters_lock = threading.Lock()
+http_counters = {'requests': 0, 'retries': 0, 'failures': 0, 'throttled_seconds': 0.0}
+
+def get_limiter(endpoint):
+    '''
+    Returns the shared rate limiter for the endpoint, creating it from
+    HTTP_RATE_LIMITS on first use
+
+    Keyword Arguments:
+    endpoint -- The endpoint name
+    '''
+    with http_limiters_lock:
+        if endpoint not in http_limiters:
+            rate, burst = HTTP_RATE_LIMITS.get(endpoint, (None, 1))
+            http_limiters[endpoint] = RateLimiter(rate, burst)
+        return http_limiters[endpoint]
+
+def backoff_delay(attempt, retry_after=None):
+    '''
+    Returns the number of seconds to wait before the next try. Uses the server's
+    Retry-After value when it gives one, otherwise a random delay of up to
+    HTTP_BACKOFF_BASE * 2^attempt, capped at HTTP_BACKOFF_MAX
+
+    Keyword Arguments:
+    attempt -- The number of tries made so far, starting at 0
+    retry_after -- The value of the Retry-After header, if any. Default is None
+    '''
+    try:
+        return min(float(retry_after), HTTP_BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+class UnusableResponse(Exception):
+    '''
+    Raised by an is_valid check, and passed on by fetch, when a response is an
+    answer that trying again won't change, such as a place Google can't geocode
+    '''
+
+
+def fetch(url, endpoint, is_valid=None):
+    '''
+    Makes a rate limited GET request for the url, retrying connection errors,
+    timeouts, throttling and server errors, and successful responses that fail the
+    optional is_valid check or can't be parsed by it. Raises
+    requests.exceptions.RetryError once HTTP_MAX_TRIES tries have failed,
+    requests.exceptions.HTTPError for other client errors, and UnusableResponse
+    right away when is_valid raises it
+
+    Keyword Arguments:
+    url -- The url to request
+    endpoint -- The endpoint name, which selects the rate limiter
+    is_valid -- An optional function of the body that returns whether it is usable,
+                raises ValueError if it can't be parsed, e.g. isn't JSON, and
+                raises UnusableResponse if it is a permanent failure
+    '''
+    import requests
+    logger = logging.getLogger('capstoneutils.fetch')
+    limiter = get_limiter(endpoint)
+    
+    for attempt in range(HTTP_MAX_TRIES):
+        waited = limiter.acquire()
+        retry_after = None
+        m = metrics
+        start = perf_counter()
+        try:
+            response = http_get(url)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            reason = type(e).__name__
+            if m is not None:
+                m.observe('http_request_seconds', perf_counter() - start, endpoint=endpoint)
+                m.inc('http_responses_total', endpoint=endpoint, status=reason)
+        else:
+            if m is not None:
+                m.observe('http_request_seconds', perf_counter() - start, endpoint=endpoint)
+                m.inc('http_responses_total', endpoint=endpoint, status=response.status_code)
+                m.inc('http_response_bytes_total', len(response.content), endpoint=endpoint)
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            reset = response.headers.get('X-RateLimit-Reset')
+            if remaining is not None and reset is not None:
+                # The headers are only a hint, so a malformed one is ignored rather
+                # than failing a response that is otherwise fine
+                try:
+                    quota = int(remaining), float(reset) - time()
+                except (TypeError, ValueError):
+                    logger.debug('Ignoring malformed quota headers {!r} and {!r} from {}'.format(
+                        remaining, reset, endpoint.upper()))
+                else:
+                    limiter.update_quota(*quota)
+            
+            if response.status_code in HTTP_RETRY_STATUSES:
+                reason = 'HTTP {}'.format(response.status_code)
+                retry_after = response.headers.get('Retry-After')
+            elif response.status_code != 200:
+                response.raise_for_status()
+                return response
+            elif is_valid is not None and not response_usable(response.text, is_valid, endpoint):
+                reason = 'an unusable response'
+            else:
+                with http_limiters_lock:
+                    http_counters['requests'] += 1
+                    http_counters['throttled_seconds'] += waited
+                if m is not None:
+                    m.inc('http_throttled_seconds_total', waited, endpoint=endpoint)
+                return response
+        
+        outcome = 'retries' if attempt + 1 < HTTP_MAX_TRIES else 'failures'
+        with http_limiters_lock:
+            http_counters['requests'] += 1
+            http_counters['throttled_seconds'] += waited
+            http_counters[outcome] += 1
+        if m is not None:
+            m.inc('http_throttled_seconds_total', waited, endpoint=endpoint)
+            m.inc('http_{}_total'.format(outcome), endpoint=endpoint)
+        if attempt + 1 < HTTP_MAX_TRIES:
+            delay = backoff_delay(attempt, retry_after)
+            logger.warning('Retrying {} due to {}. Trycount={}, waiting {:.2f}s'.format(
+                endpoint.upper(), reason, attempt + 1, delay))
+            sleep(delay)
+    
+    raise requests.exceptions.RetryError('Giving up on {} after {} tries due to {}'.format(
+        endpoint.upper(), HTTP_MAX_TRIES, reason))
+
+def response_usable(text, is_valid, endpoint):
+    '''
+    Returns whether the body passes the is_valid check of fetch, treating a body
+    that can't be parsed as one to retry. A permanent failure is counted and
+    UnusableResponse is passed on
+
+    Keyword Arguments:
+    text -- The body of the response
+    is_valid -- The function of the body that returns whether it is usable
+    endpoint -- The endpoint name, for the counters
+    '''
+    try:
+        return is_valid(text)
+    except ValueError:
+        return False
+    except UnusableResponse:
+        with http_limiters_lock:
+            http_counters['requests'] += 1
+            http_counters['failures'] += 1
+        if metrics is not None:
+            metrics.inc('http_failures_total', endpoint=endpoint)
+        raise
+
+# The shared cache is opened on first use rather than when the module is loaded
+http_cache = None
+http_cache_enabled = True
+http_cache_lock = threading.Lock()
+
+def configure_cache(path=None, ttls=None, max_bytes=None, enabled=True):
+    '''
+    Changes the settings for the shared response cache. The cache is reopened with
+    the new settings the next time a request is made
+
+    Keyword Arguments:
+    path -- The sqlite file to use. Default is HTTP_CACHE_FILE
+    ttls -- A dictionary of endpoint name to time-to-live in seconds, merged over
+            HTTP_CACHE_TTLS. Default is None
+    max_bytes -- The maximum size of the cache. Default is HTTP_CACHE_MAX_BYTES
+    enabled -- Whether to use the cache at all. Default is True
+    '''
+    global http_cache, http_cache_enabled, HTTP_CACHE_FILE, HTTP_CACHE_MAX_BYTES
+    with http_cache_lock:
+        if http_cache is not None:
+            http_cache.close()
+        http_cache = None
+        http_cache_enabled = enabled
+        HTTP_CACHE_FILE = path or HTTP_CACHE_FILE
+        HTTP_CACHE_MAX_BYTES = max_bytes or HTTP_CACHE_MAX_BYTES
+        if ttls:
+            HTTP_CACHE_TTLS.update(ttls)
+
+def get_cache():
+    '''
+    Returns the shared response cache, opening it if needed, or None if the cache
+    has been disabled with configure_cache
+    '''
+    global http_cache
+    with http_cache_lock:
+        if http_cache_enabled and http_cache is None:
+            http_cache = ResponseCache(HTTP_CACHE_FILE, HTTP_CACHE_TTLS, HTTP_CACHE_MAX_BYTES)
+        return http_cache if http_cache_enabled else None
+
+def cache_stats():
+    '''
+    Returns the hit and miss counters for the shared response cache, so a warm rerun
+    can be checked for network calls. Returns an empty dictionary when disabled
+    '''
+    cache = get_cache()
+    return cache.stats() if cache else {}
+
+def cached_get(url, endpoint, is_valid=None):
+    '''
+    Returns the body of a GET request for the url, from the shared response cache if
+    possible. Otherwise the request is made with fetch, so it is rate limited and
+    retried until it succeeds and the body passes the optional is_valid check, and
+    only then is it stored, so failures are never replayed
+
+    Keyword Arguments:
+    url -- The url to request
+    endpoint -- The endpoint name, which selects the time-to-live and rate limiter
+    is_valid -- An optional function of the body that returns whether it is usable
+    '''
+    cache = get_cache()
+    if cache:
+        text = cache.get(url, endpoint)
+        if metrics is not None:
+            metrics.inc('cache_hits_total' if text is not None else 'cache_misses_total', endpoint=endpoint)
+        if text is not None:
+            return text
+    
+    text = fetch(url, endpoint, is_valid).text
+    if cache:
+        cache.put(url, endpoint, text)
+    return text
+
+# Per zip code checkpoints for the loaders, so that an interrupted build picks up
+# where it left off and a refresh only redoes the zip codes that are new or stale
+CHECKPOINT_FILE = './capstone_checkpoints.sqlite'
+
+class CheckpointStore:
+    '''
+    A sqlite table of pickled results keyed by dataset name and key (usually a zip
+    code), along with the time each one was stored. Each result is committed as
+    soon as it is stored, so nothing finished is lost if a build is interrupted
+
+    Keyword Arguments:
+    path -- The sqlite file to store the checkpoints in
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS checkpoints (
+                                dataset TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                updated REAL NOT NULL,
+                                payload BLOB NOT NULL,
+                                PRIMARY KEY (dataset, key))''')
+        self.conn.commit()
+
+    def load(self, dataset, keys=None):
+        '''
+        Returns a dictionary of key to (updated, result) for the checkpoints stored
+        for the dataset, either all of them or only those for the given keys, which
+        keeps a metro from loading every other metro's checkpoints
+
+        Keyword Arguments:
+        dataset -- The name of the dataset
+        keys -- The keys to load, or None for all of them. Default is None
+        '''
+        query = 'SELECT key, updated, payload FROM checkpoints WHERE dataset = ?'
+        with self.lock:
+            if keys is None:
+                rows = self.conn.execute(query, (dataset,)).fetchall()
+            else:
+                # Stay well under sqlite's limit on the number of parameters
+                keys = list(dict.fromkeys(str(key) for key in keys))
+                rows = []
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    rows += self.conn.execute('{} AND key IN ({})'.format(query, ','.join('?' * len(chunk))),
+                                              [dataset] + chunk).fetchall()
+        return {key: (updated, pickle.loads(payload)) for key, updated, payload in rows}
+
+    def put(self, dataset, key, result, updated=None):
+        '''
+        Stores the result for the key, replacing any earlier checkpoint
+
+        Keyword Arguments:
+        dataset -- The name of the dataset
+        key -- The key of the result, usually a zip code
+        result -- The result to store, which must be picklable
+        updated -- The time the result was obtained. Default is now
+        '''
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+                              (dataset, str(key), updated or time(), pickle.dumps(result)))
+            self.conn.commit()
+
+    def seed(self, dataset, results, updated):
+        '''
+        Stores results for the keys that don't have a checkpoint yet, which lets a
+        dataset built before checkpoints existed be refreshed incrementally
+
+        Keyword Arguments:
+        dataset -- The name of the dataset
+        results -- A dictionary of key to result
+        updated -- The time the results were obtained
+        '''
+        existing = self.load(dataset, results)
+        for key, result in results.items():
+            if key not in existing:
+                self.put(dataset, key, result, updated)
+
+    def clear(self, dataset):
+        '''
+        Removes every checkpoint for the dataset
+
+        Keyword Arguments:
+        dataset -- The name of the dataset
+        '''
+        with self.lock:
+            self.conn.execute('DELETE FROM checkpoints WHERE dataset = ?', (dataset,))
+            self.conn.commit()
+
+
+checkpoints = None
+checkpoints_lock = threading.Lock()
+
+def get_checkpoints():
+    '''
+    Returns the shared checkpoint store, opening CHECKPOINT_FILE on first use
+    '''
+    global checkpoints
+    with checkpoints_lock:
+        if checkpoints is None or checkpoints.path != CHECKPOINT_FILE:
+            checkpoints = CheckpointStore(CHECKPOINT_FILE)
+        return checkpoints
+
+def is_stale(checkpoint, max_age):
+    '''
+    Returns whether a checkpoint is missing or older than max_age seconds
+
+    Keyword Arguments:
+    checkpoint -- The (updated, result) tuple from CheckpointStore.load, or None
+    max_age -- The age in seconds after which results are refreshed, or None for never
+    '''
+    if checkpoint is None:
+        return True
+    return max_age is not None and time() - checkpoint[0] > max_age
+
+# Cached datasets are stored as Parquet files when pyarrow is available, which lets
+# single columns or zip codes be read without loading the whole file. Without
+# pyarrow, or when only an older pickle exists, the pickle is used instead
+DATA_DIR = '.'
+DATA_ROW_GROUP_SIZE = 16 * 1024
+
+def dataset_file(name):
+    '''
+    Returns the path of the stored dataset with the given name, preferring the
+    Parquet file over the pickle, or None if it hasn't been stored yet
+
+    Keyword Arguments:
+    name -- The name of the dataset, e.g. 'all_demog'
+    '''
+    for ext in (['parquet'] if get_parquet() is not None else []) + ['pkl']:
+        path = os.path.join(DATA_DIR, '{}.{}'.format(name, ext))
+        if os.path.exists(path):
+            return path
+    return None
+
+def metro_dataset(name, metro):
+    '''
+    Returns the name of a metro's partition of a dataset, e.g. 'fsq_venues/metro=boston/part-0'
+    for the Boston venues, laid out the way Hive partitions are so that the
+    partitions can also be read together as one Parquet dataset
+
+    Keyword Arguments:
+    name -- The name of the dataset, e.g. 'fsq_venues'
+    metro -- The name of the metro in METROS
+    '''
+    return '/'.join([name, 'metro={}'.format(metro), 'part-0'])
+
+def load_metro_configs(metros=None):
+    '''
+    Returns a dictionary of metro name to config, laid out like METROS, for the
+    metros to build. The metros can be given by name, in which case they are
+    looked up in METROS, as a dictionary of their own configs, or as the path to
+    a JSON or YAML file holding such a dictionary. Raises a KeyError for names
+    that aren't in METROS and a ValueError for configs missing any of
+    METRO_REQUIRED_KEYS
+
+    Keyword Arguments:
+    metros -- The names of the metros, a dictionary of metro name to config, the
+              path to a .json, .yaml or .yml file of one, or None for all of
+              METROS. Default is None
+    '''
+    if metros is None:
+        metros = METROS
+    elif isinstance(metros, (str, os.PathLike)):
+        path = os.fspath(metros)
+        with open(path) as f:
+            if path.endswith(('.yaml', '.yml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ImportError('Reading {} requires PyYAML'.format(path))
+                metros = yaml.safe_load(f)
+            else:
+                metros = json.load(f)
+        if not isinstance(metros, dict):
+            raise ValueError('{} must hold a mapping of metro name to config'.format(path))
+    elif not isinstance(metros, dict):
+        metros = list(metros)
+        unknown = [metro for metro in metros if metro not in METROS]
+        if unknown:
+            raise KeyError('Unknown metros {}, add them to METROS first'.format(unknown))
+        metros = {metro: METROS[metro] for metro in metros}
+
+    configs = {}
+    for metro, config in metros.items():
+        missing = [key for key in METRO_REQUIRED_KEYS if key not in config]
+        if missing:
+            raise ValueError('The config of metro {} is missing {}'.format(metro, missing))
+        # JSON and YAML have no tuples, so the (zip code, state) pairs come back as lists
+        configs[metro] = dict(config, extra_zips=[tuple(pair) for pair in config.get('extra_zips', [])])
+    return configs
+
+def select_dataset(df, columns=None, zipcodes=None):
+    '''
+    Returns the rows of the frame for the given zip codes and only the given columns
+
+    Keyword Arguments:
+    df -- The frame to select from
+    columns -- The columns to keep, or None for all. Default is None
+    zipcodes -- The zip codes to keep, or None for all. Default is None
+    '''
+    if zipcodes is not None:
+        df = df[df['ZipCode'].isin([str(z) for z in zipcodes])]
+    return df if columns is None else df[list(columns)]
+
+def convert_dataset(name, remove=False):
+    '''
+    Stores a dataset that only exists as a pickle as Parquet, so that it can be
+    read a few columns or zip codes at a time, and returns the path of the Parquet
+    file. Datasets are never converted as a side effect of reading them, so
+    calling this is the only way a pickle becomes a Parquet file. Raises an
+    ImportError if pyarrow isn't installed and a FileNotFoundError if there is no
+    stored dataset
+
+    Keyword Arguments:
+    name -- The name of the dataset, e.g. 'all_demog'
+    remove -- Whether to remove the pickle afterwards. Default is False
+    '''
+    if get_parquet() is None:
+        raise ImportError('convert_dataset requires pyarrow')
+    path = dataset_file(name)
+    if path is None:
+        raise FileNotFoundError('No stored dataset named {}'.format(name))
+    if path.endswith('.pkl'):
+        write_dataset(pd.read_pickle(path), name)
+        if remove:
+            os.remove(path)
+    return dataset_file(name)
+
+def read_dataset(name, columns=None, zipcodes=None, dtypes=None):
+    '''
+    Reads a stored dataset, or returns None if it hasn't been stored yet. Parquet
+    files are memory mapped, only the requested columns are read and the zip code
+    filter is pushed down so that row groups without those zip codes are skipped.
+    A dataset that only exists as a pickle is read from the pickle and left as it
+    is; use convert_dataset to store it as Parquet.
+
+    When dtypes is given the columns are converted with compact_frame once they are
+    read and back in their original order, which also gives the memory used along
+    the way back to the operating system
+
+    Keyword Arguments:
+    name -- The name of the dataset, e.g. 'all_demog'
+    columns -- The columns to read, or None for all. Default is None
+    zipcodes -- The zip codes to read, or None for all. Default is None
+    dtypes -- The dtypes to convert columns to as they are read, see compact_frame.
+              Default is None
+    '''
+    path = dataset_file(name)
+    if path is None:
+        return None
+    
+    if path.endswith('.parquet'):
+        filters = [('ZipCode', 'in', [str(z) for z in zipcodes])] if zipcodes is not None else None
+        table = get_parquet().read_table(path, columns=None if columns is None else list(columns), filters=filters,
+                              memory_map=True, use_pandas_metadata=True)
+        # Rows are stored sorted by zip code, so put them back in their original
+        # order. Sorting in pyarrow keeps the copies in its memory pool, which
+        # compact_frame gives back afterwards
+        index = [col for col in table.column_names if col.startswith('__index_level_')]
+        if index and hasattr(table, 'sort_by'):
+            table = table.sort_by(index[0])
+        df = table.to_pandas()
+        del table
+    else:
+        df = select_dataset(pd.read_pickle(path), columns, zipcodes)
+        return df if dtypes is None else compact_frame(df, dtypes)
+    
+    # Go back to a range index when that's what was stored
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='stable')
+    if len(df) and df.index[0] == 0 and df.index[-1] == len(df) - 1 and df.index.is_unique:
+        df.index = pd.RangeIndex(len(df))
+    return df if dtypes is None else compact_frame(df, dtypes)
+
+
+def write_dataset(df, name):
+    '''
+    Stores the dataset as Parquet, or as a pickle if pyarrow isn't available. The
+    Parquet rows are sorted by zip code so that each row group covers a narrow
+    range of zip codes, which is what lets read_dataset skip most of them; the
+    index is stored as well, which lets the original order be restored
+
+    Keyword Arguments:
+    df -- The frame to store
+    name -- The name of the dataset, e.g. 'all_demog'
+    '''
+    os.makedirs(os.path.dirname(os.path.join(DATA_DIR, name)), exist_ok=True)
+    if get_parquet() is not None:
+        if 'ZipCode' in df and df.index.is_monotonic_increasing:
+            df = df.sort_values('ZipCode', kind='stable')
+        # Parquet writes the whole dictionary of a categorical column into every row
+        # group, so they are stored as plain values, which Parquet dictionary encodes
+        # within each row group anyway, and compacted again when they are loaded
+        categorical = [col for col in df if isinstance(df[col].dtype, pd.CategoricalDtype)]
+        if categorical:
+            df = df.astype({col: df[col].cat.categories.dtype for col in categorical})
+        df.to_parquet(os.path.join(DATA_DIR, '{}.parquet'.format(name)), engine='pyarrow', index=True,
+                      row_group_size=DATA_ROW_GROUP_SIZE)
+    else:
+        df.to_pickle(os.path.join(DATA_DIR, '{}.pkl'.format(name)))
+
+
+class DatasetWriter:
+    '''
+    Appends frames to a stored dataset as they arrive, so a dataset can be built
+    from a stream of batches without holding all of it in memory. Batches are
+    buffered until there are row_group_size rows and then written as one Parquet
+    row group, so memory is bounded by a row group. The rows keep the order they
+    were appended in and are numbered across batches, which read_dataset restores
+    as a range index. The dataset replaces any stored one when the writer is
+    closed, unless nothing was appended, and is discarded if it is closed due to
+    an exception. Without pyarrow
+    the batches are kept and stored as a pickle when the writer is closed
+
+    Use it as a context manager, e.g.
+        with DatasetWriter('fsq_venues') as sink:
+            for batch in iter_nearby_venues(names, lats, lngs):
+                sink.append(batch)
+
+    Keyword Arguments:
+    name -- The name of the dataset, e.g. 'fsq_venues'
+    row_group_size -- The number of rows to buffer before writing them. Default
+                      is DATA_ROW_GROUP_SIZE
+    '''
+    def __init__(self, name, row_group_size=None):
+        self.name = name
+        self.row_group_size = row_group_size or DATA_ROW_GROUP_SIZE
+        self.pq = get_parquet()
+        ext = 'parquet' if self.pq is not None else 'pkl'
+        self.path = os.path.join(DATA_DIR, '{}.{}'.format(name, ext))
+        self.tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.buffer = []
+        self.buffered = 0
+        self.rows = 0
+        self.writer = None
+        self.schema = None
+
+    def append(self, df):
+        '''
+        Adds a frame to the dataset. Every frame must have the same columns
+
+        Keyword Arguments:
+        df -- The frame to append
+        '''
+        if len(df) == 0:
+            return
+        self.buffer.append(df)
+        self.buffered += len(df)
+        if self.pq is not None and self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered frames as one row group
+        '''
+        if not self.buffer:
+            return
+        import pyarrow as pa
+        df = pd.concat(self.buffer, ignore_index=True) if len(self.buffer) > 1 else self.buffer[0]
+        self.buffer, self.buffered = [], 0
+        # Stored as plain values for the same reason as in write_dataset
+        categorical = [col for col in df if isinstance(df[col].dtype, pd.CategoricalDtype)]
+        if categorical:
+            df = df.astype({col: df[col].cat.categories.dtype for col in categorical})
+        df = df.set_axis(pd.RangeIndex(self.rows, self.rows + len(df)).astype(np.int64), axis=0)
+        self.rows += len(df)
+        
+        if self.writer is None:
+            # Columns that are empty in the first batch would be typed as null, and
+            # later batches couldn't be written with that schema
+            schema = pa.Schema.from_pandas(df, preserve_index=True)
+            for i, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    schema = schema.set(i, field.with_type(pa.string()))
+            self.schema = schema
+            self.writer = self.pq.ParquetWriter(self.tmp_path, schema)
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=True))
+
+    def close(self, discard=False):
+        '''
+        Writes anything still buffered and replaces the stored dataset with the new
+        one, or throws the new one away if discard is True
+
+        Keyword Arguments:
+        discard -- Whether to throw away what has been written. Default is False
+        '''
+        if self.pq is not None:
+            if not discard:
+                self.flush()
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+        elif not discard and self.buffer:
+            df = pd.concat(self.buffer, ignore_index=True)
+            self.rows = len(df)
+            df.to_pickle(self.tmp_path)
+        self.buffer = []
+        
+        if discard or not os.path.exists(self.tmp_path):
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            return
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(discard=exc_type is not None)
 
-# Go ahead and configure the logger, since this module will be run when its loaded
-logging.basicConfig(filename='capstone_util.log', filemode='w', level=logging.DEBUG)
 
 def clean_value(value):
     '''
@@ -42,33 +1320,241 @@ def clean_value(value):
     any leading and trailing spaces.
 
     Keyword Arguments:
-    value -- A string to clean
+    value -- A string to clean
+    '''
+    return value.split()[0].replace(',','').replace('$','').strip()
+
+# Script run in the browser to tell whether a Folium map has finished rendering:
+# the page has loaded, the Leaflet map object exists and none of its tile layers
+# have tiles still loading
+MAP_READY_SCRIPT = '''
+var map = window[arguments[0]];
+if (document.readyState !== 'complete' || !map || !map.eachLayer) { return false; }
+var tiles = document.querySelectorAll('img.leaflet-tile');
+for (var i = 0; i < tiles.length; i++) { if (!tiles[i].complete) { return false; } }
+var loading = false;
+map.eachLayer(function(layer) { if (layer.isLoading && layer.isLoading()) { loading = true; } });
+return !loading;
+'''
+
+
+class MapRenderer:
+    '''
+    Saves rendered Folium maps as png images using a single Selenium browser
+    (geckodriver.exe) for every map, rather than starting one per map. Each
+    screenshot is taken as soon as the map reports it has finished rendering.
+    Use it as a context manager so the browser is closed afterwards.
+
+    Experimental: MAP_READY_SCRIPT hasn't been run against a real Firefox yet. If
+    it never reports the map as ready, each screenshot is still taken after the
+    timeout, which is the fixed wait save_map used to make. render_static_map
+    needs no browser
+
+    Keyword Arguments:
+    headless -- Whether to run the browser without a window. Default is True
+    window_size -- The (width, height) of the browser window, or None for the
+                   browser's default. Default is None
+    '''
+    def __init__(self, headless=True, window_size=None):
+        from selenium import webdriver
+        options = webdriver.FirefoxOptions()
+        if headless:
+            options.add_argument('-headless')
+        self.browser = webdriver.Firefox(options=options)
+        if window_size:
+            self.browser.set_window_size(*window_size)
+
+    def render(self, map, html_fn, png_fn, html_dir='maps', timeout=3):
+        '''
+        Saves the map as HTML, loads it and saves a screenshot once it has finished
+        rendering. If it hasn't finished within timeout seconds, which can happen
+        when the tiles can't be reached, the screenshot is taken anyway
+
+        Keyword Arguments:
+        map -- The rendered folium map to save
+        html_fn -- The HTML filename to use when saving the rendered map
+        png_fn -- The PNG filename, including path, to use when saving the image
+        html_dir -- A subdirectory to use when saving the HTML. Default is 'maps'
+        timeout -- The most seconds to wait for the map to render. Default is 3
+        '''
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.common.exceptions import TimeoutException
+        logger = logging.getLogger('capstoneutils.MapRenderer.render')
+        html_path = os.path.join(os.getcwd(), html_dir, html_fn)
+        map.save(html_path)
+        self.browser.get('file://' + html_path)
+        try:
+            WebDriverWait(self.browser, timeout, poll_frequency=0.05).until(
+                lambda browser: browser.execute_script(MAP_READY_SCRIPT, map.get_name()))
+        except TimeoutException:
+            logger.warning('{} did not finish rendering within {} seconds'.format(html_fn, timeout))
+        self.browser.save_screenshot(png_fn)
+
+    def close(self):
+        '''
+        Closes the browser
+        '''
+        self.browser.quit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_map(map, html_fn, png_fn, html_dir='maps', delay=3, renderer=None):
+    '''
+    Uses the Selenium driver (geckodriver.exe) to save the rendered folium map
+    as a png image. Rendering goes through the experimental MapRenderer
+    
+    Keyword Arguments:
+    map -- The rendered folium map to save
+    html_fn -- The HTML filename to use when saving the rendered map
+    png_fn -- The PNG filename, including path, to use when saving the image
+    html_dir -- A subdirectory to use when saving the HTML. Default is 'maps'
+    delay -- The most seconds to wait for the map to render before capturing it
+    renderer -- A MapRenderer to reuse, or None to open a browser just for this
+                map. Default is None
+    '''
+    if renderer is not None:
+        renderer.render(map, html_fn, png_fn, html_dir, timeout=delay)
+        return
+    with MapRenderer(headless=False) as renderer:
+        renderer.render(map, html_fn, png_fn, html_dir, timeout=delay)
+
+
+def save_maps(maps, html_dir='maps', delay=3, static=False):
+    '''
+    Saves a batch of rendered folium maps as png images, reusing one headless
+    browser for all of them with the experimental MapRenderer, or without a
+    browser at all using render_static_map
+
+    Keyword Arguments:
+    maps -- A sequence of (map, html_fn, png_fn) tuples
+    html_dir -- A subdirectory to use when saving the HTML. Default is 'maps'
+    delay -- The most seconds to wait for each map to render. Default is 3
+    static -- Whether to draw the maps with render_static_map instead of a
+              browser. Default is False
+    '''
+    if static:
+        for map, html_fn, png_fn in maps:
+            map.save(os.path.join(os.getcwd(), html_dir, html_fn))
+            render_static_map(map, png_fn)
+        return
+    with MapRenderer() as renderer:
+        for map, html_fn, png_fn in maps:
+            renderer.render(map, html_fn, png_fn, html_dir, timeout=delay)
+
+
+def mercator_pixels(lats, lons, zoom):
+    '''
+    Projects latitudes and longitudes to Web Mercator pixel coordinates at the given
+    zoom level, the same projection Leaflet uses, returning arrays of x and y
+
+    Keyword Arguments:
+    lats -- A sequence of latitudes
+    lons -- A sequence of longitudes
+    zoom -- The zoom level
     '''
-    return value.split()[0].replace(',','').replace('$','').strip()
+    scale = 256 * 2.0 ** zoom
+    lats = np.radians(np.clip(np.asarray(lats, dtype=np.float64), -85.0511, 85.0511))
+    x = (np.asarray(lons, dtype=np.float64) + 180) / 360 * scale
+    y = (1 - np.log(np.tan(lats) + 1 / np.cos(lats)) / np.pi) / 2 * scale
+    return x, y
+
 
-def save_map(map, html_fn, png_fn, html_dir='maps', delay=3):
+def render_static_map(map, png_fn, size=(1024, 768), tiles=False, background='#e8e8e8', supersample=2,
+                      tile_workers=8):
     '''
-    Uses the Selenium driver (geckodriver.exe) to save the rendered folium map
-    as a png image
+    Draws the circle markers and markers of a folium map to a png image with Pillow
+    instead of a browser, centered and zoomed like the map. The background is a
+    plain color unless tiles is True, in which case the map's tile layer is
+    downloaded with http_get, through the shared session unless pooling is off,
+    and drawn underneath
+
+    Keyword Arguments:
+    map -- The folium map to draw
+    png_fn -- The PNG filename, including path, to save the image as
+    size -- The (width, height) of the image in pixels. Default is (1024, 768)
+    tiles -- Whether to draw the map tiles underneath. Default is False
+    background -- The background color where there are no tiles. Default is '#e8e8e8'
+    supersample -- How many times larger to draw before scaling down, which
+                   smooths the edges of the markers. Default is 2
+    tile_workers -- The maximum number of tiles to download at once. Default is 8
+    '''
+    try:
+        from PIL import Image, ImageDraw, ImageColor
+    except ImportError:
+        raise ImportError('render_static_map requires Pillow')
+    import requests
+    logger = logging.getLogger('capstoneutils.render_static_map')
+    zoom = map.options.get('zoom', map.options.get('zoomStart', 10))
+    width, height = size[0] * supersample, size[1] * supersample
+    cx, cy = mercator_pixels([map.location[0]], [map.location[1]], zoom)
+    left, top = cx[0] - size[0] / 2, cy[0] - size[1] / 2
+    img = Image.new('RGB', size, background)
+    
+    layers = list(map._children.values())
+    if tiles:
+        templates = [layer.tiles for layer in layers if type(layer).__name__ == 'TileLayer']
+        if templates:
+            template = templates[0].replace('{s}', 'a').replace('{r}', '')
+            coords = [(tx, ty) for tx in range(int(left // 256), int((left + size[0]) // 256) + 1)
+                      for ty in range(int(top // 256), int((top + size[1]) // 256) + 1)]
+            
+            def fetch_tile(coord):
+                try:
+                    response = http_get(template.format(z=zoom, x=coord[0], y=coord[1]))
+                    response.raise_for_status()
+                    return Image.open(io.BytesIO(response.content)).convert('RGB')
+                except (requests.exceptions.RequestException, OSError) as e:
+                    logger.warning('Could not load tile {},{}: {}'.format(coord[0], coord[1], e))
+                    return None
+            
+            for (tx, ty), tile in zip(coords, iter_map(fetch_tile, coords, tile_workers)):
+                if tile is not None:
+                    img.paste(tile, (int(tx * 256 - left), int(ty * 256 - top)))
+    img = img.resize((width, height))
     
+    # Draw the markers in the order they were added, blending their colors
+    draw = ImageDraw.Draw(img, 'RGBA')
+    for layer in layers:
+        kind = type(layer).__name__
+        if kind not in ('CircleMarker', 'Marker'):
+            continue
+        x, y = mercator_pixels([layer.location[0]], [layer.location[1]], zoom)
+        x, y = (x[0] - left) * supersample, (y[0] - top) * supersample
+        if kind == 'Marker':
+            r = 6 * supersample
+            draw.polygon([(x, y), (x - r, y - 2 * r), (x + r, y - 2 * r)], fill='#2a81cb')
+            draw.ellipse([x - r, y - 3 * r, x + r, y - r], fill='#2a81cb', outline='#3274a3')
+            continue
+        options = layer.options
+        r = options.get('radius', 10) * supersample
+        box = [x - r, y - r, x + r, y + r]
+        color = ImageColor.getrgb(options.get('color', '#3388ff'))[:3]
+        if options.get('fill', True):
+            fill = ImageColor.getrgb(options.get('fillColor') or options.get('color', '#3388ff'))[:3]
+            draw.ellipse(box, fill=fill + (int(255 * options.get('fillOpacity', 0.2)),))
+        if options.get('stroke', True):
+            draw.ellipse(box, outline=color + (int(255 * options.get('opacity', 1.0)),),
+                         width=max(1, int(round(options.get('weight', 3) * supersample))))
+    
+    if supersample > 1:
+        img = img.resize(size, Image.LANCZOS)
+    img.save(png_fn)
+
+
+def foursquare_ok(text):
+    '''
+    Returns whether a raw Foursquare API response reports success, used to decide
+    whether the response can be cached
+
     Keyword Arguments:
-    map -- The rendered folium map to save
-    html_fn -- The HTML filename to use when saving the rendered map
-    png_fn -- The PNG filename, including path, to use when saving the image
-    html_dir -- A subdirectory to use when saving the HTML. Default is 'maps'
-    delay -- The number of seconds to sleep to allow Selenium to capture
+    text -- The body of the response
     '''
-    # Save the map as an HTML file
-    tmpurl = 'file://{cwd}/{subdir}/{file}'.format(cwd=os.getcwd(), subdir=html_dir, file=html_fn)
-    map.save('{cwd}/{subdir}/{file}'.format(cwd=os.getcwd(), subdir=html_dir, file=html_fn))
-     
-    # Open a browser window that displays the map, wait for it to load
-    # then grab a screenshot
-    browser = webdriver.Firefox()
-    browser.get(tmpurl)
-    sleep(delay)
-    browser.save_screenshot(png_fn)
-    browser.quit()    
+    return json.loads(text)['meta']['code'] == 200
 
 
 def add_categories(cats, r):
@@ -80,6 +1566,7 @@ def add_categories(cats, r):
     cats -- Json array of categories from the Foursquare API
     r -- Current node in which to add children, if any
     '''
+    from anytree import Node
     for cat in cats:
         n = Node(name=cat['id'], parent=r, descr=cat['name'])
         if len(cat['categories']) > 0:
@@ -88,55 +1575,96 @@ def add_categories(cats, r):
     return n 
 
 
+@instrumented()
 def get_category_tree(trycount=0):
     '''
     Utilizes the Foursquare API to return their tree of categories. This method
     uses anytree and returns a root node with all the hierarchy of categories
     listed on https://developer.foursquare.com/docs/resources/categories
-    
+
     Keyword Arguments:
-    trycount -- the count of current tries, for retry. Default is 0
+    trycount -- Ignored, kept so older callers still work. Retries are made by
+                fetch. Default is 0
     '''
-    logger = logging.getLogger('capstoneutils.get_category_tree')
     VERSION = '20190101'
     
     # Retrieve the categories from Foursquare  
-    url = 'https://api.foursquare.com/v2/venues/categories?client_id={}&client_secret={}&v={}'.format(
-        rg.CLIENT_ID, 
-        rg.CLIENT_SECRET, 
+    url = '{}/venues/categories?client_id={}&client_secret={}&v={}'.format(
+        FOURSQUARE_URL,
+        get_secrets().CLIENT_ID, 
+        get_secrets().CLIENT_SECRET, 
         VERSION)
     
-    result = requests.get(url).json()
-    if (result['meta']['code'] != 200 and trycount < 5):
-        sleep(0.5)
-        t = trycount + 1
-        logger.warning('Retrying Foursquare CATEGORY due to failure. Trycount={}'.format(t))
-        return get_category_tree(trycount=t)
-    
+    from anytree import Node
+    result = json.loads(cached_get(url, 'categories', is_valid=foursquare_ok))
     cats = result['response']['categories']
     root = Node('root')
     add_categories(cats, root)
+    index_categories(root)
     return root
 
 
+def index_categories(tree):
+    '''
+    Walks the category tree once and stores a flat index on the root node that maps
+    each category id to its top-level ancestor, so that classifying a venue is a
+    dictionary lookup rather than a search of the whole tree. The index is kept in
+    attributes of the root: top_parents (id to node), top_descrs (id to the
+    top-level category name) and top_descrs_series, the same as a Series
+
+    Keyword Arguments:
+    tree -- The root of the anytree tree built by add_categories
+    '''
+    from anytree import PreOrderIter
+    top_parents = {}
+    for node in PreOrderIter(tree):
+        if node.is_root:
+            continue
+        # The path starts at the root, so the node just under it is the top-level
+        # category. Keep the first match in case an id appears more than once, which
+        # is what the search used to return
+        top_parents.setdefault(node.name, node.path[1])
+    
+    tree.top_parents = top_parents
+    tree.top_descrs = {name: node.descr for name, node in top_parents.items()}
+    # Mapping with a dictionary turns it into a Series on every call, which costs
+    # more than the lookups themselves when classifying a zip code at a time
+    tree.top_descrs_series = pd.Series(tree.top_descrs, dtype=object)
+    return tree
+
+
 def get_top_parent(tree, name):
     '''
-    Searches the given anytree tree for a node with the given name and returns
-    the ancestor just under root, which would be the top-level category from
-    Foursquare categories https://developer.foursquare.com/docs/resources/categories
+    Looks up the node with the given name in the tree's index and returns the
+    ancestor just under root, which would be the top-level category from
+    Foursquare categories https://developer.foursquare.com/docs/resources/categories.
+    The index is built on first use if the tree doesn't have one yet
     
     Keyword Arguments:
     tree -- The anytree tree to search for the top parent
     name -- The name to search the tree for
     '''
-    node = search.findall(tree, filter_ = lambda node:  node.name == name)[0]
-    if len(node.ancestors) == 1:
-        # This is already a top-level candidate so return it
-        return node
-    else:
-        return node.ancestors[1]
+    if getattr(tree, 'top_parents', None) is None:
+        index_categories(tree)
+    return tree.top_parents[name]
 
 
+def get_top_descrs(tree, names):
+    '''
+    Returns a Series with the top-level category name for each of the given
+    category ids, looked up in one pass through the tree's index. Ids that are
+    not in the tree are returned as NaN
+
+    Keyword Arguments:
+    tree -- The anytree tree built by get_category_tree
+    names -- A sequence of category ids to classify
+    '''
+    if getattr(tree, 'top_descrs_series', None) is None:
+        index_categories(tree)
+    return pd.Series(names, dtype=object).map(tree.top_descrs_series)
+
+
+@instrumented()
 def scrape_zipcodes(page_dict):
     '''
     Scrapes the zip code list located on zip-codes.com for the city and county of
@@ -145,10 +1673,11 @@ def scrape_zipcodes(page_dict):
     Keyword Arguments:
     page_dict -- a dictionary containing the url (key) and list of cities to scrape
     '''
+    from bs4 import BeautifulSoup
     l = []
 
     for url, cities in page_dict.items():
-        zips_raw = requests.get(url).text
+        zips_raw = cached_get(url, 'zipcodes')
         soup = BeautifulSoup(zips_raw, 'lxml')
 
         # On the page, the data we want is located in a table with class 'statTable'.
@@ -167,191 +1696,1011 @@ def scrape_zipcodes(page_dict):
     return pd.DataFrame(l, columns=['ZipCode'])
 
 
-def scrape_demographics(zipcode, prefix='colorado', missingZip='80202'):
+# XPath expressions for the hometownlocator demographics pages, which are compiled
+# by demographics_xpaths the first time a page is parsed
+DEMOGRAPHICS_DIVS = "//div[contains(concat(' ', normalize-space(@class), ' '), ' halfcontentpadded ')]"
+FIRST_TABLE_ROWS = '(.//table)[1]//tr'
+ROW_CELLS = './/td'
+CELL_LABEL = 'string((.//span)[1])'
+
+@functools.lru_cache(maxsize=None)
+def demographics_xpaths():
+    '''
+    Returns the compiled XPath expressions used by parse_demographics, in the order
+    DEMOGRAPHICS_DIVS, FIRST_TABLE_ROWS, ROW_CELLS, CELL_LABEL
+    '''
+    from lxml import etree
+    return tuple(etree.XPath(path) for path in (DEMOGRAPHICS_DIVS, FIRST_TABLE_ROWS, ROW_CELLS, CELL_LABEL))
+
+def parse_demographics(html, zipcode):
+    '''
+    Extracts the demographic information from a hometownlocator zip code page, or
+    returns None if the page doesn't have any. Rather than building a full soup,
+    the page is parsed once by lxml and only the two tables we need are visited
+    with precompiled XPath expressions
+    
+    Keyword Arguments:
+    html -- The text of the page
+    zipcode -- The zip code the page is for
+    '''
+    # On this page the data we are looking for is in two divs both with a class 
+    # of 'halfcontentpadded'. Each div contains a table with a header row that
+    # has colspan of 2 and then tr's with two td's the first with a span that
+    # holds the label and the second holding the actual data. Overall this will
+    # build out a demographics dataframe of 20 columns
+    import lxml.html
+    from fastnumbers import fast_real
+    find_divs, find_rows, find_cells, cell_label = demographics_xpaths()
+    divs = find_divs(lxml.html.fromstring(html))
+    if (len(divs) < 3):
+        return None
+    
+    data = {"ZipCode": zipcode}
+    for div in divs[1:3]:
+        for row in find_rows(div):
+            cells = find_cells(row)
+            if not cells or cells[0].get('colspan') is not None:
+                continue
+            key = cell_label(cells[0]).strip()
+            value = clean_value(cells[1].text_content().strip())
+            data[key] = fast_real(value)
+    
+    return data
+
+
+@instrumented()
+def scrape_demographics(zipcode, prefix='colorado', missingZip='80202', missingPrefix='colorado'):
+    '''
+    Scrapes demographic information for a zip code from hometownlocator
+
+    Keyword Arguments:
+    zipcode -- The zip code to scrape
+    prefix -- The state in which the zip code is located. Default is colorado
+    missingZip -- If demographic data is not found, which zip code to use instead 
+    missingPrefix -- The state in which missingZip is located. Default is colorado
+    '''
+    demo_raw = cached_get(DEMOGRAPHICS_URL.format(prefix, zipcode), 'demographics')
+    data = parse_demographics(demo_raw, zipcode)
+    
+    # There isn't demographic data available for all the zip codes. From inspection,
+    # the site we are using for demographics suggests 80202 for all the ones that
+    # are missing, so we use that data instead. Note that this will result in duplicates
+    # which are easily removed later. The fallback is only scraped once.
+    if data is None:
+        return dict(scrape_fallback_demographics(missingZip, missingPrefix))
+    
+    # Return the dictionary of values
+    return data
+
+
+# The scrapes of the zip codes used in place of ones without demographic data, as
+# a future for each (zip code, state) so that threads missing at the same time
+# all wait on the one scrape
+fallback_demographics = {}
+fallback_demographics_lock = threading.Lock()
+
+def scrape_fallback_demographics(zipcode, prefix='colorado'):
+    '''
+    Memoized scrape of the zip code used in place of ones without demographic data.
+    The page is only fetched once even when many threads ask for it at the same
+    time, and a failed scrape is tried again by the next caller. Raises a
+    ValueError if the fallback zip code's own page has no demographic data.
+    Callers should copy the result before changing it
+
+    Keyword Arguments:
+    zipcode -- The zip code to scrape
+    prefix -- The state in which the zip code is located. Default is colorado
+    '''
+    key = (zipcode, prefix)
+    with fallback_demographics_lock:
+        future = fallback_demographics.get(key)
+        owner = future is None
+        if owner:
+            future = fallback_demographics[key] = Future()
+    if owner:
+        try:
+            # Parsed here rather than through scrape_demographics, which would fall
+            # back to this same page again when it has no data
+            data = parse_demographics(cached_get(DEMOGRAPHICS_URL.format(prefix, zipcode), 'demographics'), zipcode)
+            if data is None:
+                raise ValueError('The fallback zip code {} in {} has no demographic data'.format(zipcode, prefix))
+            future.set_result(data)
+        except Exception as e:
+            with fallback_demographics_lock:
+                del fallback_demographics[key]
+            future.set_exception(e)
+    return future.result()
+
+def clear_fallback_demographics():
+    '''
+    Forgets the memoized scrapes of scrape_fallback_demographics
+    '''
+    with fallback_demographics_lock:
+        fallback_demographics.clear()
+
+
+def scrape_demographics_many(zipcodes, prefixes, max_workers=1, missingZip='80202', missingPrefix='colorado'):
+    '''
+    Generator that scrapes the demographics for each zip code and yields the
+    results in input order as they arrive, with up to max_workers requests at once
+
+    Keyword Arguments:
+    zipcodes -- A sequence of zip codes to scrape
+    prefixes -- A sequence of the state for each zip code
+    max_workers -- The maximum number of concurrent requests. Default is 1 (serial)
+    missingZip -- If demographic data is not found, which zip code to use instead
+    missingPrefix -- The state in which missingZip is located. Default is colorado
+    '''
+    yield from iter_map(lambda z: scrape_demographics(z[0], z[1], missingZip, missingPrefix),
+                        list(zip(zipcodes, prefixes)), max_workers)
+
+
+@instrumented()
+def scrape_franchises():
+    '''
+    Scrapes the wikipedia page with the list of coffee franchises. The data is in the first
+    table with the wikitable sortable style. This code pulls out just the first column.
+    '''
+    url = FRANCHISES_URL
+    df_cols = ['Name']
+
+    try:
+        from bs4 import BeautifulSoup
+        html_raw = cached_get(url, 'franchises')
+        soup = BeautifulSoup(html_raw, 'lxml')
+        table = soup.find('table', {'class': ['wikitable', 'sortable', 'jquery-sortable']})
+        rows = table.find_all('tr')
+        l = []
+        for row in rows:
+            td = row.find_all('td')
+            cells = [cell for cell in td]
+            if len(cells) > 0:
+                l.append(cells[0].find('a').get_text())
+        return pd.DataFrame(l, columns=df_cols)
+
+    except:
+        return pd.DataFrame(columns=df_cols)
+
+# Geocoded places are kept in the checkpoint store, so a place is only sent to
+# Google once. In offline mode nothing is requested: zip codes come from a local
+# table of zip code centroids, such as the Census Gazetteer ZCTA file, and other
+# places must already be in the store
+GEOCODE_OFFLINE = False
+ZIP_CENTROIDS_FILE = './zip_centroids.csv'
+
+place_latlons = None
+place_latlons_store = None
+zip_centroids = None
+zip_centroids_path = None
+geocode_lock = threading.Lock()
+
+
+def normalize_place(place):
+    '''
+    Returns the key a place is cached under, so that differences in case and
+    spacing don't cause the same place to be geocoded twice
+
+    Keyword Arguments:
+    place -- The place to normalize
+    '''
+    return ' '.join(str(place).split()).upper()
+
+
+def get_place_latlons():
+    '''
+    Returns the in-memory copy of the geocoded places, a dictionary of normalized
+    place to (updated, [lat, lon]), loading it from the checkpoint store on first use
+    '''
+    global place_latlons, place_latlons_store
+    store = get_checkpoints()
+    with geocode_lock:
+        if place_latlons is None or place_latlons_store is not store:
+            place_latlons = store.load('places')
+            place_latlons_store = store
+        return place_latlons
+
+
+def load_zip_centroids(path=None):
+    '''
+    Returns the zip code centroid table as a DataFrame of Latitude and Longitude
+    indexed by ZipCode, reading it on first use. The file can be a csv with ZipCode,
+    Latitude and Longitude columns or the tab separated Census Gazetteer ZCTA file
+    with GEOID, INTPTLAT and INTPTLONG columns
+
+    Keyword Arguments:
+    path -- The file to read. Default is ZIP_CENTROIDS_FILE
+    '''
+    global zip_centroids, zip_centroids_path
+    path = path or ZIP_CENTROIDS_FILE
+    with geocode_lock:
+        if zip_centroids is None or zip_centroids_path != path:
+            with open(path) as f:
+                sep = '\t' if '\t' in f.readline() else ','
+            table = pd.read_csv(path, sep=sep, dtype={'GEOID': str, 'ZipCode': str})
+            table.columns = table.columns.str.strip()
+            table = table.rename(columns={'GEOID': 'ZipCode', 'INTPTLAT': 'Latitude', 'INTPTLONG': 'Longitude'})
+            zip_centroids = table.set_index('ZipCode')[['Latitude', 'Longitude']].astype(np.float64)
+            zip_centroids_path = path
+        return zip_centroids
+
+
+def save_zip_centroids(df, path=None):
+    '''
+    Writes the ZipCode, Latitude and Longitude columns of a DataFrame, for example
+    the stored demographics, as a zip code centroid table for offline geocoding
+
+    Keyword Arguments:
+    df -- The DataFrame with ZipCode, Latitude and Longitude columns
+    path -- The file to write. Default is ZIP_CENTROIDS_FILE
+    '''
+    global zip_centroids
+    df[['ZipCode', 'Latitude', 'Longitude']].drop_duplicates('ZipCode').to_csv(path or ZIP_CENTROIDS_FILE, index=False)
+    zip_centroids = None
+
+
+# Google geocoding statuses that are worth trying again. Any other status besides
+# OK, such as ZERO_RESULTS for an unknown place, is the same however often it is
+# requested
+GEOCODE_RETRY_STATUSES = {'OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'}
+
+def geocode_ok(text):
+    '''
+    Returns whether a raw Google geocoding response has a location, or False if
+    it is worth trying again. Raises UnusableResponse for other failures
+
+    Keyword Arguments:
+    text -- The body of the response
+    '''
+    response = json.loads(text)
+    status = response.get('status')
+    if status == 'OK' and len(response.get('results', [])) > 0:
+        return True
+    if status in GEOCODE_RETRY_STATUSES:
+        return False
+    raise UnusableResponse('Geocoding failed with {}{}'.format(
+        status, ': ' + response['error_message'] if 'error_message' in response else ''))
+
+
+@instrumented()
+def fetch_place_latlon(place):
+    '''
+    Uses the Google API to retrieve location information, without the geocode cache.
+    Note that the API key has been scrubbed
+
+    Keyword Arguments:
+    place -- The place to geolocate
+    '''
+    url = '{}?address={}&key={}'.format(
+        GEOCODE_URL,
+        urllib.parse.quote_plus(place),
+        get_secrets().GOOGLE_API_KEY
+    )
+    
+    response = json.loads(cached_get(url, 'geocode', is_valid=geocode_ok))
+    latlon = response['results'][0]['geometry']['location']
+    return [latlon['lat'], latlon['lng']]
+
+
+@instrumented()
+def geocode_places(places, max_workers=1, offline=None, max_age=None):
+    '''
+    Geocodes a batch of places, returning an array with a row of latitude and
+    longitude for each. Places already in the geocode cache are not requested
+    again, each distinct place is only looked up once, and the rest are requested
+    with up to max_workers at once and added to the cache. In offline mode zip
+    codes missing from the cache are looked up in the zip code centroid table and
+    a KeyError is raised for any place that can't be found without the network
+
+    Keyword Arguments:
+    places -- A sequence of places, such as zip codes or 'Denver, CO, USA'
+    max_workers -- The maximum number of concurrent requests. Default is 1 (serial)
+    offline -- Whether to avoid the network. Default is GEOCODE_OFFLINE
+    max_age -- The age in seconds after which a cached place is requested again,
+               or None to keep them forever. Default is None
+    '''
+    offline = GEOCODE_OFFLINE if offline is None else offline
+    keys = [normalize_place(place) for place in places]
+    cached = get_place_latlons()
+    found = {}
+    missing = {}
+    for place, key in zip(places, keys):
+        if key in found or key in missing:
+            continue
+        checkpoint = cached.get(key)
+        if not is_stale(checkpoint, None if offline else max_age):
+            found[key] = checkpoint[1]
+        else:
+            missing[key] = str(place).strip()
+    
+    if missing and offline:
+        table = load_zip_centroids()
+        zips = [key for key in missing if key in table.index]
+        found.update(zip(zips, table.loc[zips].to_numpy().tolist()))
+        unknown = [place for key, place in missing.items() if key not in found]
+        if unknown:
+            raise KeyError('Cannot geocode {} places offline, such as {}'.format(len(unknown), unknown[0]))
+    elif missing:
+        store = get_checkpoints()
+        for key, latlon in zip(missing, iter_map(fetch_place_latlon, list(missing.values()), max_workers)):
+            store.put('places', key, latlon)
+            with geocode_lock:
+                cached[key] = (time(), latlon)
+            found[key] = latlon
+    
+    return np.array([found[key] for key in keys], dtype=np.float64).reshape(-1, 2)
+
+
+@instrumented()
+def get_place_latlon(place, trycount=0):
+    '''
+    Uses the Google API to retrieve location information, through the geocode cache.
+    Note that the API key has been scrubbed
+
+    Keyword Arguments:
+    place -- The place to geolocate
+    trycount -- Ignored, kept so older callers still work. Retries are made by
+                fetch. Default is 0
+    '''
+    return geocode_places([place])[0].tolist()
+
+
+def get_latlon(x):
+    '''
+    Uses the Google API to retrieve location information. Note that the API key has been scrubbed
+
+    Keyword Arguments:
+    x -- The row containing the ZipCode to geolocate, must be a string zip code
+    '''
+    return get_place_latlon(x['ZipCode'])
+
+
+# The number of calls per worker iter_map starts ahead of the results taken
+ITER_MAP_AHEAD = 4
+
+def iter_map(func, items, max_workers=1):
+    '''
+    Generator that applies func to each item and yields the results in input order.
+    When max_workers is greater than one the calls are made concurrently using a
+    bounded pool of threads, which suits functions that mostly wait on the network.
+    Only a few calls per worker are started ahead of the results that have been
+    taken, so items can be a lazy iterable and results that are waiting to be
+    taken never pile up
+
+    Keyword Arguments:
+    func -- The function to call with each item
+    items -- An iterable of items
+    max_workers -- The maximum number of concurrent calls. Default is 1 (serial)
+    '''
+    # Make sure each worker can hold on to its own connection
+    ensure_pool_size(max_workers)
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # Futures are handed back oldest first, so results come out in input order
+    # regardless of which call finishes first
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= ITER_MAP_AHEAD * max_workers:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def explored_rows(result):
+    '''
+    Returns the number of venues in a raw Foursquare explore response
+
+    Keyword Arguments:
+    result -- The response from explore_location or explore_tiled
+    '''
+    return sum(len(group['items']) for group in result.get('response', {}).get('groups', []))
+
+
+@instrumented(rows=explored_rows)
+def explore_location(lat, lon, limit=100, section=None, trycount=0, radius=None):
+    '''
+    Utilizes the Foursquare API to return top 100 venues near the given coordinates
+
+    Keyword Arguments:
+    lat -- the latitude of the location
+    lon -- the longitude of the location
+    limit -- The optional limit on the number of results. Default is 100
+    section -- The optional Foursquare section to explore. Default is None
+    trycount -- Ignored, kept so older callers still work. Retries are made by
+                fetch. Default is 0
+    radius -- The optional radius in meters to search within, otherwise the API
+              suggests one. Default is None
+    '''
+    VERSION = '20190101'
+    
+    # Get the top venues around the location from the Foursquare API. Without a radius
+    # the API suggests one based on the density of venues in the area; explore_tiled
+    # passes one so that each tile covers its own square
+    url = '{}/venues/explore?client_id={}&client_secret={}&v={}&ll={},{}&limit={}'.format(
+        FOURSQUARE_URL,
+        get_secrets().CLIENT_ID, 
+        get_secrets().CLIENT_SECRET, 
+        VERSION, 
+        lat, 
+        lon, 
+        limit)
+    
+    if section:
+        url = url + '&section={}'.format(section)
+    if radius:
+        url = url + '&radius={:.0f}'.format(radius)
+    
+    return json.loads(cached_get(url, 'explore', is_valid=foursquare_ok))
+
+
+# Meters per degree of latitude, for laying out explore tiles
+METERS_PER_DEGREE = 111320.0
+
+@instrumented(rows=explored_rows)
+def explore_tiled(lat, lon, half_size=1500, limit=100, section=None, max_depth=6, max_workers=1):
+    '''
+    Explores the square of half_size meters either side of the given coordinates
+    as a quadtree of tiles, so that dense areas aren't cut off by the explore limit.
+    Each tile is requested with the radius of the circle around it. A tile whose
+    response is saturated, returning as many venues as the limit, is split and its
+    quarters are requested, going down as many levels at once as the response's
+    totalResults says are needed. A tile that isn't saturated already holds every
+    venue in it, so sparse areas cost a single request and dense ones only
+    subdivide where they need to. Each round of tiles is requested together, up to
+    max_workers at once.
+
+    Venues are deduplicated by their Foursquare id across the overlapping tiles and
+    those outside the square are dropped. The result has the same shape as an
+    explore response, so it can be passed to venues_frame
+
+    Keyword Arguments:
+    lat -- The latitude of the center of the area
+    lon -- The longitude of the center of the area
+    half_size -- Half the width of the square area in meters. Default is 1500
+    limit -- The limit on the number of results for each tile. Default is 100
+    section -- The optional Foursquare section to explore. Default is None
+    max_depth -- The most times a tile is split. Default is 6
+    max_workers -- The maximum number of concurrent requests. Default is 1 (serial)
+    '''
+    logger = logging.getLogger('capstoneutils.explore_tiled')
+    m_lat = 1 / METERS_PER_DEGREE
+    m_lon = 1 / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    venues = {}
+    requests_made = 0
+    deepest = 0
+    tiles = [(lat, lon, half_size, 0)]
+    while tiles:
+        results = iter_map(lambda t: explore_location(t[0], t[1], limit=limit, section=section,
+                                                      radius=t[2] * np.sqrt(2)), tiles, max_workers)
+        split = []
+        for (t_lat, t_lon, t_half, depth), result in zip(tiles, results):
+            requests_made += 1
+            deepest = max(deepest, depth)
+            items = result['response']['groups'][0]['items']
+            for item in items:
+                venues.setdefault(item['venue']['id'], item)
+            total = result['response'].get('totalResults', len(items))
+            if len(items) < limit and total <= len(items):
+                continue
+            if depth == max_depth:
+                logger.warning('Tile at {},{} around {},{} is still saturated at depth {}'.format(
+                    t_lat, t_lon, lat, lon, depth))
+                continue
+            # When the response says how many venues the tile holds, skip straight to
+            # the level where the quarters should fit under the limit, rather than
+            # requesting every level in between
+            levels = max(1, int(np.ceil(np.log(max(total, 1) / limit) / np.log(4))))
+            levels = min(levels, max_depth - depth)
+            split.append((t_lat, t_lon, t_half, depth, levels))
+        tiles = []
+        for t_lat, t_lon, t_half, depth, levels in split:
+            n = 2 ** levels
+            child = t_half / n
+            offsets = (np.arange(n) * 2 + 1 - n) * child
+            tiles.extend((t_lat + dy * m_lat, t_lon + dx * m_lon, child, depth + levels)
+                         for dy in offsets for dx in offsets)
+    
+    items = [item for item in venues.values()
+             if abs(item['venue']['location']['lat'] - lat) <= half_size * m_lat
+             and abs(item['venue']['location']['lng'] - lon) <= half_size * m_lon]
+    logger.debug('Explored {} venues around {},{} with {} requests'.format(len(items), lat, lon, requests_made))
+    return {'meta': {'code': 200, 'requests': requests_made, 'depth': deepest},
+            'response': {'groups': [{'items': items}]}}
+
+
+def explore_locations(latitudes, longitudes, section=None, max_workers=1):
+    '''
+    Calls explore_location for each pair of coordinates and returns the list of
+    raw results in the same order as the coordinates were given. When max_workers
+    is greater than one the requests are made concurrently using a bounded pool
+    of threads, since nearly all the time is spent waiting on the network
+
+    Keyword Arguments:
+    latitudes -- A sequence of latitudes to lookup
+    longitudes -- A sequence of longitudes to lookup
+    section -- The optional Foursquare section to explore. Default is None
+    max_workers -- The maximum number of concurrent requests. Default is 1 (serial)
+    '''
+    return list(iter_explore_locations(latitudes, longitudes, section, max_workers))
+
+
+def iter_explore_locations(latitudes, longitudes, section=None, max_workers=1):
+    '''
+    Generator version of explore_locations that yields each raw result, in input
+    order, as soon as it and every result before it have arrived
+
+    Keyword Arguments:
+    latitudes -- A sequence of latitudes to lookup
+    longitudes -- A sequence of longitudes to lookup
+    section -- The optional Foursquare section to explore. Default is None
+    max_workers -- The maximum number of concurrent requests. Default is 1 (serial)
+    '''
+    coords = list(zip(latitudes, longitudes))
+    yield from iter_map(lambda c: explore_location(c[0], c[1], section=section), coords, max_workers)
+
+
+@instrumented()
+def get_nearby_venues(rownames, latitudes, longitudes, section=None, max_workers=1, half_size=None, store=None):
+    '''
+    Uses the Foursquare API to get the top 100 venues near the given coordinates,
+    or with half_size set every venue in the square around each one using
+    explore_tiled. With a VenueStore the venues are added to the store, so only
+    the ones it hasn't seen are classified, and the frame is built from it
+
+    Keyword Arguments:
+    names -- A sequence of names intended to help later identify rows
+    latitudes -- A sequence of latitudes to lookup
+    longitudes -- A sequence of longitudes to lookup
+    section -- The optional Foursquare section to explore. Default is None
+    max_workers -- The maximum number of concurrent explore requests. Default is 1
+    half_size -- Half the width in meters of the square to explore with tiles, or
+                 None for a single request per location. Default is None
+    store -- The VenueStore to add the venues to, e.g. get_venue_store(), or None.
+             Default is None
+    '''
+    category_tree = get_category_tree()
+    
+    # Materialize the inputs since they are walked twice, once for the requests
+    # and once to build the rows
+    rownames, latitudes, longitudes = list(rownames), list(latitudes), list(longitudes)
+    if half_size:
+        explored = list(iter_map(lambda c: explore_tiled(c[0], c[1], half_size, section=section),
+                                 list(zip(latitudes, longitudes)), max_workers))
+    else:
+        explored = explore_locations(latitudes, longitudes, section=section, max_workers=max_workers)
+    
+    if store is not None:
+        store.add(rownames, latitudes, longitudes, explored, category_tree, section)
+        return store.frame(rownames, section)
+    return venues_frame(rownames, latitudes, longitudes, explored, category_tree)
+
+
+def iter_nearby_venues(rownames, latitudes, longitudes, section=None, max_workers=1, half_size=None, batch_size=1,
+                       store=None):
     '''
-    Scrapes demographic information for a zip code from hometownlocator
+    Generator version of get_nearby_venues that yields a venue frame for each row
+    name, or for each batch_size of them, in input order as soon as their
+    responses have arrived. The raw responses are turned into a frame and let go
+    before the next batch is taken, so memory is bounded by a batch and the
+    requests in flight rather than the whole run. The inputs can be lazy iterables
 
     Keyword Arguments:
-    zipcode -- The zip code to scrape
-    prefix -- The state in which the zip code is located. Default is colorado
-    missingZip -- If demographic data is not found, which zip code to use instead 
+    rownames -- An iterable of names intended to help later identify rows
+    latitudes -- An iterable of latitudes to lookup
+    longitudes -- An iterable of longitudes to lookup
+    section -- The optional Foursquare section to explore. Default is None
+    max_workers -- The maximum number of concurrent explore requests. Default is 1
+    half_size -- Half the width in meters of the square to explore with tiles, or
+                 None for a single request per location. Default is None
+    batch_size -- The number of row names in each frame. Larger batches spread the
+                  cost of building a frame over more venues. Default is 1
+    store -- The VenueStore to add the venues to, or None. See get_nearby_venues.
+             Default is None
     '''
-    demo_raw = requests.get('https://{}.hometownlocator.com/zip-codes/data,zipcode,{}.cfm'.format(prefix, zipcode)).text
-
-    soup = BeautifulSoup(demo_raw, 'lxml')
-    
-    # On this page the data we are looking for is in two divs both with a class 
-    # of 'halfcontentpadded'. Each div contains a table with a header row that
-    # has colspan of 2 and then tr's with two td's the first with a span that
-    # holds the label and the second holding the actual data. Overall this will
-    # build out a demographics dataframe of 20 columns
-    data = {"ZipCode": zipcode}
-    divs = soup.findAll('div', {"class": "halfcontentpadded"})
+    category_tree = get_category_tree()
     
-    # There isn't demographic data available for all the zip codes. From inspection,
-    # the site we are using for demographics suggests 80202 for all the ones that
-    # are missing, so we use that data instead. Note that this will result in duplicates
-    # which are easily removed later.
-    if (len(divs) < 3):
-        return scrape_demographics(missingZip)
+    def explore(place):
+        name, lat, lng = place
+        if half_size:
+            return explore_tiled(lat, lng, half_size, section=section)
+        return explore_location(lat, lng, section=section)
     
-    for i in [1,2]:
-        div = divs[i]
-        rows = div.find('table').findAll('tr')
-        for row in rows:
-            cells = row.findAll('td')
-            if not cells or cells[0].has_attr('colspan'):
-                continue
-            key = cells[0].find('span').get_text().strip()
-            value = clean_value(cells[1].get_text().strip())
-            data[key] = fast_real(value)
+    def frame(batch):
+        names, lats, lngs = zip(*(place for place, _ in batch))
+        if store is not None:
+            store.add(names, lats, lngs, [result for _, result in batch], category_tree, section)
+            return store.frame(names, section)
+        return venues_frame(names, lats, lngs, [result for _, result in batch], category_tree)
     
-    # Return the dictionary of values
-    return data
+    places = zip(rownames, latitudes, longitudes)
+    batch = []
+    # Pair each result with its place, since iter_map consumes the places lazily
+    for place, result in iter_map(lambda p: (p, explore(p)), places, max_workers):
+        batch.append((place, result))
+        if len(batch) >= batch_size:
+            yield frame(batch)
+            batch = []
+    if batch:
+        yield frame(batch)
 
 
-def scrape_franchises():
+# The number of row names store_nearby_venues builds each frame from, a few
+# thousand venues, which keeps both the batches and the cost per venue small
+STREAM_BATCH_SIZE = 32
+
+@instrumented(rows=lambda rows: rows)
+def store_nearby_venues(rownames, latitudes, longitudes, name='fsq_venues', section=None, max_workers=1,
+                        half_size=None, batch_size=STREAM_BATCH_SIZE, store=None):
     '''
-    Scrapes the wikipedia page with the list of coffee franchises. The data is in the first
-    table with the wikitable sortable style. This code pulls out just the first column.
+    Streams the venues for each row name from iter_nearby_venues into the stored
+    dataset with a DatasetWriter, replacing the stored one, and returns the number
+    of venues stored. Peak memory is bounded by a row group of the dataset, so this
+    suits runs over too many zip codes to hold at once; read them back in parts
+    with read_dataset and its zipcodes and columns filters
+
+    Keyword Arguments:
+    rownames -- An iterable of names intended to help later identify rows
+    latitudes -- An iterable of latitudes to lookup
+    longitudes -- An iterable of longitudes to lookup
+    name -- The name of the dataset to store. Default is 'fsq_venues'
+    section -- The optional Foursquare section to explore. Default is None
+    max_workers -- The maximum number of concurrent explore requests. Default is 1
+    half_size -- Half the width in meters of the square to explore with tiles, or
+                 None for a single request per location. Default is None
+    batch_size -- The number of row names to build each frame from. Default is
+                  STREAM_BATCH_SIZE
+    store -- The VenueStore to add the venues to, or None. See get_nearby_venues.
+             Default is None
     '''
-    url = 'https://en.wikipedia.org/wiki/List_of_coffeehouse_chains'
-    df_cols = ['Name']
+    with DatasetWriter(name) as sink:
+        for batch in iter_nearby_venues(rownames, latitudes, longitudes, section, max_workers, half_size, batch_size,
+                                        store):
+            sink.append(batch)
+    return sink.rows
 
-    try:
-        html_raw = requests.get(url).text
-        soup = BeautifulSoup(html_raw, 'lxml')
-        table = soup.find('table', {'class': ['wikitable', 'sortable', 'jquery-sortable']})
-        rows = table.find_all('tr')
-        l = []
-        for row in rows:
-            td = row.find_all('td')
-            cells = [cell for cell in td]
-            if len(cells) > 0:
-                l.append(cells[0].find('a').get_text())
-        return pd.DataFrame(l, columns=df_cols)
 
-    except:
-        return pd.DataFrame(columns=df_cols)
+# Compact dtypes for the venue frames. The names repeat across venues, so they
+# are stored once as categories with small integer codes per row, and float32
+# keeps venue coordinates to within a meter
+VENUE_DTYPES = {
+    'ZipCode': 'category',
+    'Centroid Latitude': np.float32,
+    'Centroid Longitude': np.float32,
+    'Venue': 'category',
+    'Venue Latitude': np.float32,
+    'Venue Longitude': np.float32,
+    'Venue Main Category': 'category',
+    'Venue Top-Level Category': 'category',
+}
 
-def get_place_latlon(place, trycount=0):
+# Demographic columns that keep their full precision. The coordinates are used to
+# build explore requests, so rounding them would change the requests
+DEMOGRAPHIC_EXACT_COLUMNS = ['Latitude', 'Longitude']
+
+def compact_frame(df, dtypes):
     '''
-    Uses the Google API to retrieve location information. Note that the API key has been scrubbed
+    Converts the columns of a DataFrame that are listed in dtypes, in place, and
+    returns it. Categories are sorted, so sorting by their codes matches sorting by
+    the values
 
     Keyword Arguments:
-    place -- The place to geolocate
+    df -- The DataFrame to convert
+    dtypes -- A dictionary of column name to dtype, where 'category' makes the
+              column categorical
     '''
-    logger = logging.getLogger('capstoneutils.get_place_latlon')
-    url = 'https://maps.googleapis.com/maps/api/geocode/json?address={}&key={}'.format(
-        urllib.parse.quote_plus(place),
-        rg.GOOGLE_API_KEY
-    )
-    
-    response = requests.get(url).json()
-    
-    if len(response['results']) == 0 and trycount < 5:
-        sleep(.05)
-        t = trycount + 1
-        logger.warning('Retrying Google Maps GEOCODE due to failure. Trycount={}'.format(t))
-        return get_place_latlon(place, trycount=t)
-    
-    latlon = response['results'][0]['geometry']['location']
-    return [latlon['lat'], latlon['lng']]
+    for col, dtype in dtypes.items():
+        if col not in df or (df[col].dtype == dtype and dtype != 'category'):
+            continue
+        if dtype == 'category' and isinstance(df[col].dtype, pd.CategoricalDtype):
+            if not df[col].cat.categories.is_monotonic_increasing:
+                df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+        elif dtype == 'category':
+            codes, uniques = pd.factorize(df[col], sort=True)
+            df[col] = pd.Categorical.from_codes(codes, categories=pd.Index(np.asarray(uniques, dtype=object)))
+        else:
+            df[col] = df[col].astype(dtype)
+    # Strings read from Parquet are held by pyarrow's memory pool, and the ones
+    # factorized along the way by the C heap, and both keep the memory after they
+    # are converted unless asked to give it back
+    if 'category' in dtypes.values():
+        if get_parquet() is not None:
+            import pyarrow as pa
+            pa.default_memory_pool().release_unused()
+        if get_malloc_trim() is not None:
+            get_malloc_trim()(0)
+    return df
 
 
-def get_latlon(x):
+def compact_venues(df):
     '''
-    Uses the Google API to retrieve location information. Note that the API key has been scrubbed
+    Converts a venue frame to the compact VENUE_DTYPES, in place, and returns it
 
     Keyword Arguments:
-    x -- The row containing the ZipCode to geolocate, must be a string zip code
+    df -- A venue frame like the output of get_nearby_venues
     '''
-    return get_place_latlon(x['ZipCode'])
+    return compact_frame(df, VENUE_DTYPES)
 
 
-def explore_location(lat, lon, limit=100, section=None, trycount=0):
+def compact_demographics(df):
     '''
-    Utilizes the Foursquare API to return top 100 venues near the given coordinates
+    Downcasts the integer demographic columns to int32 where the values fit, in
+    place, and returns the frame. Float columns keep float64 since they feed the
+    clustering, and so do the DEMOGRAPHIC_EXACT_COLUMNS
 
     Keyword Arguments:
-    lat -- the latitude of the location
-    lon -- the longitude of the location
-    limit -- The optional limit on the number of results. Default is 100
+    df -- A demographics frame like the output of load_demographics
     '''
-    logger = logging.getLogger('capstoneutils.explore_location')
-    VERSION = '20190101'
-    
-    # Get the top 100 venues in this postal code from the Foursquare API and transform
-    # the results into a DataFrame. We are excluding radius from the request, as the API
-    # will suggest a radius based on the density of venues in the area    
-    url = 'https://api.foursquare.com/v2/venues/explore?client_id={}&client_secret={}&v={}&ll={},{}&limit={}'.format(
-        rg.CLIENT_ID, 
-        rg.CLIENT_SECRET, 
-        VERSION, 
-        lat, 
-        lon, 
-        limit)
-    
-    if section:
-        url = url + '&section={}'.format(section)
-    
-    result = requests.get(url).json()
-    if (result['meta']['code'] != 200 and trycount < 5):
-        sleep(0.5)
-        t = trycount + 1
-        logger.warning('Retrying Foursquare EXPLORE due to failure. Trycount={}'.format(t))
-        return explore_location(lat, lon, limit, section, trycount=t)
+    info = np.iinfo(np.int32)
+    dtypes = {col: np.int32 for col in df.select_dtypes(include='integer')
+              if col not in DEMOGRAPHIC_EXACT_COLUMNS and len(df) and info.min <= df[col].min() and df[col].max() <= info.max}
+    return compact_frame(df, dtypes)
 
-    return requests.get(url).json()
 
-
-def get_nearby_venues(rownames, latitudes, longitudes, section=None):
+def venues_frame(rownames, latitudes, longitudes, explored, category_tree):
     '''
-    Uses the Foursquare API to get the top 100 venues near the given coordinates
+    Builds the nearby venues dataframe from raw Foursquare EXPLORE results. Values
+    are accumulated into one list per column and the frame is built once at the
+    end, so the cost is linear in the number of venues. Columns have the compact
+    VENUE_DTYPES
 
     Keyword Arguments:
-    names -- A sequence of names intended to help later identify rows
-    latitudes -- A sequence of latitudes to lookup
-    longitudes -- A sequence of longitudes to lookup
+    rownames -- A sequence of names intended to help later identify rows
+    latitudes -- A sequence of the latitudes that were explored
+    longitudes -- A sequence of the longitudes that were explored
+    explored -- A sequence of EXPLORE results, one for each set of coordinates
+    category_tree -- The Foursquare category tree from get_category_tree
     '''
-    venues_list=[]
-    category_tree = get_category_tree()
+    names, c_lats, c_lngs, venues, v_lats, v_lngs, c_mains, c_ids = [], [], [], [], [], [], [], []
     
-    for name, lat, lng in zip(rownames, latitudes, longitudes):
-        # create the API request URL
-        results = explore_location(lat, lng, section=section)
-        
+    for name, lat, lng, results in zip(rownames, latitudes, longitudes, explored):
         # The actual results are in the items array of groups
         groups = results['response']['groups'][0]['items']
         
         # Return relevant information for each nearby venue.
         for v in groups:
             cat = v['venue']['categories'][0]
-            c_main = cat['name']
-            c_top = get_top_parent(category_tree, cat['id']).descr
-            
-            venues_list.append([(
-                name, 
-                lat, 
-                lng, 
-                v['venue']['name'], 
-                v['venue']['location']['lat'], 
-                v['venue']['location']['lng'],
-                c_main,
-                c_top)])
-    
-            nearby_venues = pd.DataFrame([item for venue_list in venues_list for item in venue_list])
-            nearby_venues.columns = [
-                'ZipCode', 
-                'Centroid Latitude', 
-                'Centroid Longitude', 
-                'Venue', 
-                'Venue Latitude', 
-                'Venue Longitude', 
-                'Venue Main Category',
-                'Venue Top-Level Category']
-    
-    return(nearby_venues)
+            names.append(name)
+            c_lats.append(lat)
+            c_lngs.append(lng)
+            venues.append(v['venue']['name'])
+            v_lats.append(v['venue']['location']['lat'])
+            v_lngs.append(v['venue']['location']['lng'])
+            c_mains.append(cat['name'])
+            c_ids.append(cat['id'])
+    
+    return compact_venues(pd.DataFrame({
+        'ZipCode': names,
+        'Centroid Latitude': np.array(c_lats, dtype=np.float64),
+        'Centroid Longitude': np.array(c_lngs, dtype=np.float64),
+        'Venue': venues,
+        'Venue Latitude': np.array(v_lats, dtype=np.float64),
+        'Venue Longitude': np.array(v_lngs, dtype=np.float64),
+        'Venue Main Category': c_mains,
+        'Venue Top-Level Category': get_top_descrs(category_tree, c_ids).tolist()}))
+
+
+# The normalized venue store, which keeps each Foursquare venue once however many
+# zip codes and sections return it
+VENUE_STORE_FILE = './capstone_venues.sqlite'
+
+class VenueStore:
+    '''
+    A sqlite store of Foursquare venues normalized by venue id. Neighboring zip
+    codes return many of the same venues, and the coffee section returns venues
+    the plain explore already found, so rather than a row for every zip code and
+    venue, each venue is stored once in the venues table with its category,
+    top-level category and whether it is a franchise. The memberships table
+    records which venues were returned for each zip code and section, in the order
+    they were returned, and the places table the point that was explored.
+
+    Memberships refer to venues by a small integer key rather than by their id,
+    which is much longer. A venue is classified only the first time it is added,
+    and matched against the franchise list only the first time it is asked for,
+    so venues that are returned again cost neither. frame rebuilds the same frame
+    venues_frame builds for any zip codes and section
+
+    Keyword Arguments:
+    path -- The sqlite file to store the venues in
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = {'venues': 0, 'classified': 0, 'matched': 0}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS venues (
+                key INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                name TEXT,
+                latitude REAL,
+                longitude REAL,
+                category TEXT,
+                top_category TEXT,
+                is_franchise INTEGER);
+            CREATE TABLE IF NOT EXISTS places (
+                zipcode TEXT NOT NULL,
+                section TEXT NOT NULL,
+                latitude REAL,
+                longitude REAL,
+                PRIMARY KEY (zipcode, section)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS memberships (
+                zipcode TEXT NOT NULL,
+                section TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                venue INTEGER NOT NULL,
+                PRIMARY KEY (zipcode, section, rank)) WITHOUT ROWID;''')
+        self.conn.commit()
+
+    def select_in(self, query, values, params=()):
+        '''
+        Returns the rows of a query with an IN clause over the values, run in chunks
+        to stay well under sqlite's limit on the number of parameters. Call it with
+        the lock held
+
+        Keyword Arguments:
+        query -- The query, with {} where the placeholders of the IN clause go
+        values -- The values for the IN clause
+        params -- The parameters before the IN clause. Default is ()
+        '''
+        rows = []
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            rows += self.conn.execute(query.format(','.join('?' * len(chunk))), list(params) + chunk).fetchall()
+        return rows
+
+    def add(self, rownames, latitudes, longitudes, explored, category_tree, section=None):
+        '''
+        Adds raw Foursquare EXPLORE results, replacing the memberships stored for
+        each row name and section, and returns the number of venues that weren't
+        stored yet. Only those are classified; venues already stored keep what was
+        stored the first time
+
+        Keyword Arguments:
+        rownames -- A sequence of names, usually zip codes, one for each result
+        latitudes -- A sequence of the latitudes that were explored
+        longitudes -- A sequence of the longitudes that were explored
+        explored -- A sequence of EXPLORE results, one for each row name
+        category_tree -- The Foursquare category tree from get_category_tree
+        section -- The Foursquare section that was explored. Default is None
+        '''
+        section = section or ''
+        places, members, found = [], [], {}
+        for name, lat, lng, results in zip(rownames, latitudes, longitudes, explored):
+            name = str(name)
+            places.append((name, section, float(lat), float(lng)))
+            for rank, item in enumerate(results['response']['groups'][0]['items']):
+                venue = item['venue']
+                members.append((name, section, rank, venue['id']))
+                found.setdefault(venue['id'], venue)
+
+        with self.lock:
+            query = 'SELECT id, key FROM venues WHERE id IN ({})'
+            keys = dict(self.select_in(query, list(found)))
+            new = [venue for i, venue in found.items() if i not in keys]
+            if new:
+                cats = [venue['categories'][0] for venue in new]
+                tops = get_top_descrs(category_tree, [cat['id'] for cat in cats]).tolist()
+                self.conn.executemany('INSERT INTO venues VALUES (NULL, ?, ?, ?, ?, ?, ?, NULL)', [
+                    (venue['id'], venue['name'], venue['location']['lat'], venue['location']['lng'], cat['name'],
+                     top if isinstance(top, str) else None) for venue, cat, top in zip(new, cats, tops)])
+                keys.update(self.select_in(query, [venue['id'] for venue in new]))
+            self.conn.executemany('DELETE FROM memberships WHERE zipcode = ? AND section = ?',
+                                  [place[:2] for place in places])
+            self.conn.executemany('INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?)', places)
+            self.conn.executemany('INSERT OR REPLACE INTO memberships VALUES (?, ?, ?, ?)',
+                                  [member[:3] + (keys[member[3]],) for member in members])
+            self.conn.commit()
+            self.counters['venues'] += len(members)
+            self.counters['classified'] += len(new)
+        return len(new)
+
+    def match_franchises(self, matcher, rownames, section=None):
+        '''
+        Matches the venues of the row names and section that haven't been matched
+        yet against the franchise list, and returns the number that were matched
+
+        Keyword Arguments:
+        matcher -- The FranchiseMatcher to match the venue names with
+        rownames -- A sequence of the row names whose venues to match
+        section -- The Foursquare section. Default is None
+        '''
+        names = list(dict.fromkeys(str(name) for name in rownames))
+        with self.lock:
+            rows = self.select_in('''SELECT DISTINCT v.key, v.name FROM memberships m
+                                     JOIN venues v ON v.key = m.venue
+                                     WHERE v.is_franchise IS NULL AND m.section = ? AND m.zipcode IN ({})''',
+                                  names, (section or '',))
+            if rows:
+                matched = matcher.match([name for _, name in rows])
+                self.conn.executemany('UPDATE venues SET is_franchise = ? WHERE key = ?',
+                                      [(int(m), i) for (i, _), m in zip(rows, matched)])
+                self.conn.commit()
+                self.counters['matched'] += len(rows)
+        return len(rows)
+
+    def frame(self, rownames, section=None, franchises=False):
+        '''
+        Returns the venues of the row names and section as a frame with the same
+        columns, order and compact dtypes as venues_frame builds, and with a boolean
+        IsFranchise column if franchises is True. Use match_franchises first.
+        Like venues_frame, a row name that is repeated gets its venues once for
+        each time it appears; the store only keeps one explore per row name, so
+        each copy holds the venues stored for it last
+
+        Keyword Arguments:
+        rownames -- A sequence of the row names to return
+        section -- The Foursquare section. Default is None
+        franchises -- Whether to add the IsFranchise column. Default is False
+        '''
+        rownames = [str(name) for name in rownames]
+        names = list(dict.fromkeys(rownames))
+        section = section or ''
+        # Each venue is read once, however many zip codes it belongs to, and spread
+        # out to its memberships afterwards
+        with self.lock:
+            members = self.select_in('SELECT zipcode, rank, venue FROM memberships WHERE section = ? AND zipcode IN ({})',
+                                     names, (section,))
+            places = self.select_in('SELECT zipcode, latitude, longitude FROM places WHERE section = ? AND zipcode IN ({})',
+                                    names, (section,))
+            venues = self.select_in('''SELECT key, name, latitude, longitude, category, top_category, is_franchise
+                                       FROM venues WHERE key IN ({})''', list({member[2] for member in members}))
+        members = pd.DataFrame(members, columns=['ZipCode', 'rank', 'venue'])
+        places = pd.DataFrame(places, columns=['ZipCode', 'Centroid Latitude', 'Centroid Longitude']).set_index('ZipCode')
+        venues = pd.DataFrame(venues, columns=['key', 'Venue', 'Venue Latitude', 'Venue Longitude', 'Venue Main Category',
+                                               'Venue Top-Level Category', 'IsFranchise']).set_index('key')
+
+        # Rows come back in no particular order, so put them in the order of the row
+        # names and then the order the venues were returned in
+        position = pd.Series(np.arange(len(names)), index=pd.Index(names, dtype=object))
+        order = np.lexsort((members['rank'].to_numpy(dtype=np.int64),
+                            members['ZipCode'].map(position).to_numpy(dtype=np.int64)))
+        # Each row name's venues are now one block, in the order of names, so repeat
+        # the blocks in the order of rownames
+        counts = np.bincount(members['ZipCode'].map(position).to_numpy(dtype=np.int64), minlength=len(names))
+        starts = np.cumsum(counts) - counts
+        at_name = position.loc[rownames].to_numpy(dtype=np.int64)
+        lengths = counts[at_name]
+        blocks = np.repeat(starts[at_name] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        members = members.iloc[order[blocks]]
+        at_place = places.index.get_indexer(members['ZipCode'])
+        at_venue = venues.index.get_indexer(members['venue'])
+        df = pd.DataFrame({'ZipCode': members['ZipCode'].to_numpy(dtype=object)})
+        for col in places:
+            df[col] = places[col].to_numpy(dtype=np.float64)[at_place]
+        for col in venues:
+            df[col] = venues[col].to_numpy()[at_venue]
+        if franchises:
+            df['IsFranchise'] = df['IsFranchise'].fillna(0).astype(bool)
+        else:
+            df = df.drop(columns='IsFranchise')
+        return compact_venues(df)
+
+    def stats(self):
+        '''
+        Returns a dictionary of the number of venues, places and memberships stored
+        '''
+        with self.lock:
+            return {table: self.conn.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+                    for table in ['venues', 'places', 'memberships']}
+
+
+venue_store = None
+venue_store_lock = threading.Lock()
+
+def get_venue_store():
+    '''
+    Returns the shared venue store, opening VENUE_STORE_FILE on first use
+    '''
+    global venue_store
+    with venue_store_lock:
+        if venue_store is None or venue_store.path != VENUE_STORE_FILE:
+            venue_store = VenueStore(VENUE_STORE_FILE)
+        return venue_store
 
 
 def return_most_common_venues(row, num_top_venues=10):
@@ -387,102 +2736,397 @@ def get_category_type(row):
         return categories_list[0]['name']
 
 
-def load_demographics():
+# Mean radius of the earth, for converting between meters and the radians the
+# haversine metric works in
+EARTH_RADIUS_M = 6371008.8
+
+class VenueIndex:
+    '''
+    A spatial index over venues, answering batched radius, nearest neighbor and
+    density queries by great circle distance without scanning every venue. Venues
+    are held in a BallTree on the haversine metric. Venues added later go into a
+    second, smaller tree that is rebuilt on each add, and are merged into the main
+    tree once they grow past rebuild_fraction of it, so adding a few venues at a
+    time never rebuilds the whole index.
+
+    Query results are row positions in the venues DataFrame, which holds every
+    venue in the order they were added
+
+    Keyword Arguments:
+    venues -- A Dataframe of venues to start with, or None. Default is None
+    lat_col -- The latitude column. Default is 'Venue Latitude'
+    lon_col -- The longitude column. Default is 'Venue Longitude'
+    rebuild_fraction -- How large the added venues can grow, relative to the main
+                        tree, before they are merged into it. Default is 0.1
+    leaf_size -- The leaf size of the trees. Default is 40
+    '''
+    def __init__(self, venues=None, lat_col='Venue Latitude', lon_col='Venue Longitude',
+                 rebuild_fraction=0.1, leaf_size=40):
+        self.lat_col = lat_col
+        self.lon_col = lon_col
+        self.rebuild_fraction = rebuild_fraction
+        self.leaf_size = leaf_size
+        self.frames = []
+        self.frame = None
+        self.coords = np.empty((0, 2), dtype=np.float64)
+        self.tree = None
+        self.tree_size = 0
+        self.added_tree = None
+        if venues is not None:
+            self.add(venues)
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    @property
+    def venues(self):
+        '''
+        Returns a DataFrame of every venue in the index, in the order they were added
+        '''
+        if self.frame is None or len(self.frames) > 1:
+            self.frames = [pd.concat(self.frames, ignore_index=True)] if self.frames else []
+            self.frame = self.frames[0] if self.frames else pd.DataFrame()
+        return self.frame
+
+    def build(self, coords):
+        '''
+        Returns a haversine BallTree over the coordinates in radians, or None if there
+        are none
+
+        Keyword Arguments:
+        coords -- An array of latitude and longitude rows in radians
+        '''
+        from sklearn.neighbors import BallTree
+        return BallTree(coords, leaf_size=self.leaf_size, metric='haversine') if len(coords) else None
+
+    def add(self, venues):
+        '''
+        Adds venues to the index
+
+        Keyword Arguments:
+        venues -- A Dataframe of venues with the latitude and longitude columns
+        '''
+        coords = np.radians(venues[[self.lat_col, self.lon_col]].to_numpy(dtype=np.float64))
+        self.frames.append(venues.reset_index(drop=True))
+        self.frame = None
+        self.coords = np.concatenate([self.coords, coords])
+        if len(self) - self.tree_size > self.rebuild_fraction * self.tree_size:
+            self.tree = self.build(self.coords)
+            self.tree_size = len(self)
+            self.added_tree = None
+        else:
+            self.added_tree = self.build(self.coords[self.tree_size:])
+
+    def trees(self, points):
+        '''
+        Returns the (tree, offset) of the main tree and the tree of added venues,
+        where offset is the position of the tree's first venue. There are none to
+        query when there are no points, since BallTree rejects an empty query
+
+        Keyword Arguments:
+        points -- The query points from points
+        '''
+        if not len(points):
+            return []
+        return [(tree, offset) for tree, offset in [(self.tree, 0), (self.added_tree, self.tree_size)]
+                if tree is not None]
+
+    def points(self, lats, lons):
+        '''
+        Returns the query points as an array of latitude and longitude rows in radians
+
+        Keyword Arguments:
+        lats -- A sequence of latitudes, or a single latitude
+        lons -- A sequence of longitudes, or a single longitude
+        '''
+        return np.radians(np.column_stack([np.atleast_1d(np.asarray(lats, dtype=np.float64)),
+                                           np.atleast_1d(np.asarray(lons, dtype=np.float64))]))
+
+    def query_radius(self, lats, lons, radius, return_distance=False):
+        '''
+        Returns, for each point, an array of the positions of the venues within
+        radius meters of it, and their distances in meters if return_distance is True
+
+        Keyword Arguments:
+        lats -- A sequence of latitudes, or a single latitude
+        lons -- A sequence of longitudes, or a single longitude
+        radius -- The radius in meters
+        return_distance -- Whether to also return the distances. Default is False
+        '''
+        points = self.points(lats, lons)
+        positions = [[] for _ in range(len(points))]
+        distances = [[] for _ in range(len(points))]
+        for tree, offset in self.trees(points):
+            if return_distance:
+                found, dists = tree.query_radius(points, radius / EARTH_RADIUS_M, return_distance=True)
+            else:
+                found = tree.query_radius(points, radius / EARTH_RADIUS_M)
+            for i in range(len(points)):
+                positions[i].append(found[i] + offset)
+                if return_distance:
+                    distances[i].append(dists[i] * EARTH_RADIUS_M)
+        positions = [np.concatenate(p) if p else np.empty(0, dtype=np.intp) for p in positions]
+        if not return_distance:
+            return positions
+        return positions, [np.concatenate(d) if d else np.empty(0) for d in distances]
+
+    def query_knn(self, lats, lons, k=1):
+        '''
+        Returns arrays of the distances in meters to and the positions of the k
+        nearest venues to each point, nearest first, each with a row per point.
+        When the index has fewer than k venues every venue is returned, so an
+        empty index gives arrays with no columns
+
+        Keyword Arguments:
+        lats -- A sequence of latitudes, or a single latitude
+        lons -- A sequence of longitudes, or a single longitude
+        k -- The number of venues to find. Default is 1
+        '''
+        points = self.points(lats, lons)
+        k = max(min(k, len(self)), 0)
+        if not len(points) or not k:
+            return np.empty((len(points), k)), np.empty((len(points), k), dtype=np.intp)
+        dists, positions = [], []
+        for tree, offset in self.trees(points):
+            d, p = tree.query(points, k=min(k, tree.data.shape[0]))
+            dists.append(d)
+            positions.append(p + offset)
+        dists, positions = np.hstack(dists), np.hstack(positions)
+        if len(dists[0]) > k:
+            order = np.argsort(dists, axis=1, kind='stable')[:, :k]
+            dists = np.take_along_axis(dists, order, axis=1)
+            positions = np.take_along_axis(positions, order, axis=1)
+        return dists * EARTH_RADIUS_M, positions
+
+    def count_within(self, lats, lons, radius):
+        '''
+        Returns an array of the number of venues within radius meters of each point
+
+        Keyword Arguments:
+        lats -- A sequence of latitudes, or a single latitude
+        lons -- A sequence of longitudes, or a single longitude
+        radius -- The radius in meters
+        '''
+        points = self.points(lats, lons)
+        counts = np.zeros(len(points), dtype=np.int64)
+        for tree, _ in self.trees(points):
+            counts += tree.query_radius(points, radius / EARTH_RADIUS_M, count_only=True)
+        return counts
+
+    def density(self, lats, lons, radius):
+        '''
+        Returns an array of the number of venues per square kilometer within radius
+        meters of each point
+
+        Keyword Arguments:
+        lats -- A sequence of latitudes, or a single latitude
+        lons -- A sequence of longitudes, or a single longitude
+        radius -- The radius in meters
+        '''
+        # Area of the spherical cap rather than a flat circle, which matters little
+        # at city scales but keeps large radii honest
+        area = 2 * np.pi * EARTH_RADIUS_M ** 2 * (1 - np.cos(radius / EARTH_RADIUS_M)) / 1e6
+        return self.count_within(lats, lons, radius) / area
+
+
+@instrumented()
+def load_demographics(refresh=False, max_age=None, columns=None, zipcodes=None, max_workers=1,
+                      metro=DEFAULT_METRO, name=None, config=None):
     '''
     Does the heavy lifting of loading the pre-done demographics from a serialized
-    version or builds it from scratch using the utility methods in this library
+    version or builds it from scratch using the utility methods in this library.
+    
+    Building is incremental: each zip code's demographics and geocoding are
+    checkpointed as soon as they are scraped, so an interrupted build resumes from
+    the last zip code it finished, and only zip codes that are new or older than
+    max_age are requested again. Everything else is merged from the checkpoints.
+    Requests for stale zip codes still go through the response cache, which has
+    its own time-to-live for each endpoint
+    
+    Keyword Arguments:
+    refresh -- Rebuild from the checkpoints even if the serialized version exists,
+               picking up new and stale zip codes. Default is False
+    max_age -- The age in seconds after which a zip code is scraped again, or None
+               to keep checkpoints forever. Default is None
+    columns -- The columns to return, or None for all. Default is None
+    zipcodes -- The zip codes to return, or None for all. Default is None
+    max_workers -- The maximum number of concurrent requests. Default is 1
+    metro -- The metro in METROS to load. Default is DEFAULT_METRO
+    name -- The name of the stored dataset. Default is 'all_demog' for the default
+            metro and its partition from metro_dataset for the others
+    config -- The metro's config, laid out like the ones in METROS, or None to use
+              METROS[metro]. Default is None
     '''
     logger = logging.getLogger('capstoneutils.load_demographics')
-    demog_file = './all_demog.pkl'
-    loaded = False
-    try:
-        with open(demog_file, 'rb') as f:
-            logger.info("Geocoding: Using pickled demographics/geocoding.")
-            results = pickle.load(f)
-        loaded = True
+    config = config if config is not None else METROS[metro]
+    demog_name = name or ('all_demog' if metro == DEFAULT_METRO else metro_dataset('all_demog', metro))
+    if not refresh:
+        results = read_dataset(demog_name, columns, zipcodes)
+        if results is not None:
+            logger.info("Geocoding: Using stored demographics/geocoding.")
+            return compact_demographics(results)
+    
+    results = read_dataset(demog_name)
+    logger.info('Building demographics/geocoding data incrementally. Please be patient.')
+    store = get_checkpoints()
+    
+    # Seed the checkpoints from a previously stored dataset so that refreshing it
+    # only fetches what is new or stale
+    if results is not None:
+        updated = os.path.getmtime(dataset_file(demog_name))
+        geo_cols = ['Latitude', 'Longitude']
+        store.seed('demographics', {r['ZipCode']: {k: v for k, v in r.items() if k not in geo_cols}
+                                    for r in results.to_dict('records')}, updated)
+        store.seed('geocode', {z: [lat, lon] for z, lat, lon in
+                               zip(results['ZipCode'], results['Latitude'], results['Longitude'])}, updated)
+    
+    # Scrape the pages with the lists of zip codes for the metro area
+    pages = {ZIPCODES_URL.format(county): cities for county, cities in config['counties'].items()}
 
-    except:
-        pass
-
-    if not loaded:
-        logger.info('Building demographics/geocoding data from scratch. Please be patient.')
-        # Scrape the pages with the lists of zip codes for the Denver metro area
-        pages = {
-            'https://www.zip-codes.com/county/co-denver.asp': ['Denver']
-            ,'https://www.zip-codes.com/county/co-adams.asp': ['Denver','Westminster','Aurora','Thornton']
-            ,'https://www.zip-codes.com/county/co-jefferson.asp': ['Arvada','Broomfield','Wheat Ridge','Littleton','Denver','Golden']
-            ,'https://www.zip-codes.com/county/co-arapahoe.asp': ['Aurora','Englewood','Littleton']
-            ,'https://www.zip-codes.com/county/co-douglas.asp': ['Castle Rock','Lone Tree','Littleton','Parker']
-            ,'https://www.zip-codes.com/county/co-boulder.asp': ['Boulder']
-        }
-
-        den_zips = scrape_zipcodes(pages)
-        logger.info('ZipCodes: Successfully scraped {} zip codes.'.format(den_zips.shape[0]))
-
-        # Scrape the other pages for demographics for each zip code in the list
-        l = []
-        for zipcode in den_zips['ZipCode']:
-            l.append(scrape_demographics(zipcode))
-        l.append(scrape_demographics('85281', 'arizona'))
-        results = pd.DataFrame(l)
-        results['ZipCode'] = results['ZipCode'].astype(str)
-        
-        # We drop three zip codes, two because their demographihcs are all zeroes and one
-        # because its a tiny part of a medical school campus. We then drop any duplicates.
-        results.drop(results[results.ZipCode == '80294'].index, inplace=True)
-        results.drop(results[results.ZipCode == '80225'].index, inplace=True)
-        results.drop(results[results.ZipCode == '80045'].index, inplace=True)
-        results.drop_duplicates('ZipCode', keep='first', inplace=True)
-        logger.info("Demographics: Successfully scraped {} features for {} Zip Codes".format(results.shape[1], results.shape[0]))
-        
-        # Geolocate the zip codes using the Google API
-        results[['Latitude', 'Longitude']] = results.apply(lambda row: pd.Series(get_latlon(row)), axis=1)
-        logger.info("Geocoding: Successfully geocoded {} Zip Codes".format(results.shape[0]))
+    metro_zips = scrape_zipcodes(pages)
+    logger.info('ZipCodes: Successfully scraped {} zip codes.'.format(metro_zips.shape[0]))
 
-        # Reorder the columns and pickle the results        
-        results = results[['ZipCode','Latitude', 'Longitude'] + [c for c in results if c not in ['ZipCode','Latitude', 'Longitude']]]
-        results.to_pickle(demog_file)
-        
-    return results
+    # Scrape the other pages for demographics for each zip code in the list that
+    # doesn't have a fresh checkpoint. Zip codes are unique across metros, so the
+    # checkpoints are shared and only this metro's are loaded
+    keys = [(zipcode, config['state']) for zipcode in metro_zips['ZipCode']] + list(config.get('extra_zips', []))
+    done = store.load('demographics', [zipcode for zipcode, _ in keys])
+    stale = [(zipcode, prefix) for zipcode, prefix in keys if is_stale(done.get(zipcode), max_age)]
+    logger.info('Demographics: Scraping {} of {} zip codes.'.format(len(stale), len(keys)))
+    scraped = scrape_demographics_many([z for z, _ in stale], [p for _, p in stale], max_workers,
+                                       config['fallback_zip'], config['state'])
+    try:
+        for (zipcode, _), data in zip(stale, scraped):
+            store.put('demographics', zipcode, data)
+    except ValueError as e:
+        # Most likely the metro's fallback zip code has no data, so say which metro
+        raise ValueError('Metro {}: {}'.format(metro, e)) from e
+    
+    done = store.load('demographics', [zipcode for zipcode, _ in keys])
+    results = pd.DataFrame([done[zipcode][1] for zipcode, _ in keys])
+    results['ZipCode'] = results['ZipCode'].astype(str)
+    
+    # Drop the zip codes the metro leaves out and then any duplicates
+    results = results[~results['ZipCode'].isin(config.get('drop_zips', []))]
+    results = results.drop_duplicates('ZipCode', keep='first')
+    logger.info("Demographics: Successfully scraped {} features for {} Zip Codes".format(results.shape[1], results.shape[0]))
+    
+    # Geolocate the zip codes that don't have a fresh checkpoint in one batch, using
+    # the geocode cache and then the Google API or the offline centroid table
+    geocoded = store.load('geocode', results['ZipCode'])
+    stale = [zipcode for zipcode in results['ZipCode'] if is_stale(geocoded.get(zipcode), max_age)]
+    logger.info('Geocoding: Geocoding {} of {} zip codes.'.format(len(stale), results.shape[0]))
+    for zipcode, latlon in zip(stale, geocode_places(stale, max_workers, max_age=max_age).tolist()):
+        store.put('geocode', zipcode, latlon)
+    
+    geocoded = store.load('geocode', results['ZipCode'])
+    latlons = np.array([geocoded[zipcode][1] for zipcode in results['ZipCode']], dtype=np.float64).reshape(-1, 2)
+    results['Latitude'] = latlons[:, 0]
+    results['Longitude'] = latlons[:, 1]
+    logger.info("Geocoding: Successfully geocoded {} Zip Codes".format(results.shape[0]))
+
+    # Reorder the columns and store the results        
+    results = compact_demographics(results[['ZipCode','Latitude', 'Longitude'] + [c for c in results if c not in ['ZipCode','Latitude', 'Longitude']]])
+    write_dataset(results, demog_name)
+    
+    return select_dataset(results, columns, zipcodes)
 
 
-def load_foursquare_venues(names, lats, lngs):
+@instrumented()
+def load_foursquare_venues(names, lats, lngs, max_workers=1, refresh=False, max_age=None,
+                           columns=None, zipcodes=None, name='fsq_venues'):
     '''
     Does the heavy lifting to get the venue data from Foursquare or from a file if
     its already been retrieved. The method takes three sequences as paramenters, 
     though it might be easier to think of the parameters as a lists of tuples, one
     for each request that is made to Foursquare.
     
+    Like load_demographics, building is incremental: the venues for each name are
+    checkpointed as they arrive, and only names that are new or older than max_age
+    are requested again
+    
     Keyword Arguments:
     names -- A sequence of rownames to use for each request
     lats -- A sequence of latitudes to use for each request
     lngs -- A sequence of longitudes to use for each request
+    max_workers -- The maximum number of concurrent Foursquare requests. Default is 1
+    refresh -- Rebuild from the checkpoints even if the serialized version exists,
+               picking up new and stale names. Default is False
+    max_age -- The age in seconds after which a name is explored again, or None to
+               keep checkpoints forever. Default is None
+    columns -- The columns to return, or None for all. Default is None
+    zipcodes -- The zip codes to return, or None for all. Default is None
+    name -- The name of the stored dataset. Default is 'fsq_venues'
     '''
     logger = logging.getLogger('capstoneutils.load_foursquare_venues')
-    venue_file = './fsq_venues.pkl'
-    loaded = False
+    venue_name = name
+    if not refresh:
+        result_venues = read_dataset(venue_name, columns, zipcodes, dtypes=VENUE_DTYPES)
+        if result_venues is not None:
+            logger.info("Using stored venue data.")
+            return result_venues
     
-    try:
-        with open(venue_file, 'rb') as f:
-            logger.info("Using pickled venue data.")
-            result_venues = pickle.load(f)
-        loaded = True
-        
-    except:
-        pass
+    result_venues = read_dataset(venue_name, dtypes=VENUE_DTYPES)
+    logger.info('Building Foursquare venue data incrementally. Please be patient.')
+    store = get_checkpoints()
+    if result_venues is not None:
+        store.seed('venues', {name: group.reset_index(drop=True) for name, group in
+                              result_venues.groupby('ZipCode', sort=False, observed=True)},
+                   os.path.getmtime(dataset_file(venue_name)))
     
-    if not loaded:
-        logger.info('Building Foursquare venue data from scratch. Please be patient.')
-        result_venues = get_nearby_venues(rownames=names, latitudes=lats, longitudes=lngs)
-        gp = result_venues.groupby(by='ZipCode').count()
-        logger.info("Top Venues: Successfully retrieved {} features for {} Zip Codes.".format(gp.shape[1], gp.shape[0]))
-        
-        result_venues.to_pickle(venue_file)
+    names, lats, lngs = list(names), list(lats), list(lngs)
+    done = store.load('venues', names)
+    stale = [i for i, name in enumerate(names) if is_stale(done.get(str(name)), max_age)]
+    logger.info('Top Venues: Exploring {} of {} locations.'.format(len(stale), len(names)))
+    
+    if stale:
+        category_tree = get_category_tree()
+        explored = iter_explore_locations([lats[i] for i in stale], [lngs[i] for i in stale], max_workers=max_workers)
+        for i, result in zip(stale, explored):
+            store.put('venues', names[i], venues_frame([names[i]], [lats[i]], [lngs[i]], [result], category_tree))
+        done = store.load('venues', names)
+    
+    frames = [done[str(name)][1] for name in names]
+    # Frames with different categories concatenate to plain columns, so they are
+    # compacted again
+    result_venues = compact_venues(pd.concat([f for f in frames if len(f) > 0] or frames[:1], ignore_index=True))
+    gp = result_venues.groupby(by='ZipCode', observed=True).count()
+    logger.info("Top Venues: Successfully retrieved {} features for {} Zip Codes.".format(gp.shape[1], gp.shape[0]))
+    
+    write_dataset(result_venues, venue_name)
+    return select_dataset(result_venues, columns, zipcodes)
+
+
+def count_coffee_shops(shops, legacy=False):
+    '''
+    Counts the independent and franchise coffee shops in each zip code in one
+    vectorized pass, returning a DataFrame sorted by ZipCode with columns False
+    and True for the independent and franchise counts, All for the total and
+    PctInd for the fraction that are independent. With legacy set the columns are
+    the strings 'False' and 'True' under an 'IsFranchise' column name, the same
+    as the margins pivot table load_coffee_shops used to build
 
-    return result_venues
+    Keyword Arguments:
+    shops -- Dataframe of coffee shops with ZipCode and a boolean IsFranchise column
+    legacy -- Whether to return the old pivot table schema. Default is False
+    '''
+    flags = shops['IsFranchise']
+    if flags.dtype != bool:
+        # Older data has the strings 'True' and 'False'
+        flags = flags.astype(str) == 'True'
+    codes, zips = pd.factorize(shops['ZipCode'], sort=True)
+    counts = np.bincount(codes * 2 + flags.to_numpy(dtype=np.int64), minlength=2 * len(zips)).reshape(-1, 2)
+    total = counts.sum(axis=1)
+    results = pd.DataFrame({'ZipCode': np.asarray(zips, dtype=object), False: counts[:, 0], True: counts[:, 1],
+                            'All': total, 'PctInd': counts[:, 0] / total})
+    if legacy:
+        results.columns = pd.Index(['ZipCode', 'False', 'True', 'All', 'PctInd'], name='IsFranchise')
+    return results
 
 
-def load_coffee_shops(names, lats, lngs):
+@instrumented()
+def load_coffee_shops(names, lats, lngs, max_workers=1, columns=None, zipcodes=None, legacy=True,
+                      name='fsq_coffee', store=None, prefix=False, fuzzy=None, loose=False):
     '''
     Does the heavy lifting to get the coffee venue data from Foursquare or from a file if
     its already been retrieved. The method takes three sequences as paramenters, 
@@ -493,55 +3137,118 @@ def load_coffee_shops(names, lats, lngs):
     names -- A sequence of rownames to use for each request
     lats -- A sequence of latitudes to use for each request
     lngs -- A sequence of longitudes to use for each request
+    max_workers -- The maximum number of concurrent Foursquare requests. Default is 1
+    columns -- The columns to return, or None for all. Default is None
+    zipcodes -- The zip codes to return, or None for all. Default is None
+    legacy -- Whether to return the 'False' and 'True' string columns of the old
+              pivot table rather than the boolean columns of count_coffee_shops.
+              Default is True
+    name -- The name of the stored dataset. Default is 'fsq_coffee'
+    store -- The VenueStore to add the venues to, or None. See get_coffee_shops.
+             Default is None
+    prefix -- Passed to get_coffee_shops when building. Default is False
+    fuzzy -- Passed to get_coffee_shops when building. Default is None
+    loose -- Passed to get_coffee_shops when building. Default is False
     '''
     logger = logging.getLogger('capstoneutils.load_coffee_shops')
-    coffee_file= './fsq_coffee.pkl'
-    loaded = False
-    
-    try:
-        with open(coffee_file, 'rb') as f:
-            logger.info("Using pickled coffee shop data")
-            results = pickle.load(f)
-        loaded = True
-    
-    except:
-        pass
+    coffee_name = name
+    results = read_dataset(coffee_name, columns, zipcodes)
     
-    if not loaded:
+    if results is not None:
+        logger.info("Using stored coffee shop data")
+    else:
         logger.info("Building Foursquare coffee shop data from scratch. Please be patient.")
         # Get the shops from the candidates using Foursquare EXPLORE with a section = 'coffee'
-        # then create and sort a pivot table showing the counts with the margin totals calculated
-        candidate_shops = get_coffee_shops(rownames=names,latitudes=lats,longitudes=lngs)
-        grouped_shops = candidate_shops.groupby(['ZipCode','IsFranchise'], as_index=False)['Venue'].count()
-        results = pd.pivot_table(grouped_shops, index='ZipCode', columns='IsFranchise', values='Venue', aggfunc='sum', margins=True, fill_value=0)
-        results.reset_index(inplace=True)
-        results = results[:-1]
-        results[['PctInd']] = results.apply(lambda row: pd.Series(row['False'] / row['All']), axis=1)
+        # then count the independent and franchise shops in each zip code. The stored
+        # data keeps the old schema since its column names have to be strings
+        candidate_shops = get_coffee_shops(rownames=names,latitudes=lats,longitudes=lngs,
+                                           max_workers=max_workers, store=store, prefix=prefix,
+                                           fuzzy=fuzzy, loose=loose)
+        results = count_coffee_shops(candidate_shops, legacy=True)
         
-        results.to_pickle(coffee_file)
+        write_dataset(results, coffee_name)
+        results = select_dataset(results, columns, zipcodes)
     
+    if not legacy:
+        results = results.rename(columns={'False': False, 'True': True})
+        results.columns.name = None
     return results
 
 
+@instrumented()
+def run_metros(metros=None, max_workers=4, metro_workers=None, coffee=True, refresh=False, max_age=None):
+    '''
+    Builds the demographics, venues and coffee shops of several metros at once,
+    storing each metro in its own partition of all_demog, fsq_venues and
+    fsq_coffee (see metro_dataset). The stages of a metro run in order, and up to
+    metro_workers metros run at the same time, each with up to max_workers
+    requests at once. Every request still goes through the shared rate limiter of
+    its endpoint, so the metros split HTTP_RATE_LIMITS between them: throughput
+    grows with the number of metros until the quota is used up, and no further.
+    A metro that fails is logged and reported without stopping the others.
+    Returns a DataFrame with a row for each metro of its zip codes, venues, coffee
+    shop zip codes, seconds and the error if it failed
+
+    Keyword Arguments:
+    metros -- The metros to build, as names in METROS, a dictionary of metro name to
+              config or the path to a JSON or YAML file of one (see
+              load_metro_configs), or None for all of METROS. Default is None
+    max_workers -- The maximum number of concurrent requests for each metro. Default is 4
+    metro_workers -- The maximum number of metros built at once, or None for all of
+                     them. Default is None
+    coffee -- Whether to build the coffee shops as well. Default is True
+    refresh -- Passed to load_demographics and load_foursquare_venues. Default is False
+    max_age -- Passed to load_demographics and load_foursquare_venues. Default is None
+    '''
+    logger = logging.getLogger('capstoneutils.run_metros')
+    configs = load_metro_configs(metros)
+    metros = list(configs)
+    metro_workers = max(1, min(metro_workers or len(metros), len(metros)))
+
+    # Each metro's iter_map only sizes the pool for its own workers, but they all
+    # share it
+    ensure_pool_size(metro_workers * max_workers)
+
+    def run(metro):
+        start = perf_counter()
+        summary = {'Metro': metro, 'ZipCodes': 0, 'Venues': 0, 'CoffeeShops': 0, 'Seconds': 0.0, 'Error': None}
+        try:
+            demog = load_demographics(refresh=refresh, max_age=max_age, max_workers=max_workers, metro=metro,
+                                      name=metro_dataset('all_demog', metro), config=configs[metro])
+            summary['ZipCodes'] = len(demog)
+            places = demog['ZipCode'], demog['Latitude'], demog['Longitude']
+            venues = load_foursquare_venues(*places, max_workers=max_workers, refresh=refresh, max_age=max_age,
+                                            name=metro_dataset('fsq_venues', metro))
+            summary['Venues'] = len(venues)
+            if coffee:
+                summary['CoffeeShops'] = len(load_coffee_shops(*places, max_workers=max_workers,
+                                                               name=metro_dataset('fsq_coffee', metro)))
+        except Exception as e:
+            logger.exception('{}: Failed to build the metro.'.format(metro))
+            summary['Error'] = repr(e)
+        summary['Seconds'] = perf_counter() - start
+        logger.info('{}: Built {} zip codes and {} venues in {:.1f}s.'.format(
+            metro, summary['ZipCodes'], summary['Venues'], summary['Seconds']))
+        return summary
+
+    return pd.DataFrame(list(iter_map(run, metros, metro_workers)))
+
+
 def get_top_venues(result_venues, num_top_venues=10):
     '''
-    Uses the method shown in the Foursquare lab to generate the top n venues for each zip
-    code in the passed dataframe.
+    Generates the top n venue categories for each zip code in the passed dataframe,
+    the same result as the one hot encoding method shown in the Foursquare lab but
+    computed in one batch. Venues are counted into a zip code by category matrix,
+    and the top n columns of every row are selected at once with argpartition, so
+    there is no per-venue one hot matrix and no per-row sort. Categories with the
+    same count are ordered alphabetically, and zip codes with fewer than n
+    categories are filled with unused categories, also alphabetically
     
     Keyword Arguments:
     result_venues -- Dataframe containg the venue data. Must contain at least a ZipCode
                      and Venue Main Category column
     num_top_venues -- The number of venues to return. Default is 10
     '''
-    # Perform one hot encoding
-    onehot = pd.get_dummies(result_venues[['Venue Main Category']], prefix="", prefix_sep="")
-    
-    # Add back our zip code column and group the data by zip code
-    # and drop the noted features
-    onehot['ZipCode'] = result_venues['ZipCode']
-    
-    onehot_grouped = onehot.groupby('ZipCode').mean().reset_index()
-    
     # Create columns according to number of top venues by exhausting the special suffix
     # list 'indicators' and using the same suffix for items 3-10.
     indicators = ['st', 'nd', 'rd']
@@ -552,16 +3259,150 @@ def get_top_venues(result_venues, num_top_venues=10):
         except:
             columns.append('{}th Most Common Venue'.format(ind+1))
     
-    # Create a new dataframe with the derived column names and our zip codes
-    result_venues_sorted = pd.DataFrame(columns=columns)
-    result_venues_sorted['ZipCode'] = onehot_grouped['ZipCode']
+    # Count the venues in each zip code and category. Both factorizations are
+    # sorted, so rows come out in zip code order and columns in category order
+    zip_codes, zips = pd.factorize(result_venues['ZipCode'], sort=True)
+    cat_codes, cats = pd.factorize(result_venues['Venue Main Category'], sort=True)
+    n_zips, n_cats = len(zips), len(cats)
+    counts = np.bincount(zip_codes * n_cats + cat_codes, minlength=n_zips * n_cats).reshape(n_zips, n_cats)
     
-    # For each zip code, use our utility function to get the top 10 venue categories
-    for ind in np.arange(onehot_grouped.shape[0]):
-        result_venues_sorted.iloc[ind, 1:] = return_most_common_venues(onehot_grouped.iloc[ind, :], num_top_venues)
+    # Fold the alphabetical tie break into a single descending sort key, then pick
+    # the top k of each row and order just those k
+    k = min(num_top_venues, n_cats)
+    key = counts.astype(np.int64) * n_cats + (n_cats - 1 - np.arange(n_cats))
+    result_venues_sorted = pd.DataFrame(columns=columns, index=np.arange(n_zips), dtype=object)
+    result_venues_sorted['ZipCode'] = np.asarray(zips, dtype=object)
+    if k > 0:
+        top = np.argpartition(-key, k - 1, axis=1)[:, :k] if k < n_cats else np.tile(np.arange(n_cats), (n_zips, 1))
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(key, top, axis=1), axis=1), axis=1)
+        result_venues_sorted.iloc[:, 1:k+1] = np.asarray(cats, dtype=object)[top]
     
     return result_venues_sorted
 
+
+def get_diversity_index(result_venues):
+    '''
+    Calculates the reciprocal Simpson's Diversity Index of the main venue categories
+    within each top-level category for each zip code, 1 / sum((n/N)^2), where n is
+    the number of venues in a main category and N the number in its top-level
+    category. Returns a frame with a row for each zip code and a column for each
+    top-level category, with 0.0 where a zip code has no venues in a category.
+    See http://www.countrysideinfo.co.uk/simpsons.htm
+    
+    Keyword Arguments:
+    result_venues -- Dataframe containing the venue data from get_nearby_venues, or
+                     an iterable of such frames, e.g. read in chunks. Must contain
+                     at least the ZipCode, Venue, Venue Main Category and
+                     Venue Top-Level Category columns
+    '''
+    keys = ['ZipCode', 'Venue Top-Level Category', 'Venue Main Category']
+    chunks = [result_venues] if isinstance(result_venues, pd.DataFrame) else result_venues
+    
+    # Counts are additive, so chunks can be counted separately and summed
+    n = None
+    for chunk in chunks:
+        counts = chunk.groupby(keys, observed=True)['Venue'].count()
+        n = counts if n is None else n.add(counts, fill_value=0)
+    
+    big_n = n.groupby(level=[0, 1], observed=True).transform('sum')
+    simpsons_ri = 1 / ((n / big_n) ** 2).groupby(level=[0, 1], observed=True).sum()
+    result = simpsons_ri.unstack(fill_value=0.0)
+    
+    # Compact frames group by categoricals, so give back plain labels either way
+    for axis in ('index', 'columns'):
+        labels = getattr(result, axis)
+        if isinstance(labels, pd.CategoricalIndex):
+            setattr(result, axis, labels.astype(labels.categories.dtype))
+    return result
+
+
+# Arrays shared with the current worker process by sweep_kmeans
+sweep_arrays = {}
+
+def attach_shared_arrays(specs):
+    '''
+    Process pool initializer for sweep_kmeans that maps the shared feature and
+    distance matrices into the worker without copying them, and keeps each worker
+    to a single thread so that the workers don't compete for cores
+
+    Keyword Arguments:
+    specs -- A dictionary of array name to (shared memory name, shape, dtype)
+    '''
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(1)
+    for key, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        sweep_arrays[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+def fit_kmeans(k, n_init, random_state, X=None, D=None):
+    '''
+    Fits k-means for one value of k and returns (k, inertia, silhouette score). The
+    silhouette score is taken from the precomputed distance matrix, or is NaN if
+    there isn't one. In a worker process the matrices come from shared memory
+
+    Keyword Arguments:
+    k -- The number of clusters
+    n_init -- The number of k-means initializations
+    random_state -- The random seed for k-means
+    X -- The feature matrix. Default is the shared one
+    D -- The pairwise distance matrix. Default is the shared one, if any
+    '''
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+    if X is None:
+        X = sweep_arrays['X'][1]
+        D = sweep_arrays['D'][1] if 'D' in sweep_arrays else None
+    
+    kmeans = KMeans(n_clusters=k, n_init=n_init, random_state=random_state).fit(X)
+    score = silhouette_score(D, kmeans.labels_, metric='precomputed') if D is not None else np.nan
+    return k, kmeans.inertia_, score
+
+def sweep_kmeans(X, k_range=range(2, 20), n_init=100, random_state=13031, silhouette=True, max_workers=None):
+    '''
+    Fits k-means for each k in k_range and returns a frame with the inertia (for
+    the elbow method) and the mean silhouette score for each k. The fits run in a
+    pool of processes that share the feature matrix through shared memory, and the
+    pairwise distances are computed once and shared for every silhouette score
+    
+    Keyword Arguments:
+    X -- The (already scaled) feature matrix, one row per zip code
+    k_range -- The values of k to try. Default is 2 through 19
+    n_init -- The number of k-means initializations for each k. Default is 100
+    random_state -- The random seed for k-means. Default is 13031
+    silhouette -- Whether to calculate silhouette scores. Default is True
+    max_workers -- The number of processes to use. Default is None, one per core
+    '''
+    from sklearn.metrics import pairwise_distances
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    arrays = {'X': X}
+    if silhouette:
+        arrays['D'] = pairwise_distances(X)
+    
+    ks = list(k_range)
+    if max_workers == 1:
+        rows = [fit_kmeans(k, n_init, random_state, arrays['X'], arrays.get('D')) for k in ks]
+    else:
+        shms, specs = [], {}
+        try:
+            for key, arr in arrays.items():
+                shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                shms.append(shm)
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+                specs[key] = (shm.name, arr.shape, arr.dtype.str)
+            
+            # Hand out the largest k first since those take the longest to fit
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=attach_shared_arrays,
+                                     initargs=(specs,)) as pool:
+                futures = [pool.submit(fit_kmeans, k, n_init, random_state) for k in sorted(ks, reverse=True)]
+                rows = sorted((f.result() for f in futures), key=lambda r: ks.index(r[0]))
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+    
+    return pd.DataFrame(rows, columns=['k', 'Inertia', 'Silhouette Score'])
+
+
 def is_franchise(x, fr_list):
     '''
     Uses the given list to determine if the row representing a venue is a franchise or not.
@@ -587,73 +3428,232 @@ def is_franchise(x, fr_list):
     
     return [isFranchise]
 
-def get_coffee_shops(rownames, latitudes, longitudes):
+
+# Venue names are matched as a franchise name when their first word is one of
+# these, like 'Starbucks Reserve' or Foursquare's "Dunkin'Donuts", whatever follows.
+# These are the special cases is_franchise always had
+FRANCHISE_FIRST_WORDS = {'Starbucks': 'Starbucks', "Dunkin'Donuts": "Dunkin' Donuts"}
+
+
+def normalize_venue_names(names, loose=True):
+    '''
+    Normalizes a Series of venue or franchise names for matching the way
+    is_franchise did: anything after a '(' or '#' is dropped, the ends are
+    stripped and names starting with one of FRANCHISE_FIRST_WORDS become its
+    franchise name. When loose is True, curly apostrophes are also straightened,
+    runs of whitespace collapsed and the names case folded before that
+
+    Keyword Arguments:
+    names -- A Series of names
+    loose -- Whether to also ignore case, apostrophe style and spacing. Default is True
+    '''
+    def clean(values):
+        values = values.astype(str).str.replace(r'[(#].*$', '', regex=True).str.strip()
+        if loose:
+            values = (values.str.replace('\u2019', "'", regex=False)
+                      .str.replace(r'\s+', ' ', regex=True)
+                      .str.casefold())
+        return values
+
+    normalized = clean(names)
+    words = dict(zip(clean(pd.Series(list(FRANCHISE_FIRST_WORDS), dtype=object)),
+                     clean(pd.Series(list(FRANCHISE_FIRST_WORDS.values()), dtype=object))))
+    first = normalized.str.split(' ', n=1).str[0]
+    return normalized.where(~first.isin(list(words)), first.map(words))
+
+
+class FranchiseMatcher:
+    '''
+    Matches venue names against a list of franchise names. The franchise names are
+    normalized once into a hashed set, and each distinct venue name is normalized
+    and looked up once however many times it appears, so matching a column of
+    venues is a handful of vectorized string operations rather than a scan of the
+    list per row.
+
+    By default a venue matches if its name, normalized as is_franchise did, is
+    exactly a franchise name, so it flags the same venues as is_franchise. The
+    other kinds of match are opt-in:
+    - loose also ignores case, curly apostrophes and extra spaces on both sides,
+      so 'starbucks' and 'Peet’s Coffee' match
+    - prefix matches names that start with any franchise name followed by more
+      words, like 'Peet's Coffee Reserve'
+    - fuzzy compares names that don't match otherwise with difflib and matches
+      them if their similarity ratio is at least fuzzy
+
+    Keyword Arguments:
+    franchise_names -- A sequence of franchise names
+    prefix -- Whether to match names that start with a franchise name. Default is False
+    fuzzy -- The similarity ratio between 0 and 1 for fuzzy matches, or None to
+             turn them off. Default is None
+    loose -- Whether to ignore case, apostrophe style and spacing. Default is False
+    '''
+    def __init__(self, franchise_names, prefix=False, fuzzy=None, loose=False):
+        franchise_names = pd.Series(list(franchise_names), dtype=object)
+        # Without loose matching the franchise names are compared as they are,
+        # like is_franchise compared them
+        normalized = normalize_venue_names(franchise_names) if loose else franchise_names.astype(str)
+        self.names = set(normalized[normalized != ''])
+        self.loose = loose
+        self.prefix = prefix
+        self.fuzzy = fuzzy
+        # The franchise names grouped by how many words they have, so prefixes can be
+        # checked one word count at a time
+        self.by_words = {}
+        for name in self.names:
+            self.by_words.setdefault(name.count(' ') + 1, set()).add(name)
+
+    def match_unique(self, names):
+        '''
+        Returns a boolean array of whether each of the already distinct names is a
+        franchise
+
+        Keyword Arguments:
+        names -- A Series of distinct names
+        '''
+        normalized = normalize_venue_names(names, self.loose)
+        matched = normalized.isin(self.names).to_numpy(dtype=bool, copy=True)
+        if self.prefix:
+            for words in self.by_words:
+                heads = normalized.str.extract(r'^((?:\S+ ){%d}\S+) ' % (words - 1), expand=False)
+                matched |= heads.isin(self.by_words[words]).to_numpy(dtype=bool)
+        if self.fuzzy is not None and self.names:
+            import difflib
+            choices = list(self.names)
+            for i in np.flatnonzero(~matched):
+                matched[i] = bool(difflib.get_close_matches(normalized.iat[i], choices, n=1, cutoff=self.fuzzy))
+        return matched
+
+    def match(self, names):
+        '''
+        Returns a boolean Series, aligned with names, of whether each venue is a franchise
+
+        Keyword Arguments:
+        names -- A Series or sequence of venue names
+        '''
+        names = names if isinstance(names, pd.Series) else pd.Series(list(names), dtype=object)
+        codes, uniques = pd.factorize(names)
+        matched = self.match_unique(pd.Series(uniques, dtype=object))
+        # factorize codes missing names as -1, which are never franchises
+        result = np.append(matched, False)[codes]
+        return pd.Series(result, index=names.index, name='IsFranchise')
+
+
+@instrumented()
+def get_coffee_shops(rownames, latitudes, longitudes, max_workers=1, store=None, half_size=None, prefix=False,
+                     fuzzy=None, loose=False):
     '''
     Utilizes the Foursquare EXPLORE endpoint with a section parameter to obtain a recommended
-    list of coffee shops for the given places
+    list of coffee shops for the given places. With a VenueStore, coffee shops it
+    already has from earlier explores are neither classified nor matched against
+    the franchise list again
     
     Keyword Arguments:
     rownames -- A sequence of names intended to help later identify rows
     latitudes -- A sequence of latitudes to lookup
     longitudes -- A sequence of longitudes to lookup
+    max_workers -- The maximum number of concurrent Foursquare requests. Default is 1
+    store -- The VenueStore to add the venues to, or None. Default is None
+    half_size -- Half the width in meters of the square to explore with tiles, or
+                 None for a single request per location. Default is None
+    prefix -- Whether to also flag venues whose names start with a franchise name,
+              see FranchiseMatcher. Venues already matched in the store keep
+              their flags. Default is False
+    fuzzy -- The similarity ratio for fuzzy franchise matches, or None to turn them
+             off. See FranchiseMatcher. Default is None
+    loose -- Whether franchise matches ignore case, apostrophe style and spacing.
+             See FranchiseMatcher. Default is False
     '''
-    franchises = scrape_franchises()
-    fr_vals = franchises['Name'].values
+    matcher = FranchiseMatcher(scrape_franchises()['Name'], prefix=prefix, fuzzy=fuzzy, loose=loose)
+    rownames = list(rownames)
     
     candidate_cs = get_nearby_venues(rownames=rownames,
                                      latitudes=latitudes,
                                      longitudes=longitudes,
-                                     section='coffee')
+                                     section='coffee',
+                                     max_workers=max_workers,
+                                     half_size=half_size,
+                                     store=store)
     
     # Foursquare's 'coffee' section returns a few things that are not 
     # just coffee shops, so I'm only keeping the ones that are
     candidate_cs.drop(candidate_cs[~candidate_cs['Venue Main Category'].isin(['Coffee Shop'])].index, inplace=True)
     
-    # Add a column that says whether the venue is a franchise based
+    # Add a boolean column that says whether the venue is a franchise based
     # on the list we sraped from Wikipedia
-    candidate_cs[['IsFranchise']] = candidate_cs.apply(lambda row: pd.Series(is_franchise(row, fr_vals)), axis=1)
+    if store is not None:
+        store.match_franchises(matcher, rownames, 'coffee')
+        flags = store.frame(rownames, 'coffee', franchises=True)['IsFranchise']
+        candidate_cs['IsFranchise'] = flags.loc[candidate_cs.index].to_numpy()
+    else:
+        candidate_cs['IsFranchise'] = matcher.match(candidate_cs['Venue'])
    
     return candidate_cs
+
+
+def iter_coffee_shops(rownames, latitudes, longitudes, max_workers=1, batch_size=1, store=None, half_size=None,
+                      prefix=False, fuzzy=None, loose=False):
+    '''
+    Generator version of get_coffee_shops that yields the coffee shops for each
+    row name, or for each batch_size of them, in input order as soon as their
+    responses have arrived, with the same columns and IsFranchise flag. See
+    iter_nearby_venues
+
+    Keyword Arguments:
+    rownames -- An iterable of names intended to help later identify rows
+    latitudes -- An iterable of latitudes to lookup
+    longitudes -- An iterable of longitudes to lookup
+    max_workers -- The maximum number of concurrent Foursquare requests. Default is 1
+    batch_size -- The number of row names in each frame. Default is 1
+    store -- The VenueStore to add the venues to, or None. Default is None
+    half_size -- Half the width in meters of the square to explore with tiles, or
+                 None for a single request per location. Default is None
+    prefix -- Whether to also flag venues whose names start with a franchise name,
+              see FranchiseMatcher. Venues already matched in the store keep
+              their flags. Default is False
+    fuzzy -- The similarity ratio for fuzzy franchise matches, or None to turn them
+             off. See FranchiseMatcher. Default is None
+    loose -- Whether franchise matches ignore case, apostrophe style and spacing.
+             See FranchiseMatcher. Default is False
+    '''
+    matcher = FranchiseMatcher(scrape_franchises()['Name'], prefix=prefix, fuzzy=fuzzy, loose=loose)
+    for batch in iter_nearby_venues(rownames, latitudes, longitudes, section='coffee', max_workers=max_workers,
+                                    half_size=half_size, batch_size=batch_size, store=store):
+        if store is not None:
+            names = batch['ZipCode'].unique()
+            store.match_franchises(matcher, names, 'coffee')
+            batch = batch.assign(IsFranchise=store.frame(names, 'coffee', franchises=True)['IsFranchise'].to_numpy())
+            yield batch[batch['Venue Main Category'] == 'Coffee Shop']
+            continue
+        batch = batch[batch['Venue Main Category'] == 'Coffee Shop']
+        batch = batch.assign(IsFranchise=matcher.match(batch['Venue']))
+        yield batch
         
+@instrumented()
 def get_nextvenues(trycount=0):
     '''
     Returns the top 5 most commonly visited venues for my venue
+
+    Keyword Arguments:
+    trycount -- Ignored, kept so older callers still work. Retries are made by
+                fetch. Default is 0
     '''
-    logger = logging.getLogger('capstoneutils.get_nextvenues')
     VERSION = '20190101'
     
-    # Get the top 100 venues in this postal code from the Foursquare API and transform
-    # the results into a DataFrame. We are excluding radius from the request, as the API
-    # will suggest a radius based on the density of venues in the area
-    url = 'https://api.foursquare.com/v2/venues/{}/nextvenues?client_id={}&client_secret={}&v={}'.format(
-        rg.MY_VENUE,
-        rg.CLIENT_ID, 
-        rg.CLIENT_SECRET, 
+    # Get the venues most often visited after my venue from the Foursquare API. The
+    # nextvenues endpoint takes no location or radius
+    url = '{}/venues/{}/nextvenues?client_id={}&client_secret={}&v={}'.format(
+        FOURSQUARE_URL,
+        get_secrets().MY_VENUE,
+        get_secrets().CLIENT_ID, 
+        get_secrets().CLIENT_SECRET, 
         VERSION)
     
-    results = requests.get(url).json()
-    if (results['meta']['code'] != 200 and trycount < 5):
-        sleep(0.5)
-        t = trycount + 1
-        logger.warning('Retrying Foursquare NEXTVENUES due to failure. Trycount={}'.format(t))
-        return get_nextvenues(trycount=t)
-    
-    venues_list=[]
+    results = json.loads(cached_get(url, 'nextvenues', is_valid=foursquare_ok))
     items = results['response']['nextVenues']['items']
     
-    for i in items:
-        venues_list.append([(
-            i['name'],
-            i['categories'][0]['name'],
-            i['location']['lat'],
-            i['location']['lng'])])     
-        
-        next_venues = pd.DataFrame([item for venue_list in venues_list for item in venue_list])
-        
-        next_venues.columns = [
-            'Venue', 
-            'Venue Main Category',
-            'Venue Latitude', 
-            'Venue Longitude']
-    
-    return(next_venues)
+    # Build the frame once from whole columns rather than once per venue
+    return pd.DataFrame({
+        'Venue': [i['name'] for i in items],
+        'Venue Main Category': [i['categories'][0]['name'] for i in items],
+        'Venue Latitude': np.array([i['location']['lat'] for i in items], dtype=np.float64),
+        'Venue Longitude': np.array([i['location']['lng'] for i in items], dtype=np.float64)})
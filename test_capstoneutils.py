@@ -0,0 +1,338 @@
+'''
+Tests for the capstoneutils library. Like the benchmarks, none of these talk to
+the real APIs: the fetchers are pointed at the local stand-in server from
+capstonebench, which can be told to fail, stall, throttle or garble a share of
+its responses.
+
+Run with pytest from this directory.
+
+Author: Jason R. Foster
+'''
+import io                           # For encoding the stand-in's map tile
+import os                           # For finding the stored datasets next to this file
+from time import perf_counter
+import numpy as np
+import pandas as pd
+import pytest
+import requests                     # For the errors raised when requests give up
+
+import capstonebench                # Registers placeholder credentials before the library loads
+import capstoneutils as csutil
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def standin():
+    '''
+    Returns a function that starts a stand-in server with the given settings, as
+    start_standin does, and stops every server it started once the test is done
+    '''
+    servers = []
+    def start(**settings):
+        server = capstonebench.start_standin(**settings)
+        servers.append(server)
+        return server
+    yield start
+    for server in reversed(servers):
+        capstonebench.stop_standin(server)
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    '''
+    Lifts the client side rate limits and shortens the retry backoff so that
+    retried requests don't slow the tests down
+    '''
+    monkeypatch.setattr(csutil, 'HTTP_RATE_LIMITS', {})
+    monkeypatch.setattr(csutil, 'http_limiters', {})
+    monkeypatch.setattr(csutil, 'HTTP_BACKOFF_BASE', 0.01)
+
+
+# Diversity index
+
+def test_diversity_matches_notebook_calculation():
+    stored = pd.read_pickle(os.path.join(HERE, 'fsq_venues.pkl'))
+    index = csutil.get_diversity_index(stored)
+    assert np.allclose(index.values, capstonebench.diversity_notebook(stored).values)
+
+
+def test_diversity_matches_notebook_output():
+    stored = pd.read_pickle(os.path.join(HERE, 'fsq_venues.pkl'))
+    index = csutil.get_diversity_index(stored)
+    # Values shown in the Week 5 notebook for Food and Nightlife Spot
+    reported = {'80302': (22.084507, 5.400000), '80303': (14.440000, 2.117647), '85281': (17.808696, 2.941176)}
+    for zipcode, values in reported.items():
+        assert np.allclose(index.loc[zipcode, ['Food', 'Nightlife Spot']].values, values, atol=1e-6), zipcode
+
+
+def test_diversity_of_chunks_matches_whole_frame():
+    venues = capstonebench.synthetic_venue_frame(50)
+    whole = csutil.get_diversity_index(venues)
+    chunked = csutil.get_diversity_index(venues.iloc[i:i + 700] for i in range(0, venues.shape[0], 700))
+    assert np.allclose(whole.values, chunked.values)
+
+
+# Retries and rate limits
+
+def test_retries_recover_from_injected_errors(standin, fast_retries):
+    names, lats, lngs = capstonebench.synthetic_centroids(30)
+    standin()
+    clean = csutil.get_nearby_venues(names, lats, lngs, max_workers=8)
+    server = standin(error_rate=0.3)
+    flaky = csutil.get_nearby_venues(names, lats, lngs, max_workers=8)
+    assert server.error_count > 0
+    assert flaky.equals(clean)
+
+
+def test_stalled_requests_time_out_and_retry(standin, fast_retries, monkeypatch):
+    monkeypatch.setattr(csutil, 'HTTP_TIMEOUT', (5, 0.25))
+    names, lats, lngs = capstonebench.synthetic_centroids(30)
+    standin()
+    clean = csutil.get_nearby_venues(names, lats, lngs, max_workers=8)
+    retries = csutil.http_counters['retries']
+    standin(stall_rate=0.1, stall_seconds=2.0)
+    stalled = csutil.get_nearby_venues(names, lats, lngs, max_workers=8)
+    assert csutil.http_counters['retries'] > retries
+    assert stalled.equals(clean)
+
+
+def test_garbled_responses_are_retried(standin, fast_retries):
+    names, lats, lngs = capstonebench.synthetic_centroids(30)
+    standin()
+    clean = csutil.get_nearby_venues(names, lats, lngs, max_workers=8)
+    retries = csutil.http_counters['retries']
+    standin(garbled_rate=0.3)
+    garbled = csutil.get_nearby_venues(names, lats, lngs, max_workers=8)
+    assert csutil.http_counters['retries'] > retries
+    assert garbled.equals(clean)
+
+
+def test_persistent_errors_give_up(standin, fast_retries, monkeypatch):
+    monkeypatch.setattr(csutil, 'HTTP_MAX_TRIES', 3)
+    server = standin(error_rate=1.0)
+    with pytest.raises(requests.exceptions.RetryError):
+        csutil.explore_location(39.74, -104.99)
+    assert server.request_count == 3
+
+
+def test_fetchers_accept_trycount(standin, fast_retries):
+    standin(latency=0.0)
+    assert csutil.get_category_tree(trycount=2).name == csutil.get_category_tree().name
+    # trycount keeps its old place before radius, so positional calls still work
+    assert csutil.explore_location(39.74, -104.99, 100, None, 2) == csutil.explore_location(39.74, -104.99)
+
+
+def test_get_nextvenues_accepts_trycount(monkeypatch):
+    # The stand-in has no nextvenues endpoint, so answer with an empty list
+    monkeypatch.setattr(csutil, 'cached_get', lambda *args, **kwargs:
+                        '{"meta": {"code": 200}, "response": {"nextVenues": {"items": []}}}')
+    assert len(csutil.get_nextvenues(trycount=2)) == 0
+
+
+def test_unknown_place_fails_without_retrying(standin, fast_retries):
+    server = standin()
+    server.unknown_places.add('Nowhere, XX')
+    with pytest.raises(csutil.UnusableResponse):
+        csutil.fetch_place_latlon('Nowhere, XX')
+    assert server.request_count == 1
+
+
+def test_get_place_latlon_accepts_trycount(standin, fast_retries, monkeypatch, tmp_path):
+    monkeypatch.setattr(csutil, 'CHECKPOINT_FILE', str(tmp_path / 'checkpoints.sqlite'))
+    monkeypatch.setattr(csutil, 'place_latlons', None)
+    standin(latency=0.0)
+    assert csutil.get_place_latlon('Denver, CO, USA', trycount=3) == csutil.get_place_latlon('Denver, CO, USA')
+
+
+def test_rate_limiter_stays_under_the_quota(standin, fast_retries):
+    names, lats, lngs = capstonebench.synthetic_centroids(60)
+    csutil.HTTP_RATE_LIMITS['explore'] = (40, 1)
+    server = standin(latency=0.005, quota_rate=40)
+    csutil.explore_locations(lats, lngs, max_workers=16)
+    assert server.error_count == 0
+
+
+@pytest.mark.parametrize('headers', [('', ''), ('100', 'Wed, 21 Oct 2026 07:28:00 GMT'), ('many', '1893456000')])
+def test_malformed_quota_headers_are_ignored(standin, fast_retries, headers):
+    server = standin(latency=0.0)
+    server.quota_headers = headers
+    result = csutil.explore_location(39.74, -104.99)
+    assert len(result['response']['groups'][0]['items']) > 0
+    assert server.request_count == 1
+
+
+def test_reported_quota_is_used_in_a_burst():
+    limiter = csutil.RateLimiter(None, 1)
+    limiter.update_quota(100, 3600)
+    start = perf_counter()
+    for _ in range(50):
+        limiter.acquire()
+    assert perf_counter() - start < 0.5
+
+
+def test_reported_quota_that_runs_low_slows_requests():
+    limiter = csutil.RateLimiter(None, 1)
+    limiter.update_quota(2, 1.0)
+    start = perf_counter()
+    for _ in range(4):
+        limiter.acquire()
+    # Two requests are left at once, then the quota's rate of two a second
+    assert perf_counter() - start >= 0.8
+
+
+# Demographics
+
+def test_missing_fallback_demographics_raise(standin, fast_retries):
+    server = standin(latency=0.0)
+    server.missing_zips.update(['80203', '80202'])
+    csutil.clear_fallback_demographics()
+    with pytest.raises(ValueError, match='80202'):
+        csutil.scrape_demographics('80203', 'colorado')
+    # A failed fallback is tried again by the next caller rather than remembered
+    server.missing_zips.discard('80202')
+    assert csutil.scrape_demographics('80203', 'colorado')['ZipCode'] == '80202'
+    csutil.clear_fallback_demographics()
+
+
+def test_metro_uses_its_own_fallback_zip(standin, fast_retries, monkeypatch, tmp_path):
+    monkeypatch.setattr(csutil, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(csutil, 'CHECKPOINT_FILE', str(tmp_path / 'checkpoints.sqlite'))
+    metros = {'testmetro': {'counties': {'xx-testmetro-county0': ['City 0']}, 'state': 'somestate',
+                            'fallback_zip': None}}
+    server = standin(latency=0.0, metros=metros)
+    rows = server.county_zips['xx-testmetro-county0']
+    kept = [zipcode for zipcode, kind, city in rows if kind == 'General' and city == 'City 0']
+    fallback, missing = kept[0], kept[1]
+    metros['testmetro']['fallback_zip'] = fallback
+    server.missing_zips.update([fallback, missing])
+    csutil.clear_fallback_demographics()
+
+    summary = csutil.run_metros(metros, coffee=False)
+    assert 'testmetro' in summary['Error'][0] and fallback in summary['Error'][0]
+
+    # With the fallback page back, the missing zip code gets the metro's fallback,
+    # which the duplicates are then dropped with, and never Denver's
+    server.missing_zips.discard(fallback)
+    demog = csutil.load_demographics(refresh=True, metro='testmetro', config=metros['testmetro'],
+                                     name=csutil.metro_dataset('all_demog', 'testmetro'))
+    assert set(demog['ZipCode']) == set(kept) - {missing}
+    csutil.clear_fallback_demographics()
+
+
+# Tiled exploration
+
+@pytest.fixture
+def world():
+    return capstonebench.synthetic_world([(39.7508, -104.9966, 6000, 700), (39.6100, -105.0200, 150, 1500)],
+                                         background=400, seed=4)
+
+
+def venues_in_square(world, lat, lng, half_size):
+    '''
+    Returns the ids of the world's venues within half_size meters of the point
+    north to south and east to west
+    '''
+    m_lon = csutil.METERS_PER_DEGREE * np.cos(np.radians(lat))
+    return set(world['id'][(np.abs(world['lat'] - lat) * csutil.METERS_PER_DEGREE <= half_size) &
+                           (np.abs(world['lng'] - lng) * m_lon <= half_size)])
+
+
+def test_explore_tiled_finds_every_venue_in_a_dense_area(standin, fast_retries, world):
+    standin(latency=0.0, world=world)
+    in_square = venues_in_square(world, 39.7508, -104.9966, 1500)
+    tiled = csutil.explore_tiled(39.7508, -104.9966, 1500, max_workers=8)
+    ids = [item['venue']['id'] for item in tiled['response']['groups'][0]['items']]
+    assert len(in_square) > 100
+    assert len(ids) == len(set(ids))
+    assert set(ids) == in_square
+    assert tiled['meta']['depth'] > 0
+
+
+def test_explore_tiled_makes_one_request_in_a_sparse_area(standin, fast_retries, world):
+    server = standin(latency=0.0, world=world)
+    in_square = venues_in_square(world, 39.9000, -105.2000, 1500)
+    tiled = csutil.explore_tiled(39.9000, -105.2000, 1500)
+    assert {item['venue']['id'] for item in tiled['response']['groups'][0]['items']} == in_square
+    assert server.request_count == 1
+
+
+# Franchise matching
+
+FRANCHISES = ['Starbucks', "Dunkin' Donuts", "Peet's Coffee", 'Caribou Coffee']
+VENUE_NAMES = ['Starbucks', 'Starbucks Reserve', 'starbucks', 'STARBUCKS (Union Station)', "Dunkin'Donuts",
+               "Dunkin'Donuts Baskin", "Dunkin' Donuts #123", "Peet's Coffee", 'Peet’s Coffee',
+               "Peet's  Coffee", "Peet's Coffee Reserve", 'Caribou Coffee (Cherry Creek)', 'Caribou',
+               'Corner Cafe', '']
+
+
+def test_franchise_matcher_defaults_to_is_franchise():
+    names = pd.Series(VENUE_NAMES, dtype=object)
+    legacy = [csutil.is_franchise({'Venue': name}, FRANCHISES)[0] == 'True' for name in VENUE_NAMES]
+    assert list(csutil.FranchiseMatcher(FRANCHISES).match(names)) == legacy
+
+
+def test_franchise_matcher_opt_in_differences():
+    names = pd.Series(VENUE_NAMES, dtype=object)
+    default = csutil.FranchiseMatcher(FRANCHISES).match(names)
+    added = {
+        # Case, curly apostrophes and extra spaces
+        'loose': ['starbucks', 'STARBUCKS (Union Station)', 'Peet’s Coffee', "Peet's  Coffee"],
+        # A franchise name followed by more words
+        'prefix': ["Peet's Coffee Reserve"],
+    }
+    for option, names_added in added.items():
+        matched = csutil.FranchiseMatcher(FRANCHISES, **{option: True}).match(names)
+        assert not (default & ~matched).any()
+        assert sorted(names[matched & ~default]) == sorted(names_added), option
+
+
+# Static maps
+
+@pytest.mark.parametrize('pooled', [True, False])
+def test_render_static_map_draws_tiles(standin, tmp_path, pooled):
+    folium = pytest.importorskip('folium')
+    Image = pytest.importorskip('PIL.Image')
+    buf = io.BytesIO()
+    Image.new('RGB', (256, 256), '#d0e0c8').save(buf, 'PNG')
+    server = standin(latency=0.0)
+    server.tile_png = buf.getvalue()
+    fmap = folium.Map(location=[39.7392, -104.9903], zoom_start=10,
+                      tiles=server.base_url + '/tiles/{z}/{x}/{y}.png', attr='stand-in')
+    csutil.configure_session(pooled=pooled)
+    try:
+        csutil.render_static_map(fmap, str(tmp_path / 'tiled.png'), size=(512, 384), tiles=True)
+    finally:
+        csutil.configure_session(pooled=True)
+    assert server.request_count > 0
+    assert Image.open(str(tmp_path / 'tiled.png')).convert('RGB').getpixel((10, 10)) == (0xd0, 0xe0, 0xc8)
+
+
+# Venue store
+
+def test_venue_store_frame_matches_storeless_frame_with_repeated_names(standin, fast_retries, tmp_path):
+    names, lats, lngs = capstonebench.synthetic_centroids(3)
+    names, lats, lngs = names + names[:1] + names[1:2], lats + lats[:1] + lats[1:2], lngs + lngs[:1] + lngs[1:2]
+    standin(latency=0.0)
+    storeless = csutil.get_nearby_venues(names, lats, lngs)
+    store = csutil.VenueStore(str(tmp_path / 'venues.sqlite'))
+    stored = csutil.get_nearby_venues(names, lats, lngs, store=store)
+    assert len(stored) == len(storeless) == 500
+    pd.testing.assert_frame_equal(stored, storeless)
+    assert len(store.frame([])) == 0
+
+
+# Spatial index
+
+def test_venue_index_answers_empty_queries():
+    empty = csutil.VenueIndex()
+    dists, positions = empty.query_knn([39.74, 39.75], [-104.99, -105.0], k=3)
+    assert dists.shape == positions.shape == (2, 0)
+    assert list(empty.count_within([39.74], [-104.99], 500)) == [0]
+
+    venues = pd.DataFrame({'Venue Latitude': [39.74, 39.75, 39.76], 'Venue Longitude': [-104.99, -105.0, -105.01]})
+    index = csutil.VenueIndex(venues)
+    dists, positions = index.query_knn([], [], k=2)
+    assert dists.shape == positions.shape == (0, 2)
+    assert index.query_radius([], [], 500) == []
+    assert len(index.count_within([], [], 500)) == 0